@@ -0,0 +1,195 @@
+'''
+Headless asyncio client for bots and integrations.
+
+Speaks the same protocol as client.py without the TUI, and doesn't import
+urwid:
+
+    client = await aio_client.connect('localhost', 8000)
+    await client.login('bot', encoding=BINARY)
+    client.join('deploys')
+    client.send('deploys', 'build 1234 is out')
+    async for event in client:
+        ...
+    client.close()
+
+Requests are pipelined: join, send, whisper and the other request methods
+queue the request and return at once, they don't wait for the server's
+answer. Everything queued before the event loop next gets control goes out
+in one write (one compressed block with compression on). Answers and
+everything else the server sends come through the client's async iterator,
+HEART_BEATs are answered automatically and never show up there. Call drain
+to wait for the socket to catch up when sending a lot.
+'''
+
+import asyncio
+
+from opcodes import OpCode
+from framing import RECV_SIZE
+from codec import JsonCodec
+from session import LOGIN_ERRORS, LoginError, login_request, accept_login
+
+
+async def connect(host='localhost', port=8000):
+    '''
+    Opens a connection to the server and returns a ChatClient for it
+    '''
+    reader, writer = await asyncio.open_connection(host, port)
+    return ChatClient(reader, writer)
+
+
+class ChatClient:
+    '''
+    One connection to the server
+    '''
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.username = None
+        self.codec = JsonCodec()
+        self.decoder = self.codec.new_decoder()
+        self.compressor = None
+        self.decompressor = None
+        # encoded requests waiting for the next flush
+        self.pending = []
+        self.flush_scheduled = False
+
+    async def login(self, username, encoding=None, compression=None):
+        '''
+        Logs in and returns the LOGIN response, raises LoginError if the
+        server refuses the name
+        '''
+        self.request(login_request(username, encoding, compression))
+        while True:
+            response = await self.next_event()
+            if response is None:
+                raise ConnectionResetError('Server closed the connection')
+            if response['op'] == OpCode.LOGIN:
+                break
+            if response['op'] in LOGIN_ERRORS:
+                raise LoginError(response)
+        self.codec, self.decoder, self.compressor, self.decompressor = (
+            accept_login(response, self.decoder))
+        self.username = response['username']
+        return response
+
+    def request(self, payload):
+        '''
+        Queues a request to be written once the event loop gets control
+        '''
+        self.pending.append(self.codec.encode(payload)[0])
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        '''
+        Writes every queued request
+        '''
+        self.flush_scheduled = False
+        if not self.pending or self.writer.is_closing():
+            self.pending = []
+            return
+        chunks, self.pending = self.pending, []
+        if self.compressor:
+            self.writer.write(self.compressor.compress(chunks))
+        else:
+            self.writer.writelines(chunks)
+
+    async def drain(self):
+        '''
+        Writes queued requests and waits until the socket's write buffer is
+        below its high water mark
+        '''
+        self.flush()
+        await self.writer.drain()
+
+    def join(self, room, history=0):
+        '''
+        Joins room, the server answers with the last history messages sent
+        to it
+        '''
+        payload = {'op': OpCode.JOIN_ROOM, 'user': self.username, 'room': room}
+        if history:
+            payload['history'] = history
+        self.request(payload)
+
+    def leave(self, room):
+        self.request({'op': OpCode.LEAVE_ROOM, 'user': self.username, 'room': room})
+
+    def send(self, room, message):
+        '''
+        Sends message to room
+        '''
+        self.request({'op': OpCode.MESSAGE, 'user': self.username,
+            'room': room, 'message': message})
+
+    def whisper(self, target, message):
+        '''
+        Sends message to the user target only
+        '''
+        self.request({'op': OpCode.WHISPER, 'sender': self.username,
+            'target': target, 'message': message})
+
+    def list_rooms(self):
+        self.request({'op': OpCode.LIST_ROOMS})
+
+    def list_users(self, room='', prefix='', cursor=None):
+        '''
+        Lists users, the answer may come as several LIST_USERS events, see
+        users.py
+        '''
+        payload = {'op': OpCode.LIST_USERS, 'room': room}
+        if prefix:
+            payload['prefix'] = prefix
+        if cursor is not None:
+            payload['cursor'] = cursor
+        self.request(payload)
+
+    async def next_event(self):
+        '''
+        Returns the next message from the server, or None once it closes the
+        connection
+        '''
+        while True:
+            frame = self.decoder.next_frame()
+            if frame is None:
+                data = await self.reader.read(RECV_SIZE)
+                if not data:
+                    return None
+                if self.decompressor:
+                    data = self.decompressor.decompress(data)
+                self.decoder.feed(data)
+                continue
+            event = self.decoder.decode(frame)
+            # answer heartbeats so the server knows we're alive
+            if event['op'] == OpCode.HEART_BEAT:
+                self.request({'op': OpCode.HEART_BEAT})
+                continue
+            return event
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await self.next_event()
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+    def close(self):
+        '''
+        Writes queued requests and closes the connection
+        '''
+        self.flush()
+        self.writer.close()
+
+    async def wait_closed(self):
+        await self.writer.wait_closed()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+        await self.wait_closed()
@@ -0,0 +1,98 @@
+#! /usr/bin/env python3
+
+'''
+Measures the CPU cost of fanning a MESSAGE out to a room, comparing encoding
+the message once per recipient (the old broadcast path) with encoding it once
+per broadcast, for each wire encoding.
+
+No sockets are involved, clients are registered with the server's room index
+and their outbound queues are drained through their encoders the way the
+writers do, so the numbers are the cost of the fanout itself.
+
+Usage: benchmarks/fanout.py [room sizes...]
+'''
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import server
+from codec import Frame, JSON, BINARY
+from opcodes import OpCode
+
+ROOM_SIZES = [10, 100, 1000, 5000]
+ROUNDS = 20
+
+MESSAGE = {
+    'op': OpCode.MESSAGE,
+    'user': 'benchmark_user',
+    'room': 'benchmark',
+    'message': 'The quick brown fox jumps over the lazy dog. ' * 3,
+}
+
+
+def per_recipient_fanout(message, room):
+    '''
+    The previous broadcast_room, encoding once for every member
+    '''
+    for client in server.rooms.members(room):
+        client.send(Frame(message))
+
+def setup_room(size, encoding):
+    '''
+    Creates size clients in the benchmark room with queues large enough to
+    hold every round
+    '''
+    server.QUEUE_SIZE = ROUNDS + 1
+    clients = []
+    for i in range(size):
+        client = server.Client(None)
+        client.username = f'user{i}'
+        client.encoder = server.codecs[encoding].new_encoder()
+        server.add_to_room(client, 'benchmark')
+        clients.append(client)
+    return clients
+
+def write_all(clients):
+    '''
+    Does what each client's writer would, short of the socket write
+    '''
+    written = 0
+    for client in clients:
+        for data in client.buffers(client.outbound.drain()):
+            written += len(data)
+    return written
+
+def teardown_room(clients):
+    for client in clients:
+        server.remove_from_all_rooms(client)
+
+def measure(fanout, size, encoding):
+    '''
+    Returns (CPU seconds, bytes written) per fanout to a room of size members
+    '''
+    clients = setup_room(size, encoding)
+    start = time.process_time()
+    written = 0
+    for _ in range(ROUNDS):
+        fanout(MESSAGE, 'benchmark')
+        written += write_all(clients)
+    elapsed = time.process_time() - start
+    teardown_room(clients)
+    return elapsed / ROUNDS, written / ROUNDS
+
+def main():
+    sizes = [int(s) for s in sys.argv[1:]] or ROOM_SIZES
+    print(f'{"encoding":>8} {"members":>8} {"per recipient":>15} {"once":>12} {"saved":>8} {"bytes":>10}')
+    for encoding in [JSON, BINARY]:
+        for size in sizes:
+            before, _ = measure(per_recipient_fanout, size, encoding)
+            after, written = measure(server.broadcast_room, size, encoding)
+            saved = 1 - after / before if before else 0
+            print(f'{encoding:>8} {size:>8} {before * 1000:>12.3f} ms {after * 1000:>9.3f} ms {saved:>7.0%} {written:>10.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+#! /usr/bin/env python3
+
+'''
+Load generator and end-to-end latency benchmark.
+
+Starts server.py on a local port (or targets a running server with
+--connect), connects synthetic clients that LOGIN and JOIN_ROOM a room picked
+from a uniform or zipf room-size distribution, then has every client send
+MESSAGE and WHISPER requests at a fixed rate for the duration of the run.
+
+Each message carries the time it was sent, so receivers measure delivery
+latency from the sender's write to their own read. Both sides share a host
+and time.monotonic, so the clocks agree. The report has delivery latency
+percentiles, messages sent and delivered per second, and the server's CPU
+use and RSS over the measured period (read from /proc, Linux only).
+
+Every client runs on this process's event loop. The generator's own CPU use is
+reported too. If it is close to 100% the generator, not the server, is the
+bottleneck.
+
+Usage: benchmarks/load.py [--clients N] [--rooms N] [--distribution uniform|zipf]
+                          [--rate MSGS/S] [--whisper-ratio F] [--duration S]
+                          [--binary] [--server-args ARGS] [--connect HOST:PORT]
+'''
+
+import argparse
+import asyncio
+import os
+import random
+import shlex
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from server import raise_fd_limit
+from codec import JsonCodec, BinaryCodec, BINARY
+from framing import RECV_SIZE
+from opcodes import OpCode
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server.py')
+
+# connections being set up at once
+CONNECT_CONCURRENCY = 200
+# seconds to wait for messages still in flight when the run ends
+DRAIN_TIME = 2.0
+PERCENTILES = [50, 90, 99, 99.9]
+
+
+class Stats:
+    '''
+    Counters shared by every synthetic client
+    '''
+
+    def __init__(self):
+        self.measuring = False
+        self.sent = 0
+        self.delivered = 0
+        self.latencies = []
+        self.errors = {}
+
+
+class LoadClient:
+    '''
+    One synthetic client connection
+    '''
+
+    def __init__(self, name, room, stats):
+        self.name = name
+        self.room = room
+        self.stats = stats
+        self.codec = JsonCodec()
+        self.decoder = self.codec.new_decoder()
+        self.joined = asyncio.Event()
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, host, port, encoding):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        login = {'op': OpCode.LOGIN, 'username': self.name}
+        if encoding:
+            login['encoding'] = encoding
+        self.send(login)
+        while True:
+            message = await self.next_message()
+            if message['op'] == OpCode.LOGIN:
+                break
+            if message['op'] != OpCode.HEART_BEAT:
+                raise ConnectionError(f'{self.name} could not log in: {message}')
+        if message.get('encoding') == BINARY:
+            self.codec = BinaryCodec()
+            self.decoder = self.codec.new_decoder(self.decoder.remaining())
+        asyncio.create_task(self.read_loop())
+        self.send({'op': OpCode.JOIN_ROOM, 'user': self.name, 'room': self.room})
+        await self.joined.wait()
+
+    async def next_message(self):
+        while (frame := self.decoder.next_frame()) is None:
+            data = await self.reader.read(RECV_SIZE)
+            if not data:
+                raise ConnectionError(f'{self.name} disconnected')
+            self.decoder.feed(data)
+        return self.decoder.decode(frame)
+
+    def send(self, message):
+        self.writer.write(self.codec.encode(message)[0])
+
+    async def read_loop(self):
+        stats = self.stats
+        try:
+            while data := await self.reader.read(RECV_SIZE):
+                now = time.monotonic()
+                self.decoder.feed(data)
+                for frame in self.decoder:
+                    message = self.decoder.decode(frame)
+                    op = message['op']
+                    if op == OpCode.MESSAGE or op == OpCode.WHISPER:
+                        if stats.measuring:
+                            sent_at = float(message['message'].split(' ', 1)[0])
+                            stats.latencies.append(now - sent_at)
+                            stats.delivered += 1
+                    elif op == OpCode.HEART_BEAT:
+                        self.send({'op': OpCode.HEART_BEAT})
+                    elif op == OpCode.JOIN_ROOM:
+                        if message['user'] == self.name:
+                            self.joined.set()
+                    elif op >= OpCode.ERR_UNKNOWN:
+                        stats.errors[op] = stats.errors.get(op, 0) + 1
+        except ConnectionError:
+            pass
+
+    async def send_loop(self, names, rate, whisper_ratio, padding, until):
+        '''
+        Sends rate messages a second until the until deadline, starting at a
+        random offset so clients don't send in lockstep
+        '''
+        interval = 1 / rate
+        await asyncio.sleep(random.random() * interval)
+        next_send = time.monotonic()
+        while next_send < until:
+            text = f'{time.monotonic():.6f} {padding}'
+            target = random.choice(names) if random.random() < whisper_ratio else None
+            if target and target != self.name:
+                self.send({'op': OpCode.WHISPER, 'sender': self.name,
+                    'target': target, 'message': text})
+            else:
+                self.send({'op': OpCode.MESSAGE, 'room': self.room, 'message': text})
+            self.stats.sent += 1
+            next_send += interval
+            await asyncio.sleep(max(next_send - time.monotonic(), 0))
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+
+
+def assign_rooms(clients, rooms, distribution, rng):
+    '''
+    Returns the room each client joins
+    '''
+    names = [f'room{i}' for i in range(rooms)]
+    if distribution == 'zipf':
+        weights = [1 / (rank + 1) for rank in range(rooms)]
+    else:
+        weights = [1] * rooms
+    return rng.choices(names, weights, k=clients)
+
+def read_proc(pid):
+    '''
+    Returns (CPU seconds, RSS bytes, peak RSS bytes) of a process, or None
+    where /proc isn't available
+    '''
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open(f'/proc/{pid}/status') as f:
+            status = dict(line.split(':', 1) for line in f)
+    except OSError:
+        return None
+    ticks = os.sysconf('SC_CLK_TCK')
+    cpu = (int(fields[11]) + int(fields[12])) / ticks
+    kb = lambda key: int(status.get(key, '0 kB').split()[0]) * 1024
+    return cpu, kb('VmRSS'), kb('VmHWM')
+
+def percentile(ordered, p):
+    if not ordered:
+        return 0
+    return ordered[min(int(len(ordered) * p / 100), len(ordered) - 1)]
+
+async def wait_for_server(host, port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection(host, port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+async def run(args):
+    host, port = args.host, args.port
+    stats = Stats()
+    rng = random.Random(args.seed)
+    rooms = assign_rooms(args.clients, args.rooms, args.distribution, rng)
+    names = [f'load{i}' for i in range(args.clients)]
+    clients = [LoadClient(name, room, stats) for (name, room) in zip(names, rooms)]
+
+    await wait_for_server(host, port)
+    started = time.monotonic()
+    limit = asyncio.Semaphore(CONNECT_CONCURRENCY)
+    async def connect(client):
+        async with limit:
+            await client.connect(host, port, BINARY if args.binary else None)
+    results = await asyncio.gather(*(connect(c) for c in clients), return_exceptions=True)
+    failed = [c for (c, r) in zip(clients, results) if isinstance(r, Exception)]
+    clients = [c for (c, r) in zip(clients, results) if not isinstance(r, Exception)]
+    names = [c.name for c in clients]
+    print(f'connected {len(clients)} clients in {time.monotonic() - started:.2f} s'
+        + (f', {len(failed)} failed' if failed else ''))
+    if not clients:
+        return
+
+    counts = {}
+    for client in clients:
+        counts[client.room] = counts.get(client.room, 0) + 1
+    sizes = sorted(counts.values())
+    print(f'{len(sizes)} rooms, members min {sizes[0]} median {sizes[len(sizes) // 2]} max {sizes[-1]}')
+
+    padding = 'x' * args.message_size
+    server_before = read_proc(args.server_pid) if args.server_pid else None
+    own_before = time.process_time()
+    stats.measuring = True
+    start = time.monotonic()
+    until = start + args.duration
+    await asyncio.gather(*(c.send_loop(names, args.rate, args.whisper_ratio, padding, until)
+        for c in clients))
+    await asyncio.sleep(DRAIN_TIME)
+    stats.measuring = False
+    elapsed = time.monotonic() - start
+    own_cpu = time.process_time() - own_before
+    server_after = read_proc(args.server_pid) if args.server_pid else None
+
+    for client in clients:
+        client.close()
+
+    latencies = sorted(stats.latencies)
+    print(f'sent {stats.sent} ({stats.sent / args.duration:.0f}/s), '
+        f'delivered {stats.delivered} ({stats.delivered / elapsed:.0f}/s)')
+    print('latency ms: ' + ' '.join(
+        f'p{p:g} {percentile(latencies, p) * 1000:.2f}' for p in PERCENTILES)
+        + f' max {(latencies[-1] if latencies else 0) * 1000:.2f}')
+    if stats.errors:
+        print('errors: ' + ' '.join(f'{op:#x}: {n}' for (op, n) in sorted(stats.errors.items())))
+    if server_before and server_after:
+        cpu = server_after[0] - server_before[0]
+        print(f'server cpu {cpu:.2f} s ({cpu / elapsed:.0%} of a core), '
+            f'rss {server_after[1] / 2**20:.1f} MiB, peak {server_after[2] / 2**20:.1f} MiB')
+    print(f'load generator cpu {own_cpu / elapsed:.0%} of a core')
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Load generator and latency benchmark')
+    parser.add_argument('--clients', type=int, default=1000,
+        help='synthetic clients (default %(default)s)')
+    parser.add_argument('--rooms', type=int, default=50,
+        help='rooms the clients are spread across (default %(default)s)')
+    parser.add_argument('--distribution', choices=['uniform', 'zipf'], default='zipf',
+        help='room size distribution (default %(default)s)')
+    parser.add_argument('--rate', type=float, default=1.0,
+        help='messages per second sent by each client (default %(default)s)')
+    parser.add_argument('--whisper-ratio', type=float, default=0.1,
+        help='fraction of messages sent as whispers (default %(default)s)')
+    parser.add_argument('--message-size', type=int, default=64,
+        help='bytes of padding per message (default %(default)s)')
+    parser.add_argument('--duration', type=float, default=10.0,
+        help='seconds to send for (default %(default)s)')
+    parser.add_argument('--binary', action='store_true',
+        help='use the binary wire encoding')
+    parser.add_argument('--seed', type=int, default=0,
+        help='seed for room assignment (default %(default)s)')
+    parser.add_argument('--port', type=int, default=8100,
+        help='port to start the server on (default %(default)s)')
+    parser.add_argument('--server-args',
+        default='--engine asyncio --client-rate 0 --room-rate 0',
+        help='extra server.py arguments (default "%(default)s")')
+    parser.add_argument('--connect', metavar='HOST:PORT',
+        help='benchmark an already running server instead of starting one')
+    parser.add_argument('--server-pid', type=int,
+        help='pid of the --connect server, to report its CPU and RSS')
+    return parser.parse_args(argv)
+
+def main():
+    args = parse_args()
+    raise_fd_limit()
+    server = None
+    if args.connect:
+        args.host, port = args.connect.rsplit(':', 1)
+        args.port = int(port)
+    else:
+        args.host = 'localhost'
+        server = subprocess.Popen(
+            [sys.executable, SERVER, str(args.port), *shlex.split(args.server_args)],
+            stdout=subprocess.DEVNULL)
+        args.server_pid = server.pid
+    try:
+        asyncio.run(run(args))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,394 @@
+#! /usr/bin/env python3
+
+'''
+Replays traffic recorded with server.py --capture against a fresh server.
+
+Every recorded connection is opened at the time it was recorded, sends its
+requests at their recorded times, and closes when it was recorded closing.
+--speed 10 runs the same schedule ten times faster, and --speed 0 sends
+every request as soon as the one before it is sent, keeping only the order
+of each connection's requests.
+
+The replay behaves like the recorded clients: it waits for a LOGIN to be
+answered before sending anything else on that connection, then switches to
+the encoding and compression the server agreed to. Recorded HEART_BEATs are
+answers to the recording server's heartbeats, so they aren't replayed. The
+replaying connections answer the new server's heartbeats instead.
+
+A request's latency is the time from sending it until its answer arrives:
+the LOGIN, LIST_ROOMS or last LIST_USERS page for those requests, the
+server echoing MESSAGE, JOIN_ROOM, LEAVE_ROOM, WHISPER or USER_EXIT back to
+the sender, or an error. The report has requests sent and events received
+per second, answer latency percentiles, how far sends fell behind schedule
+and the server's CPU use. --save writes the results as JSON, and --baseline
+compares a run with results saved from an earlier one, so two builds can be
+compared on the same traffic.
+
+Usage: benchmarks/replay.py CAPTURE... [--speed F] [--save FILE] [--baseline FILE]
+                            [--server-args ARGS] [--connect HOST:PORT]
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import shlex
+import subprocess
+import sys
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from load import read_proc, percentile, wait_for_server, PERCENTILES
+from server import raise_fd_limit
+from capture import read_capture, CONNECTED, REQUEST, DISCONNECTED
+from codec import JsonCodec
+from framing import RECV_SIZE
+from opcodes import OpCode
+from session import accept_login
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server.py')
+
+# seconds a connection waits for answers still in flight before it closes
+DRAIN_TIME = 2.0
+# seconds to wait for a LOGIN to be answered
+LOGIN_TIMEOUT = 10.0
+
+# requests whose answer is the server echoing them to the sender, and the
+# field naming the sender
+ECHOED = {
+    OpCode.JOIN_ROOM: 'user',
+    OpCode.LEAVE_ROOM: 'user',
+    OpCode.MESSAGE: 'user',
+    OpCode.USER_EXIT: 'user',
+    OpCode.WHISPER: 'sender',
+}
+
+# results compared with --baseline, and whether higher is better
+COMPARED = [
+    ('requests_per_second', True),
+    ('events_per_second', True),
+    ('latency_p50_ms', False),
+    ('latency_p90_ms', False),
+    ('latency_p99_ms', False),
+    ('latency_p99.9_ms', False),
+    ('lag_p99_ms', False),
+    ('server_cpu_per_second', False),
+]
+
+
+class Recording:
+    '''
+    One recorded connection: when it opened and closed and the requests it
+    sent, in seconds from the start of the capture
+    '''
+
+    def __init__(self, opened):
+        self.opened = opened
+        self.closed = None
+        self.requests = []
+
+
+class Stats:
+    '''
+    Counters shared by every replayed connection
+    '''
+
+    def __init__(self):
+        self.sent = 0
+        self.answered = 0
+        self.unanswered = 0
+        self.events = 0
+        self.latencies = []
+        # seconds each send happened after it was due
+        self.lag = []
+        self.errors = {}
+        self.failed = 0
+
+
+def load_recordings(paths):
+    '''
+    Reads capture files into Recordings, on one timeline. Captures from the
+    workers of one server are replayed together
+    '''
+    captures = [read_capture(path) for path in paths]
+    first = min(started for (started, _) in captures)
+    recordings = []
+    for (started, records) in captures:
+        offset = started - first
+        connections = {}
+        for (kind, connection, at, request) in records:
+            at += offset
+            if kind == CONNECTED:
+                connections[connection] = Recording(at)
+            elif connection not in connections:
+                # opened before the capture started
+                continue
+            elif kind == REQUEST:
+                connections[connection].requests.append((at, request))
+            elif kind == DISCONNECTED:
+                connections[connection].closed = at
+        recordings.extend(connections.values())
+    return sorted(recordings, key=lambda r: r.opened)
+
+def answers(event, op, username):
+    '''
+    Whether event answers a request with op sent by username
+    '''
+    if event['op'] >= OpCode.ERR_UNKNOWN:
+        return True
+    if event['op'] != op:
+        return False
+    if op in ECHOED:
+        return event.get(ECHOED[op]) == username
+    if op == OpCode.LIST_USERS:
+        return not event.get('more')
+    return True
+
+
+class ReplayClient:
+    '''
+    Replays one recorded connection
+    '''
+
+    def __init__(self, recording, stats):
+        self.recording = recording
+        self.stats = stats
+        self.username = None
+        self.codec = JsonCodec()
+        self.decoder = self.codec.new_decoder()
+        self.compressor = None
+        self.decompressor = None
+        self.writer = None
+        # (op, time sent) of requests waiting for their answers, in order
+        self.waiting = deque()
+        self.logged_in = asyncio.Event()
+        self.idle = asyncio.Event()
+
+    async def run(self, host, port, start, speed):
+        due = lambda at: start + at / speed if speed else start
+        await sleep_until(due(self.recording.opened))
+        reader, self.writer = await asyncio.open_connection(host, port)
+        reading = asyncio.create_task(self.read_loop(reader))
+        try:
+            for (at, request) in self.recording.requests:
+                if request['op'] == OpCode.HEART_BEAT:
+                    continue
+                await sleep_until(due(at))
+                if speed:
+                    self.stats.lag.append(max(time.monotonic() - due(at), 0))
+                self.send(request)
+                if request['op'] == OpCode.LOGIN:
+                    self.logged_in.clear()
+                    await asyncio.wait_for(self.logged_in.wait(), LOGIN_TIMEOUT)
+            if self.recording.closed is not None:
+                await sleep_until(due(self.recording.closed))
+            if self.waiting:
+                self.idle.clear()
+                try:
+                    await asyncio.wait_for(self.idle.wait(), DRAIN_TIME)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.stats.unanswered += len(self.waiting)
+            self.waiting.clear()
+            # close the sending side and read until the server hangs up, so
+            # closing with unread data doesn't reset the connection
+            try:
+                self.writer.write_eof()
+                await asyncio.wait_for(reading, DRAIN_TIME)
+            except (OSError, asyncio.TimeoutError):
+                pass
+            self.writer.close()
+
+    def write(self, request):
+        data = self.codec.encode(request)[0]
+        if self.compressor:
+            data = self.compressor.compress([data])
+        self.writer.write(data)
+
+    def send(self, request):
+        '''
+        Writes a request and starts timing its answer
+        '''
+        self.write(request)
+        self.stats.sent += 1
+        self.waiting.append((request['op'], time.monotonic()))
+
+    async def read_loop(self, reader):
+        try:
+            while data := await reader.read(RECV_SIZE):
+                now = time.monotonic()
+                if self.decompressor:
+                    data = self.decompressor.decompress(data)
+                self.decoder.feed(data)
+                # a LOGIN answer switches self.decoder
+                while (frame := self.decoder.next_frame()) is not None:
+                    self.received(self.decoder.decode(frame), now)
+        except ConnectionError:
+            pass
+
+    def received(self, event, now):
+        op = event['op']
+        if op == OpCode.HEART_BEAT:
+            self.write({'op': OpCode.HEART_BEAT})
+            return
+        stats = self.stats
+        stats.events += 1
+        if op >= OpCode.ERR_UNKNOWN:
+            stats.errors[op] = stats.errors.get(op, 0) + 1
+        for (i, (request, sent)) in enumerate(self.waiting):
+            if answers(event, request, self.username):
+                # earlier requests were skipped, the server won't answer them
+                for _ in range(i):
+                    self.waiting.popleft()
+                    stats.unanswered += 1
+                self.waiting.popleft()
+                stats.answered += 1
+                stats.latencies.append(now - sent)
+                if request == OpCode.LOGIN:
+                    if op == OpCode.LOGIN:
+                        self.codec, self.decoder, self.compressor, self.decompressor = (
+                            accept_login(event, self.decoder))
+                        self.username = event['username']
+                    self.logged_in.set()
+                break
+        if not self.waiting:
+            self.idle.set()
+
+
+async def sleep_until(deadline):
+    '''
+    Sleeps until deadline, or only yields to the event loop if it has passed
+    so answers are read, and timed, while a connection catches up
+    '''
+    await asyncio.sleep(max(deadline - time.monotonic(), 0))
+
+async def run(args, recordings):
+    stats = Stats()
+    await wait_for_server(args.host, args.port)
+    server_before = read_proc(args.server_pid) if args.server_pid else None
+    start = time.monotonic()
+    clients = [ReplayClient(recording, stats) for recording in recordings]
+    outcomes = await asyncio.gather(*(c.run(args.host, args.port, start, args.speed)
+        for c in clients), return_exceptions=True)
+    elapsed = time.monotonic() - start
+    server_after = read_proc(args.server_pid) if args.server_pid else None
+    stats.failed = sum(isinstance(o, Exception) for o in outcomes)
+
+    latencies = sorted(stats.latencies)
+    lag = sorted(stats.lag)
+    results = {
+        'speed': args.speed,
+        'connections': len(clients),
+        'failed_connections': stats.failed,
+        'elapsed': elapsed,
+        'sent': stats.sent,
+        'answered': stats.answered,
+        'unanswered': stats.unanswered,
+        'events': stats.events,
+        'requests_per_second': stats.sent / elapsed,
+        'events_per_second': stats.events / elapsed,
+        'lag_p99_ms': percentile(lag, 99) * 1000,
+        'errors': {f'{op:#x}': n for (op, n) in sorted(stats.errors.items())},
+    }
+    for p in PERCENTILES:
+        results[f'latency_p{p:g}_ms'] = percentile(latencies, p) * 1000
+    results['latency_max_ms'] = (latencies[-1] if latencies else 0) * 1000
+    if server_before and server_after:
+        results['server_cpu_per_second'] = (server_after[0] - server_before[0]) / elapsed
+        results['server_peak_rss_mib'] = server_after[2] / 2**20
+    return results
+
+def report(results):
+    print(f'replayed {results["connections"]} connections in {results["elapsed"]:.2f} s'
+        + (f', {results["failed_connections"]} failed' if results['failed_connections'] else ''))
+    print(f'sent {results["sent"]} ({results["requests_per_second"]:.0f}/s), '
+        f'received {results["events"]} ({results["events_per_second"]:.0f}/s), '
+        f'{results["answered"]} answered, {results["unanswered"]} unanswered')
+    print('latency ms: ' + ' '.join(
+        f'p{p:g} {results[f"latency_p{p:g}_ms"]:.2f}' for p in PERCENTILES)
+        + f' max {results["latency_max_ms"]:.2f}')
+    print(f'sends behind schedule p99 {results["lag_p99_ms"]:.2f} ms')
+    if results['errors']:
+        print('errors: ' + ' '.join(f'{op}: {n}' for (op, n) in results['errors'].items()))
+    if 'server_cpu_per_second' in results:
+        print(f'server cpu {results["server_cpu_per_second"]:.0%} of a core, '
+            f'peak rss {results["server_peak_rss_mib"]:.1f} MiB')
+
+def compare(results, baseline):
+    '''
+    Prints how results differ from a baseline run's
+    '''
+    if baseline.get('speed') != results['speed']:
+        print(f'warning: baseline was replayed at speed {baseline.get("speed")}')
+    print(f'{"":<24}{"baseline":>12}{"this run":>12}{"change":>10}')
+    for (key, higher_is_better) in COMPARED:
+        if key not in results or key not in baseline:
+            continue
+        before, after = baseline[key], results[key]
+        change = (after - before) / before if before else 0.0
+        worse = change < 0 if higher_is_better else change > 0
+        print(f'{key:<24}{before:>12.2f}{after:>12.2f}{change:>+10.1%}'
+            + (' worse' if worse and change else ''))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Replays traffic captured with server.py --capture')
+    parser.add_argument('captures', nargs='+', metavar='CAPTURE',
+        help='capture files, several for the workers of one server')
+    parser.add_argument('--speed', type=float, default=1.0,
+        help='replay speed, 0 sends as fast as possible (default %(default)s)')
+    parser.add_argument('--save', metavar='FILE',
+        help='write the results to FILE as JSON')
+    parser.add_argument('--baseline', metavar='FILE',
+        help='compare with results saved by an earlier run')
+    parser.add_argument('--port', type=int, default=8300,
+        help='port to start the server on (default %(default)s)')
+    parser.add_argument('--server-args', default='--client-rate 0 --room-rate 0',
+        help='extra server.py arguments (default "%(default)s")')
+    parser.add_argument('--connect', metavar='HOST:PORT',
+        help='replay against an already running server instead of starting one')
+    parser.add_argument('--server-pid', type=int,
+        help='pid of the --connect server, to report its CPU and RSS')
+    args = parser.parse_args(argv)
+    if args.speed < 0:
+        parser.error('--speed can\'t be negative')
+    return args
+
+def main():
+    args = parse_args()
+    raise_fd_limit()
+    recordings = load_recordings(args.captures)
+    requests = sum(len(r.requests) for r in recordings)
+    span = max((max([r.opened, r.closed or 0] + [at for (at, _) in r.requests[-1:]])
+        for r in recordings), default=0)
+    print(f'capture has {len(recordings)} connections and {requests} requests over {span:.2f} s')
+    server = None
+    if args.connect:
+        args.host, port = args.connect.rsplit(':', 1)
+        args.port = int(port)
+    else:
+        args.host = 'localhost'
+        server = subprocess.Popen(
+            [sys.executable, SERVER, str(args.port), *shlex.split(args.server_args)],
+            stdout=subprocess.DEVNULL)
+        args.server_pid = server.pid
+    try:
+        results = asyncio.run(run(args, recordings))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    report(results)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
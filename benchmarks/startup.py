@@ -0,0 +1,107 @@
+#! /usr/bin/env python3
+
+'''
+Measures how long `client.py send` takes to post one line, from starting the
+interpreter to exiting, against a server started on a local port.
+
+For comparison it also times a bare interpreter start, importing what the
+send command imports, and importing tui.py (urwid and the TUI), which the
+send command skips. The largest imports of the send command are listed from
+python -X importtime, slowest first.
+
+Usage: benchmarks/startup.py [--runs N] [--port PORT]
+'''
+
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SERVER = os.path.join(ROOT, 'server.py')
+CLIENT = os.path.join(ROOT, 'client.py')
+
+# imports listed from -X importtime
+TOP_IMPORTS = 8
+
+
+def timed(argv, stdin=b''):
+    '''
+    Runs argv to completion and returns its wall clock seconds, or None if it
+    failed
+    '''
+    start = time.perf_counter()
+    result = subprocess.run(argv, input=stdin, cwd=ROOT,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    elapsed = time.perf_counter() - start
+    return elapsed if result.returncode == 0 else None
+
+def report(name, times):
+    if None in times:
+        print(f'{name:<24} failed')
+        return
+    times = sorted(times)
+    print(f'{name:<24} min {times[0] * 1000:7.1f} ms  median {times[len(times) // 2] * 1000:7.1f} ms')
+
+def import_times(module):
+    '''
+    Returns (cumulative microseconds, name) of the imports module pulls in,
+    slowest first
+    '''
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=ROOT, capture_output=True, text=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)
+
+def wait_for_server(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('localhost', port)).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='client.py send startup benchmark')
+    parser.add_argument('--runs', type=int, default=10,
+        help='times each command is run (default %(default)s)')
+    parser.add_argument('--port', type=int, default=8200,
+        help='port to start the server on (default %(default)s)')
+    return parser.parse_args(argv)
+
+def main():
+    args = parse_args()
+    server = subprocess.Popen(
+        [sys.executable, SERVER, str(args.port), '--engine', 'asyncio', '--client-rate', '0'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_server(args.port)
+        report('interpreter', [timed([sys.executable, '-c', 'pass'])
+            for _ in range(args.runs)])
+        report('send imports', [timed([sys.executable, '-c', 'import client, session'])
+            for _ in range(args.runs)])
+        report('client.py send', [timed([sys.executable, CLIENT, 'send', '--user', f'startup{i}',
+            '--room', 'startup', str(args.port)], b'deployed\n') for i in range(args.runs)])
+        report('tui imports', [timed([sys.executable, '-c', 'import tui'])
+            for _ in range(args.runs)])
+    finally:
+        server.terminate()
+        server.wait()
+
+    print('slowest send imports (cumulative):')
+    for (micros, name) in import_times('client, session')[:TOP_IMPORTS]:
+        print(f'  {micros / 1000:7.1f} ms  {name}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+'''
+Traffic capture for replaying a server's load against another build.
+
+With --capture FILE the server records every request it decodes, which
+connection sent it and when, and when each connection opened and closed.
+benchmarks/replay.py plays a capture back against a fresh server.
+
+Requests are recorded decoded, after decompression and whatever encoding the
+connection uses, so a replay can negotiate the same encoding and compression
+with a server whose interned names or compressor state differ. Frames the
+server couldn't decode aren't recorded.
+
+A capture file starts with MAGIC and the wall clock time capture started at
+(an 8 byte float, seconds since the epoch), followed by records:
+
+    kind        1 byte, CONNECTED, REQUEST or DISCONNECTED
+    connection  4 bytes, numbered from 1 in connection order
+    time        8 bytes, microseconds since capture started
+    request     REQUEST records only, the request as a binary frame (see
+                codec.py) with every name inline
+
+Records are buffered and flushed every flush interval, a capture cut off by
+a crash reads up to its last whole record.
+'''
+
+import struct
+from itertools import count
+from threading import Thread, Lock, Event
+from time import monotonic, time
+
+from codec import BinaryDecoder, encode_binary, LENGTH
+
+MAGIC = b'IRCCAP1\n'
+# wall clock time capture started
+START = struct.Struct('!d')
+# (kind, connection, microseconds)
+RECORD = struct.Struct('!BIQ')
+
+CONNECTED = 1
+REQUEST = 2
+DISCONNECTED = 3
+
+# seconds between flushes of buffered records
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+
+class Capture:
+    '''
+    Writes a capture file, safe to call from every handler thread
+    '''
+
+    def __init__(self, path, flush_interval=DEFAULT_FLUSH_INTERVAL):
+        self.file = open(path, 'wb')
+        self.started = monotonic()
+        self.file.write(MAGIC + START.pack(time()))
+        self.lock = Lock()
+        self.ids = count(1)
+        self.flush_interval = flush_interval
+        self.closed = Event()
+        Thread(target=self.flush_loop, name='capture', daemon=True).start()
+
+    def connected(self):
+        '''
+        Records a new connection and returns its id
+        '''
+        connection = next(self.ids)
+        self.write(CONNECTED, connection)
+        return connection
+
+    def request(self, connection, message):
+        '''
+        Records a decoded request
+        '''
+        try:
+            data = encode_binary(message)
+        except (TypeError, struct.error):
+            # JSON a binary frame can't hold, e.g. integers over 64 bits
+            return
+        self.write(REQUEST, connection, data)
+
+    def disconnected(self, connection):
+        self.write(DISCONNECTED, connection)
+
+    def write(self, kind, connection, data=b''):
+        micros = int((monotonic() - self.started) * 1_000_000)
+        record = RECORD.pack(kind, connection, micros) + data
+        with self.lock:
+            if not self.closed.is_set():
+                self.file.write(record)
+
+    def flush_loop(self):
+        while not self.closed.wait(self.flush_interval):
+            with self.lock:
+                if not self.closed.is_set():
+                    self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.closed.set()
+            self.file.close()
+
+
+def read_capture(path):
+    '''
+    Returns the wall clock time a capture started and a list of its records
+    as (kind, connection, seconds since start, request or None)
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError(f'{path} is not a capture file')
+    (started,) = START.unpack_from(data, len(MAGIC))
+    decoder = BinaryDecoder()
+    records = []
+    pos = len(MAGIC) + START.size
+    while pos + RECORD.size <= len(data):
+        kind, connection, micros = RECORD.unpack_from(data, pos)
+        pos += RECORD.size
+        request = None
+        if kind == REQUEST:
+            if pos + LENGTH.size > len(data):
+                break
+            (length,) = LENGTH.unpack_from(data, pos)
+            end = pos + LENGTH.size + length
+            if end > len(data):
+                break
+            request = decoder.decode(data[pos + LENGTH.size:end])
+            pos = end
+        records.append((kind, connection, micros / 1_000_000, request))
+    return started, records
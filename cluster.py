@@ -0,0 +1,274 @@
+'''
+Multi-process server support.
+
+With --workers N the server forks N worker processes that each bind the
+listening port with SO_REUSEPORT, so the kernel spreads incoming connections
+across them. The parent process runs a BusHub on a Unix socket and each worker
+connects to it with a BusClient. Workers publish room, broadcast and whisper
+events to the hub, which relays them to every other worker with members in
+that room, and the hub owns the username table so LOGIN stays unique across
+workers.
+
+Bus messages are newline delimited JSON objects with a 'type':
+
+    subscribe, unsubscribe  room     worker gained its first / lost its last
+                                     member of a room
+    room                    room, message
+    all                     message
+    whisper                 target, room, message
+    claim                   id, name replied to with claimed: id, ok
+    release                 name
+'''
+
+import asyncio
+import json
+import os
+import signal
+import socket
+import tempfile
+from itertools import count
+from threading import Thread, Event, Lock
+
+from framing import FrameDecoder, RECV_SIZE
+
+# seconds a worker waits on the hub to answer a username claim
+CLAIM_TIMEOUT = 5.0
+# seconds the hub waits for workers to exit before closing the bus
+STOP_TIMEOUT = 10.0
+
+
+def encode_event(event):
+    return json.dumps(event).encode() + b'\n'
+
+
+class BusHub:
+    '''
+    Runs in the parent process and relays events between workers
+    '''
+
+    def __init__(self, children):
+        # worker process ids
+        self.children = children
+        self.stopped = False
+        # writer -> rooms that worker has members in
+        self.workers = {}
+        # username -> writer of the worker it was claimed by
+        self.names = {}
+
+    async def serve(self, sock):
+        '''
+        Relays events until SIGINT or SIGTERM, then stops the workers.
+        SIGUSR1 (profiling, see profiler.py) is passed on to every worker
+        '''
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+        if hasattr(signal, 'SIGUSR1'):
+            loop.add_signal_handler(signal.SIGUSR1, self.signal_workers, signal.SIGUSR1)
+        server = await asyncio.start_unix_server(self.handle_worker, sock=sock)
+        async with server:
+            await stop.wait()
+            # workers flush their logs and captures on the way out, the bus
+            # stays up until they're done so none of them sees it close first
+            self.stop_workers()
+            for _ in range(int(STOP_TIMEOUT / 0.01)):
+                if not self.workers:
+                    break
+                await asyncio.sleep(0.01)
+
+    def stop_workers(self):
+        if not self.stopped:
+            self.stopped = True
+            self.signal_workers(signal.SIGTERM)
+
+    def signal_workers(self, signum):
+        for pid in self.children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    async def handle_worker(self, reader, writer):
+        self.workers[writer] = set()
+        decoder = FrameDecoder()
+        try:
+            while data := await reader.read(RECV_SIZE):
+                decoder.feed(data)
+                for frame in decoder:
+                    self.handle_event(decoder.decode(frame), writer)
+        except ConnectionError:
+            pass
+        finally:
+            del self.workers[writer]
+            for name in [n for (n, w) in self.names.items() if w is writer]:
+                del self.names[name]
+            writer.close()
+
+    def handle_event(self, event, origin):
+        kind = event['type']
+        if kind == 'subscribe':
+            self.workers[origin].add(event['room'])
+        elif kind == 'unsubscribe':
+            self.workers[origin].discard(event['room'])
+        elif kind == 'claim':
+            ok = event['name'] not in self.names
+            if ok:
+                self.names[event['name']] = origin
+            origin.write(encode_event({'type': 'claimed', 'id': event['id'], 'ok': ok}))
+        elif kind == 'release':
+            if self.names.get(event['name']) is origin:
+                del self.names[event['name']]
+        elif kind == 'room':
+            self.relay(event, origin, lambda rooms: event['room'] in rooms)
+        else:
+            # all and whisper go to every worker, whispers are delivered by
+            # whichever worker has the target
+            self.relay(event, origin, lambda rooms: True)
+
+    def relay(self, event, origin, wanted):
+        data = encode_event(event)
+        for writer, rooms in self.workers.items():
+            if writer is not origin and wanted(rooms):
+                writer.write(data)
+
+
+class BusClient:
+    '''
+    A worker's connection to the hub. Events from other workers are handed to
+    on_event(event) through deliver, which the asyncio engine replaces with
+    loop.call_soon_threadsafe so events are handled on the event loop
+    '''
+
+    def __init__(self, path, on_event):
+        self.sock = socket.socket(socket.AF_UNIX)
+        self.sock.connect(path)
+        self.on_event = on_event
+        self.deliver = lambda fn, event: fn(event)
+        self.send_lock = Lock()
+        self.claim_ids = count()
+        # claim id -> answered(ok), called on the reader thread
+        self.claims = {}
+        self.reader = Thread(target=self.read_loop, name='bus', daemon=True)
+        self.reader.start()
+
+    def send(self, event):
+        with self.send_lock:
+            self.sock.sendall(encode_event(event))
+
+    def read_loop(self):
+        decoder = FrameDecoder()
+        while decoder.recv_into(self.sock):
+            for frame in decoder:
+                event = decoder.decode(frame)
+                if event['type'] == 'claimed':
+                    answered = self.claims.pop(event['id'], None)
+                    if answered:
+                        answered(event['ok'])
+                else:
+                    self.deliver(self.on_event, event)
+        # stop like when the parent stops the worker, so it still flushes its
+        # log on the way out
+        print('Lost connection to cluster bus')
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    def subscribe(self, room):
+        self.send({'type': 'subscribe', 'room': room})
+
+    def unsubscribe(self, room):
+        self.send({'type': 'unsubscribe', 'room': room})
+
+    def publish_room(self, room, message):
+        self.send({'type': 'room', 'room': room, 'message': message})
+
+    def publish_all(self, message):
+        self.send({'type': 'all', 'message': message})
+
+    def publish_whisper(self, target, room, message):
+        self.send({'type': 'whisper', 'target': target, 'room': room, 'message': message})
+
+    def request_claim(self, name, answered):
+        '''
+        Asks the hub for a username, answered(ok) is called on the reader
+        thread with True if no other worker has it. Returns the claim's id
+        '''
+        id = next(self.claim_ids)
+        self.claims[id] = answered
+        self.send({'type': 'claim', 'id': id, 'name': name})
+        return id
+
+    def unanswered(self, id, name):
+        # the hub may still give this worker the name after we stop waiting
+        if self.claims.pop(id, None):
+            self.release(name)
+
+    def claim(self, name):
+        '''
+        Asks the hub for a username and waits for the answer, returns True if
+        no other worker has it, False if one does and None if the hub didn't
+        answer in time
+        '''
+        done = Event()
+        result = []
+        def answered(ok):
+            result.append(ok)
+            done.set()
+        id = self.request_claim(name, answered)
+        if not done.wait(CLAIM_TIMEOUT):
+            self.unanswered(id, name)
+            return None
+        return result[0]
+
+    async def claim_async(self, name):
+        '''
+        claim for the asyncio engine, waits for the answer on the event loop
+        '''
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        def answered(ok):
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(ok))
+        id = self.request_claim(name, answered)
+        try:
+            return await asyncio.wait_for(future, CLAIM_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.unanswered(id, name)
+            return None
+
+    def release(self, name):
+        self.send({'type': 'release', 'name': name})
+
+
+def run_cluster(workers, serve_worker):
+    '''
+    Forks workers processes running serve_worker(bus_path, index), index
+    counting from 0, and relays their events until interrupted
+    '''
+    bus_dir = tempfile.mkdtemp(prefix='irc-bus-')
+    bus_path = os.path.join(bus_dir, 'bus.sock')
+    hub_socket = socket.socket(socket.AF_UNIX)
+    hub_socket.bind(bus_path)
+    hub_socket.listen()
+
+    children = []
+    for index in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            hub_socket.close()
+            try:
+                serve_worker(bus_path, index)
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os._exit(0)
+        children.append(pid)
+    print(f'Started {workers} workers: {children}')
+
+    hub = BusHub(children)
+    try:
+        asyncio.run(hub.serve(hub_socket))
+    finally:
+        hub.stop_workers()
+        for pid in children:
+            os.waitpid(pid, 0)
+        os.unlink(bus_path)
+        os.rmdir(bus_dir)
@@ -0,0 +1,375 @@
+'''
+Wire encodings. JSON (see framing.py) is the default, a client may ask for the
+compact binary encoding by sending 'encoding': 'binary' in its LOGIN request.
+The LOGIN response is still sent in the old encoding, everything after it in
+the new one.
+
+Binary frames are a 4 byte big endian body length followed by the body:
+
+    op      1 byte opcode
+    fields  repeated until the end of the body:
+            key     1 byte index into KEYS, or 0xFF followed by a string
+            value   1 byte type tag followed by the value
+
+Values are tagged with one of the T_ constants. Strings are a 4 byte length
+and UTF-8 bytes, lists and dicts a 4 byte item count followed by the items.
+
+Room and user names are interned: the server gives each name an id once and
+sends an INTERN frame defining it the first time a connection sees the id,
+after that the name travels as a 4 byte reference.
+'''
+
+import struct
+from threading import Lock
+
+from framing import (FrameDecoder, FrameTooLarge, DecodeError, ReceiveBuffer, encode_frame,
+    MAX_FRAME_SIZE)
+from opcodes import OpCode
+
+JSON = 'json'
+BINARY = 'binary'
+
+# field names with a fixed one byte key, append only
+KEYS = [
+    'user', 'username', 'room', 'message', 'rooms', 'users', 'new', 'sender',
+    'target', 'encoding', 'id', 'name', 'limit', 'counts', 'prefix', 'cursor',
+    'more',
+]
+KEY_IDS = {key: i for (i, key) in enumerate(KEYS)}
+KEY_INLINE = 0xFF
+
+# fields holding room or user names, lists are interned item by item
+INTERN_KEYS = {'user', 'username', 'room', 'sender', 'target', 'rooms', 'users'}
+
+# value type tags
+T_NONE = 0
+T_FALSE = 1
+T_TRUE = 2
+T_INT = 3
+T_FLOAT = 4
+T_STR = 5
+T_REF = 6
+T_LIST = 7
+T_DICT = 8
+
+LENGTH = struct.Struct('!I')
+BYTE = struct.Struct('!B')
+INT = struct.Struct('!q')
+FLOAT = struct.Struct('!d')
+
+# most names interned by the server, after that names are sent inline
+MAX_INTERNED = 65536
+
+
+class Frame:
+    '''
+    A message to be sent to one or more clients. It is encoded at most once per
+    codec no matter how many clients it goes to. after, if given, is called by
+    the client's writer once the frame is written (used to switch encodings)
+    '''
+
+    __slots__ = ('message', 'encoded', 'after')
+
+    def __init__(self, message, after=None):
+        self.message = message
+        self.encoded = {}
+        self.after = after
+
+    def encode(self, codec):
+        '''
+        Returns (data, refs) for codec, encoding on first use
+        '''
+        encoded = self.encoded.get(codec.name)
+        if encoded is None:
+            try:
+                encoded = codec.encode(self.message)
+            except (TypeError, ValueError, struct.error, RecursionError) as e:
+                # a message the codec can't carry (a lone surrogate in a
+                # binary frame, say) is sent to its connections as nothing,
+                # rather than stopping their writers
+                print(f'Cannot encode frame as {codec.name}: {e!r}')
+                encoded = (b'', ())
+            self.encoded[codec.name] = encoded
+        return encoded
+
+
+class Interner:
+    '''
+    Assigns ids to room and user names, shared by all binary connections on a
+    server. Ids are never reused, once MAX_INTERNED names are known new ones are
+    sent inline.
+    '''
+
+    def __init__(self, max_size=MAX_INTERNED):
+        self.max_size = max_size
+        self.ids = {}
+        self.names = []
+        self.definitions = []
+        self.lock = Lock()
+
+    def intern(self, name):
+        '''
+        Returns the id for name, or None if the table is full
+        '''
+        id = self.ids.get(name)
+        if id is not None or len(self.names) >= self.max_size:
+            return id
+        with self.lock:
+            id = self.ids.get(name)
+            if id is None:
+                id = len(self.names)
+                self.names.append(name)
+                self.definitions.append(encode_binary(
+                    {'op': OpCode.INTERN, 'id': id, 'name': name}))
+                self.ids[name] = id
+            return id
+
+    def definition(self, id):
+        '''
+        Returns the encoded INTERN frame defining id
+        '''
+        return self.definitions[id]
+
+
+class JsonCodec:
+    '''
+    Newline delimited JSON, see framing.py
+    '''
+    name = JSON
+
+    def encode(self, message):
+        return encode_frame(message), ()
+
+    def new_decoder(self, data=b''):
+        decoder = FrameDecoder()
+        decoder.feed(data)
+        return decoder
+
+    def new_encoder(self):
+        return StreamEncoder(self)
+
+
+class BinaryCodec:
+    '''
+    Length prefixed binary frames. With an interner names are sent as
+    references, without one (the client side) they are always sent inline
+    '''
+    name = BINARY
+
+    def __init__(self, interner=None):
+        self.interner = interner
+
+    def encode(self, message):
+        refs = []
+        data = encode_binary(message, self.interner, refs)
+        return data, tuple(refs)
+
+    def new_decoder(self, data=b''):
+        decoder = BinaryDecoder()
+        decoder.feed(data)
+        return decoder
+
+    def new_encoder(self):
+        return BinaryStreamEncoder(self)
+
+
+class StreamEncoder:
+    '''
+    Per-connection encoder state, turns frames into the bytes to write
+    '''
+
+    def __init__(self, codec):
+        self.codec = codec
+
+    def chunks(self, frame):
+        '''
+        Returns the list of byte strings to write for frame
+        '''
+        return [frame.encode(self.codec)[0]]
+
+
+class BinaryStreamEncoder(StreamEncoder):
+    '''
+    Tracks which interned names the connection has been told about and sends
+    definitions ahead of the first frame using them
+    '''
+
+    def __init__(self, codec):
+        super().__init__(codec)
+        self.known = set()
+
+    def chunks(self, frame):
+        data, refs = frame.encode(self.codec)
+        if not refs:
+            return [data]
+        out = []
+        for id in refs:
+            if id not in self.known:
+                self.known.add(id)
+                out.append(self.codec.interner.definition(id))
+        out.append(data)
+        return out
+
+
+def encode_binary(message, interner=None, refs=None):
+    '''
+    Encodes a message dict as a binary frame. Ids of interned names used are
+    appended to refs
+    '''
+    body = bytearray(BYTE.pack(message['op']))
+    for key, value in message.items():
+        if key == 'op':
+            continue
+        key_id = KEY_IDS.get(key)
+        if key_id is None:
+            body += BYTE.pack(KEY_INLINE)
+            encode_str(body, key)
+        else:
+            body += BYTE.pack(key_id)
+        intern = interner if key in INTERN_KEYS else None
+        encode_value(body, value, intern, refs)
+    return LENGTH.pack(len(body)) + body
+
+def encode_str(body, value):
+    data = value.encode()
+    body += LENGTH.pack(len(data))
+    body += data
+
+def encode_value(body, value, interner=None, refs=None):
+    '''
+    Appends a tagged value to body
+    '''
+    if value is None:
+        body += BYTE.pack(T_NONE)
+    elif value is True:
+        body += BYTE.pack(T_TRUE)
+    elif value is False:
+        body += BYTE.pack(T_FALSE)
+    elif isinstance(value, int):
+        body += BYTE.pack(T_INT) + INT.pack(value)
+    elif isinstance(value, float):
+        body += BYTE.pack(T_FLOAT) + FLOAT.pack(value)
+    elif isinstance(value, str):
+        id = interner.intern(value) if interner else None
+        if id is None:
+            body += BYTE.pack(T_STR)
+            encode_str(body, value)
+        else:
+            body += BYTE.pack(T_REF) + LENGTH.pack(id)
+            refs.append(id)
+    elif isinstance(value, (list, tuple)):
+        body += BYTE.pack(T_LIST) + LENGTH.pack(len(value))
+        for item in value:
+            encode_value(body, item, interner, refs)
+    elif isinstance(value, dict):
+        body += BYTE.pack(T_DICT) + LENGTH.pack(len(value))
+        for key, item in value.items():
+            encode_str(body, str(key))
+            encode_value(body, item)
+    else:
+        raise TypeError(f'Cannot encode {type(value).__name__} in a binary frame')
+
+
+class BinaryDecoder(ReceiveBuffer):
+    '''
+    Incremental decoder for binary frames, same interface as FrameDecoder.
+    INTERN frames are consumed here and never returned by next_frame
+    '''
+
+    # nothing marks where the frame after an oversized one starts
+    resyncs = False
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        super().__init__(max_frame_size)
+        # interned id -> name
+        self.names = {}
+
+    def next_frame(self):
+        '''
+        Returns the next complete frame body as a memoryview, or None if there
+        isn't one yet
+        '''
+        while self.end - self.start >= LENGTH.size:
+            (length,) = LENGTH.unpack_from(self.buffer, self.start)
+            if length > self.max_frame_size:
+                self.reset()
+                raise FrameTooLarge(f'Frame exceeds {self.max_frame_size} bytes')
+            end = self.start + LENGTH.size + length
+            if self.end < end:
+                return None
+            body = self.view[self.start + LENGTH.size:end]
+            self.start = end
+            if body and body[0] == OpCode.INTERN:
+                definition = self.decode(body)
+                self.names[definition['id']] = definition['name']
+                continue
+            return body
+        return None
+
+    def decode(self, body):
+        '''
+        Decodes a frame body returned by next_frame into a message dict
+        '''
+        try:
+            message = {'op': body[0]}
+            pos = 1
+            while pos < len(body):
+                key_id = body[pos]
+                pos += 1
+                if key_id == KEY_INLINE:
+                    key, pos = self.decode_str(body, pos)
+                else:
+                    key = KEYS[key_id]
+                message[key], pos = self.decode_value(body, pos)
+            return message
+        except (IndexError, KeyError, struct.error, UnicodeDecodeError) as e:
+            raise DecodeError(f'Malformed binary frame: {e!r}')
+
+    def decode_str(self, body, pos):
+        (length,) = LENGTH.unpack_from(body, pos)
+        pos += LENGTH.size
+        if pos + length > len(body):
+            raise DecodeError('String runs past the end of the frame')
+        return str(body[pos:pos + length], 'utf-8'), pos + length
+
+    def decode_value(self, body, pos):
+        tag = body[pos]
+        pos += 1
+        if tag == T_NONE:
+            return None, pos
+        if tag == T_TRUE:
+            return True, pos
+        if tag == T_FALSE:
+            return False, pos
+        if tag == T_INT:
+            return INT.unpack_from(body, pos)[0], pos + INT.size
+        if tag == T_FLOAT:
+            return FLOAT.unpack_from(body, pos)[0], pos + FLOAT.size
+        if tag == T_STR:
+            return self.decode_str(body, pos)
+        if tag == T_REF:
+            (id,) = LENGTH.unpack_from(body, pos)
+            return self.names[id], pos + LENGTH.size
+        if tag == T_LIST:
+            (count,) = LENGTH.unpack_from(body, pos)
+            pos += LENGTH.size
+            items = []
+            for _ in range(count):
+                item, pos = self.decode_value(body, pos)
+                items.append(item)
+            return items, pos
+        if tag == T_DICT:
+            (count,) = LENGTH.unpack_from(body, pos)
+            pos += LENGTH.size
+            items = {}
+            for _ in range(count):
+                key, pos = self.decode_str(body, pos)
+                items[key], pos = self.decode_value(body, pos)
+            return items, pos
+        raise DecodeError(f'Unknown value type {tag:#x}')
+
+
+CODECS = {
+    JSON: JsonCodec,
+    BINARY: BinaryCodec,
+}
@@ -0,0 +1,106 @@
+'''
+Optional per-connection stream compression, negotiated like the wire
+encoding: a client adds 'compression': 'zlib' to its LOGIN request and, if
+the server agrees, the LOGIN response says so. Everything after the response
+is compressed in both directions, whatever the encoding.
+
+Each direction of a connection is a single zlib stream, so the window is
+shared across frames and the repeated keys, opcodes and names in consecutive
+frames compress against each other. Every write ends with a sync flush so the
+receiver can decode everything written so far without waiting for more.
+'''
+
+import zlib
+from time import process_time
+
+from codec import DecodeError
+from framing import FrameTooLarge, MAX_FRAME_SIZE
+
+ZLIB = 'zlib'
+COMPRESSIONS = [ZLIB]
+
+# zlib level, 1 is fastest, 9 smallest
+DEFAULT_LEVEL = 6
+
+# most bytes a single read may decompress to, guards against zlib bombs
+MAX_EXPANSION = 4 * MAX_FRAME_SIZE
+
+
+class CompressionStats:
+    '''
+    Uncompressed and compressed byte counts and the CPU seconds spent getting
+    from one to the other
+    '''
+
+    def __init__(self):
+        self.raw = 0
+        self.compressed = 0
+        self.seconds = 0.0
+
+    def add(self, raw, compressed, seconds):
+        self.raw += raw
+        self.compressed += compressed
+        self.seconds += seconds
+
+    def ratio(self):
+        '''
+        Returns compressed / raw bytes
+        '''
+        return self.compressed / self.raw if self.raw else 1.0
+
+
+class StreamCompressor(CompressionStats):
+    '''
+    Compresses one direction of a connection. Its stats are also added to
+    totals, if given
+    '''
+
+    def __init__(self, level=DEFAULT_LEVEL, totals=None):
+        super().__init__()
+        self.zlib = zlib.compressobj(level)
+        self.totals = totals
+
+    def compress(self, chunks):
+        '''
+        Returns chunks compressed and flushed as a single byte string
+        '''
+        start = process_time()
+        out = [self.zlib.compress(data) for data in chunks]
+        out.append(self.zlib.flush(zlib.Z_SYNC_FLUSH))
+        data = b''.join(out)
+        stats = (sum(map(len, chunks)), len(data), process_time() - start)
+        self.add(*stats)
+        if self.totals is not None:
+            self.totals.add(*stats)
+        return data
+
+
+class StreamDecompressor(CompressionStats):
+    '''
+    Decompresses one direction of a connection. Its stats are also added to
+    totals, if given
+    '''
+
+    def __init__(self, max_expansion=MAX_EXPANSION, totals=None):
+        super().__init__()
+        self.zlib = zlib.decompressobj()
+        self.max_expansion = max_expansion
+        self.totals = totals
+
+    def decompress(self, data):
+        '''
+        Returns the bytes data decompresses to. Raises DecodeError if data
+        isn't part of a valid stream and FrameTooLarge if it expands too far
+        '''
+        start = process_time()
+        try:
+            out = self.zlib.decompress(data, self.max_expansion)
+        except zlib.error as e:
+            raise DecodeError(f'Bad compressed stream: {e}')
+        if self.zlib.unconsumed_tail:
+            raise FrameTooLarge(f'Read decompresses to over {self.max_expansion} bytes')
+        stats = (len(out), len(data), process_time() - start)
+        self.add(*stats)
+        if self.totals is not None:
+            self.totals.add(*stats)
+        return out
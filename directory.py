@@ -0,0 +1,101 @@
+'''
+Room directory answering LIST_ROOMS.
+
+The server tells the directory whenever a room gains or loses a member, and it
+keeps member counts for public rooms and a per-user index of the private rooms
+each user can see. Private rooms are the ones with a '.' in their name
+(whisper rooms are named sender.target). They are only listed to the users
+named in them, and since usernames can't contain '.' the name alone says who
+those are.
+
+The public part of the listing is the same for everyone, so it's kept as one
+Frame, encoded at most once per codec and rebuilt only after a change. Users
+who can see private rooms get their own listing, built from the cached public
+part and their entry in the private index.
+'''
+
+from threading import Lock
+
+from codec import Frame
+from opcodes import OpCode
+
+
+def is_private(room):
+    return '.' in room
+
+def participants(room):
+    '''
+    Returns the users a private room is listed to
+    '''
+    return set(room.split('.'))
+
+
+class RoomDirectory:
+    '''
+    Member counts for every room with local members
+    '''
+
+    def __init__(self):
+        # public room -> member count, in creation order
+        self.public = {}
+        # username -> {private room -> member count}
+        self.private = {}
+        # LIST_ROOMS Frame for public rooms, None once out of date
+        self.listing = None
+        self.lock = Lock()
+
+    def joined(self, room):
+        '''
+        Counts a new member of room
+        '''
+        with self.lock:
+            if is_private(room):
+                for user in participants(room):
+                    rooms = self.private.setdefault(user, {})
+                    rooms[room] = rooms.get(room, 0) + 1
+            else:
+                self.public[room] = self.public.get(room, 0) + 1
+                self.listing = None
+
+    def left(self, room):
+        '''
+        Counts a member leaving room, rooms are dropped when their last member
+        leaves
+        '''
+        with self.lock:
+            if is_private(room):
+                for user in participants(room):
+                    rooms = self.private.get(user)
+                    if rooms is None or room not in rooms:
+                        continue
+                    rooms[room] -= 1
+                    if not rooms[room]:
+                        del rooms[room]
+                        if not rooms:
+                            del self.private[user]
+            elif room in self.public:
+                self.public[room] -= 1
+                if not self.public[room]:
+                    del self.public[room]
+                self.listing = None
+
+    def list_rooms(self, username):
+        '''
+        Returns the LIST_ROOMS Frame for username
+        '''
+        with self.lock:
+            if self.listing is None:
+                self.listing = Frame({
+                    'op': OpCode.LIST_ROOMS,
+                    'rooms': list(self.public),
+                    'counts': list(self.public.values()),
+                })
+            private = self.private.get(username)
+            if not private:
+                return self.listing
+            message = self.listing.message
+            return Frame({
+                'op': OpCode.LIST_ROOMS,
+                'rooms': message['rooms'] + list(private),
+                'counts': message['counts'] + list(private.values()),
+            })
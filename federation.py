@@ -0,0 +1,390 @@
+'''
+Server to server federation.
+
+With --link-port a server listens for links from other servers, and with
+--peer HOST:PORT it dials them, so separate server.py processes, on one host
+or several, serve a single chat. Every pair of servers needs a link, but only
+one of the two has to list the other as a peer. Dialed links are redialed
+when they drop, so servers can be started in any order.
+
+A FederationLink has the same interface as cluster.BusClient and the server
+uses it as its bus, only there is no hub. Each server tells its peers which
+rooms it has members in, and sends a room's events only to peers with
+members there. Events for everyone (USER_EXIT) go to every peer, whispers
+only to the peer the target is logged in to.
+
+Usernames stay unique across servers. A server claiming a name asks every
+peer, and gets it only if none of them holds or is claiming it. When two
+servers claim the same name at once the one with the lower node id wins.
+Servers remember which peer holds each name, which is also how whispers find
+their target, until the peer releases it or its link drops. A peer that
+doesn't answer a claim in time has its link dropped, and the claim fails
+with a timeout rather than as taken.
+
+Events for a peer are queued and written by the link's own writer thread,
+so a peer that stops reading never blocks this server. A link whose queue
+fills up is dropped, the peers resync when it's redialed.
+
+Links carry the cluster bus's newline delimited JSON events, plus:
+
+    hello   node        first event on every link, node is a random id
+    held    names       names the sender holds, sent after hello
+    claim   id, name    answered with claimed: id, ok
+'''
+
+import asyncio
+import socket
+import uuid
+from itertools import count
+from threading import Thread, Event, Lock
+from time import sleep
+
+from cluster import encode_event, CLAIM_TIMEOUT
+from framing import FrameDecoder
+from outbound import OutboundQueue, DISCONNECT, send_vectored
+
+# seconds between attempts to dial a peer that isn't linked
+RECONNECT_DELAY = 1.0
+# events queued for a peer before its link is dropped
+LINK_QUEUE_SIZE = 65536
+
+
+def parse_address(text):
+    '''
+    Parses HOST:PORT
+    '''
+    host, port = text.rsplit(':', 1)
+    return host, int(port)
+
+
+class Peer:
+    '''
+    One link to another server
+    '''
+
+    def __init__(self, sock, dialed):
+        self.sock = sock
+        # whether this server dialed the link, decides which of two links
+        # between the same servers is kept
+        self.dialed = dialed
+        # the peer's node id, None until its hello
+        self.node = None
+        # rooms the peer has members in
+        self.rooms = set()
+        # encoded events waiting for the writer
+        self.outbound = OutboundQueue(LINK_QUEUE_SIZE, DISCONNECT)
+        Thread(target=self.write_loop, name='link-writer', daemon=True).start()
+
+    def send(self, data):
+        '''
+        Queues encoded events without blocking. A full queue closes the link
+        and its reader cleans up
+        '''
+        if not self.outbound.put(data):
+            print(f'Dropping peer {self.node}, it stopped reading')
+            self.close()
+
+    def write_loop(self):
+        while (events := self.outbound.get()) is not None:
+            try:
+                send_vectored(self.sock, events)
+            except OSError:
+                self.close()
+                return
+
+    def close(self):
+        self.outbound.close()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class Claim:
+    '''
+    A username claim waiting on the peers' answers, done() is called once,
+    when every peer agreed or one refused
+    '''
+
+    def __init__(self, nodes, done):
+        # peers that haven't answered
+        self.waiting = set(nodes)
+        self.ok = True
+        self.done = done
+        self.finished = False
+        if not self.waiting:
+            self.finish()
+
+    def answer(self, node, ok):
+        self.waiting.discard(node)
+        if not ok:
+            self.ok = False
+        if not ok or not self.waiting:
+            self.finish()
+
+    def finish(self):
+        if not self.finished:
+            self.finished = True
+            self.done()
+
+
+class FederationLink:
+    '''
+    This server's links to its peers. Events from peers are handed to
+    on_event(event) through deliver, like BusClient's
+    '''
+
+    def __init__(self, on_event, address=None, peers=()):
+        self.node = uuid.uuid4().hex
+        self.on_event = on_event
+        self.deliver = lambda fn, event: fn(event)
+        self.lock = Lock()
+        # node id -> Peer, for linked peers that have said hello
+        self.peers = {}
+        # rooms with local members
+        self.rooms = set()
+        # names held by this server, and names it is claiming
+        self.held = set()
+        self.claiming = set()
+        # name -> node id of the peer holding it
+        self.names = {}
+        self.claim_ids = count()
+        # claim id -> Claim
+        self.claims = {}
+        # dialed address -> node id of the peer there, once known
+        self.dialed = {}
+        if address:
+            listener = socket.create_server(address)
+            Thread(target=self.accept_loop, args=(listener,), name='link-listener',
+                daemon=True).start()
+        for peer in peers:
+            Thread(target=self.dial_loop, args=(peer,), name=f'link-{peer[0]}:{peer[1]}',
+                daemon=True).start()
+
+    def accept_loop(self, listener):
+        while True:
+            sock, _ = listener.accept()
+            Thread(target=self.run_link, args=(sock, False), name='link', daemon=True).start()
+
+    def dial_loop(self, address):
+        '''
+        Keeps a link to the peer at address, unless the peer keeps one it
+        dialed itself
+        '''
+        while True:
+            if self.dialed.get(address) not in self.peers:
+                try:
+                    sock = socket.create_connection(address)
+                except OSError:
+                    pass
+                else:
+                    node = self.run_link(sock, True)
+                    if node == self.node:
+                        # dialed ourselves
+                        return
+                    if node:
+                        self.dialed[address] = node
+            sleep(RECONNECT_DELAY)
+
+    def run_link(self, sock, dialed):
+        '''
+        Reads a link's events until it closes, returns the peer's node id
+        '''
+        sock.settimeout(None)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        peer = Peer(sock, dialed)
+        peer.send(encode_event({'type': 'hello', 'node': self.node}))
+        decoder = FrameDecoder()
+        try:
+            while decoder.recv_into(sock):
+                for frame in decoder:
+                    self.handle_event(decoder.decode(frame), peer)
+        except OSError:
+            pass
+        finally:
+            self.unlink(peer)
+            sock.close()
+        return peer.node
+
+    def link(self, peer, node):
+        '''
+        Adds a peer that said hello and tells it what this server has. Of two
+        links between the same servers the one dialed by the lower node id is
+        kept
+        '''
+        peer.node = node
+        with self.lock:
+            if node == self.node:
+                peer.close()
+                return
+            existing = self.peers.get(node)
+            if existing:
+                keep_dialed = self.node < node
+                if peer.dialed != keep_dialed:
+                    peer.close()
+                    return
+                existing.close()
+            self.peers[node] = peer
+            state = [{'type': 'subscribe', 'room': room} for room in self.rooms]
+            state.append({'type': 'held', 'names': sorted(self.held | self.claiming)})
+            peer.send(b''.join(map(encode_event, state)))
+        if not existing:
+            print(f'Linked to peer {node}')
+
+    def unlink(self, peer):
+        '''
+        Forgets a peer whose link closed, with the names it held
+        '''
+        with self.lock:
+            if peer.node is None or self.peers.get(peer.node) is not peer:
+                return
+            del self.peers[peer.node]
+            for name in [n for (n, node) in self.names.items() if node == peer.node]:
+                del self.names[name]
+            for claim in self.claims.values():
+                claim.answer(peer.node, True)
+        print(f'Lost link to peer {peer.node}')
+
+    def handle_event(self, event, peer):
+        kind = event['type']
+        if kind == 'hello':
+            self.link(peer, event['node'])
+            return
+        if peer.node is None:
+            return
+        if kind == 'subscribe':
+            peer.rooms.add(event['room'])
+        elif kind == 'unsubscribe':
+            peer.rooms.discard(event['room'])
+        elif kind == 'held':
+            with self.lock:
+                for name in event['names']:
+                    self.names[name] = peer.node
+        elif kind == 'claim':
+            name = event['name']
+            with self.lock:
+                holder = self.names.get(name, peer.node)
+                ok = (name not in self.held and holder == peer.node
+                    and not (name in self.claiming and self.node < peer.node))
+                if ok:
+                    self.names[name] = peer.node
+            peer.send(encode_event({'type': 'claimed', 'id': event['id'], 'ok': ok}))
+        elif kind == 'claimed':
+            with self.lock:
+                claim = self.claims.get(event['id'])
+                if claim:
+                    claim.answer(peer.node, event['ok'])
+        elif kind == 'release':
+            with self.lock:
+                if self.names.get(event['name']) == peer.node:
+                    del self.names[event['name']]
+        else:
+            self.deliver(self.on_event, event)
+
+    def send_to(self, peers, event):
+        data = encode_event(event)
+        for peer in peers:
+            peer.send(data)
+
+    def subscribe(self, room):
+        # under the lock so a peer linking now gets the room exactly once,
+        # sending only queues
+        with self.lock:
+            self.rooms.add(room)
+            self.send_to(self.peers.values(), {'type': 'subscribe', 'room': room})
+
+    def unsubscribe(self, room):
+        with self.lock:
+            self.rooms.discard(room)
+            self.send_to(self.peers.values(), {'type': 'unsubscribe', 'room': room})
+
+    def publish_room(self, room, message):
+        peers = [p for p in list(self.peers.values()) if room in p.rooms]
+        if peers:
+            self.send_to(peers, {'type': 'room', 'room': room, 'message': message})
+
+    def publish_all(self, message):
+        self.send_to(list(self.peers.values()), {'type': 'all', 'message': message})
+
+    def publish_whisper(self, target, room, message):
+        peer = self.peers.get(self.names.get(target))
+        if peer:
+            self.send_to([peer], {'type': 'whisper', 'target': target,
+                'room': room, 'message': message})
+
+    def start_claim(self, name, done):
+        '''
+        Asks every peer for a username, done() is called on whichever thread
+        completes the claim. Returns the claim's id, or None if the name is
+        already known to be taken
+        '''
+        with self.lock:
+            if name in self.names or name in self.held or name in self.claiming:
+                return None
+            peers = list(self.peers.values())
+            id = next(self.claim_ids)
+            self.claims[id] = Claim((p.node for p in peers), done)
+            self.claiming.add(name)
+        self.send_to(peers, {'type': 'claim', 'id': id, 'name': name})
+        return id
+
+    def finish_claim(self, id, name):
+        '''
+        Ends a claim, returns True if every peer agreed, False if one refused
+        and None if some didn't answer. Those peers' links are dropped
+        '''
+        with self.lock:
+            claim = self.claims.pop(id)
+            self.claiming.discard(name)
+            ok = claim.ok and not claim.waiting
+            if ok:
+                self.held.add(name)
+            peers = list(self.peers.values())
+            silent = [self.peers[n] for n in claim.waiting if n in self.peers]
+        if not ok:
+            # peers that agreed have the name down as ours
+            self.send_to(peers, {'type': 'release', 'name': name})
+        if not claim.ok:
+            return False
+        for peer in silent:
+            print(f"Dropping peer {peer.node}, it didn't answer a claim")
+            peer.close()
+        return None if claim.waiting else ok
+
+    def claim(self, name):
+        '''
+        Asks every peer for a username and waits for the answers, returns True
+        if none of them has it, False if one does and None if some didn't
+        answer in time
+        '''
+        done = Event()
+        id = self.start_claim(name, done.set)
+        if id is None:
+            return False
+        done.wait(CLAIM_TIMEOUT)
+        return self.finish_claim(id, name)
+
+    async def claim_async(self, name):
+        '''
+        claim for the asyncio engine, waits for the answers on the event loop
+        '''
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        def done():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+        id = self.start_claim(name, done)
+        if id is None:
+            return False
+        try:
+            await asyncio.wait_for(future, CLAIM_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+        return self.finish_claim(id, name)
+
+    def release(self, name):
+        with self.lock:
+            if name not in self.held:
+                return
+            self.held.discard(name)
+            peers = list(self.peers.values())
+        self.send_to(peers, {'type': 'release', 'name': name})
@@ -0,0 +1,189 @@
+'''
+Wire framing shared by the server and client.
+
+Every message is a JSON object followed by a newline. json.dumps never emits a
+raw newline, so the delimiter can't appear inside a frame and a receiver can
+split a stream into messages no matter how TCP groups the bytes.
+'''
+
+import json
+
+# bytes requested per recv call; many frames can arrive in one read
+RECV_SIZE = 64 * 1024
+
+# largest frame accepted before the connection is considered malformed
+MAX_FRAME_SIZE = 1024 * 1024
+
+# smallest read into a receive buffer, and its size to begin with
+MIN_READ = 4096
+
+# integers a frame may hold, the binary encoding's are 8 bytes (see codec.py)
+INT_MIN = -2 ** 63
+INT_MAX = 2 ** 63 - 1
+
+DELIMITER = b'\n'
+# bytes a frame may be padded with, see FrameDecoder.next_frame
+WHITESPACE = b' \t\n\r\x0b\x0c'
+
+
+class FrameTooLarge(ValueError):
+    '''
+    Raised when a peer sends more than MAX_FRAME_SIZE bytes without a delimiter
+    '''
+
+
+class DecodeError(ValueError):
+    '''
+    Raised when a frame can't be decoded
+    '''
+
+
+def encode_frame(payload):
+    '''
+    Encodes a message dict as a single newline terminated frame
+    '''
+    return json.dumps(payload).encode() + DELIMITER
+
+def decode_frame(frame):
+    '''
+    Decodes a single frame (without its delimiter) into a message dict. The
+    frame may be a memoryview, decoding it to str is its only copy. Integers
+    a binary frame couldn't carry are refused here, not when the message is
+    relayed to binary connections
+    '''
+    try:
+        text = str(frame, 'utf-8')
+    except UnicodeDecodeError as e:
+        raise DecodeError(f'Malformed JSON frame: {e!r}')
+    return json.loads(text, parse_int=parse_int)
+
+def parse_int(text):
+    # checking the length first also avoids int()'s limit on digits
+    value = int(text) if len(text) <= 20 else None
+    if value is None or not INT_MIN <= value <= INT_MAX:
+        raise DecodeError(f'Integer out of range: {text[:32]}')
+    return value
+
+
+class ReceiveBuffer:
+    '''
+    A connection's received bytes, kept in one bytearray that is reused for
+    the life of the connection. recv_into reads from a socket straight into
+    it, feed copies in data that arrived some other way (asyncio, or after
+    decompression). Subclasses hand frames out as memoryview slices of the
+    buffer, so a frame's bytes are only copied when it is decoded. A frame is
+    valid until the next feed, recv_into or reset
+    '''
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        # allocated by the first read, grown when a frame doesn't fit
+        self.buffer = bytearray()
+        self.view = memoryview(self.buffer)
+        # unread bytes are buffer[start:end]
+        self.start = 0
+        self.end = 0
+        # bytes recv_into makes room for, see recv_into
+        self.read_size = MIN_READ
+
+    def reserve(self, size):
+        '''
+        Makes room for size bytes after the unread ones, by moving them to the
+        front of the buffer or if that isn't enough into a bigger one
+        '''
+        if self.start == self.end:
+            self.start = self.end = 0
+        if len(self.buffer) - self.end >= size:
+            return
+        unread = self.view[self.start:self.end]
+        if len(unread) + size <= len(self.buffer):
+            if len(unread) > self.start:
+                # the move overlaps itself
+                unread = bytes(unread)
+            self.buffer[:len(unread)] = unread
+        else:
+            # a new buffer, frames handed out keep the old one alive
+            self.buffer = bytearray(max(len(unread) + size, 2 * len(self.buffer)))
+            self.buffer[:len(unread)] = unread
+            self.view = memoryview(self.buffer)
+        self.start, self.end = 0, len(unread)
+
+    def feed(self, data):
+        '''
+        Appends received bytes to the buffer
+        '''
+        self.reserve(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def recv_into(self, sock, size=RECV_SIZE):
+        '''
+        Reads from sock into the buffer. Returns the number of bytes read, 0
+        once the peer closed. Reads start at MIN_READ bytes and double each
+        time one fills the space it was given, up to size, so quiet
+        connections keep small buffers
+        '''
+        self.reserve(max(self.read_size - (self.end - self.start), MIN_READ))
+        free = len(self.buffer) - self.end
+        received = sock.recv_into(self.view[self.end:])
+        self.end += received
+        if received == free and self.read_size < size:
+            self.read_size = min(self.read_size * 2, size)
+        return received
+
+    def remaining(self):
+        '''
+        Returns buffered bytes that haven't been returned as a frame yet
+        '''
+        return bytes(self.view[self.start:self.end])
+
+    def reset(self):
+        '''
+        Discards everything buffered, and the buffer too if an oversized frame
+        grew it
+        '''
+        self.start = self.end = 0
+        if len(self.buffer) > RECV_SIZE:
+            self.buffer = bytearray()
+            self.view = memoryview(self.buffer)
+
+    def __iter__(self):
+        while (frame := self.next_frame()) is not None:
+            yield frame
+
+
+class FrameDecoder(ReceiveBuffer):
+    '''
+    Incremental per-connection frame decoder. Received data is fed in as it
+    arrives (or read in with recv_into) and complete frames are pulled out
+    with next_frame (or by iterating), any trailing partial frame is kept
+    until the rest arrives.
+    '''
+
+    # an oversized frame is skipped up to the next delimiter
+    resyncs = True
+
+    def next_frame(self):
+        '''
+        Returns the next complete frame as a memoryview, or None if there isn't
+        one yet
+        '''
+        while True:
+            end = self.buffer.find(DELIMITER, self.start, self.end)
+            if end == -1:
+                if self.end - self.start > self.max_frame_size:
+                    self.reset()
+                    raise FrameTooLarge(f'Frame exceeds {self.max_frame_size} bytes')
+                return None
+            start = self.start
+            self.start = end + 1
+            # tolerate blank lines between frames
+            if end > start and not (self.buffer[start] in WHITESPACE
+                    and self.buffer[start:end].isspace()):
+                return self.view[start:end]
+
+    def decode(self, frame):
+        '''
+        Decodes a frame returned by next_frame
+        '''
+        return decode_frame(frame)
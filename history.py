@@ -0,0 +1,78 @@
+'''
+Recent message history per room, replayed to clients that ask for it when
+joining.
+
+Each room keeps a ring buffer of the Frames that were broadcast to it, the
+same objects handed to the members' outbound queues, so a replay re-sends
+already encoded bytes. Buffers are bounded by message count and encoded size,
+and only the most recently active rooms keep any history at all.
+'''
+
+from collections import OrderedDict, deque
+from threading import Lock
+
+from codec import JsonCodec
+
+# messages kept per room, 0 disables history
+DEFAULT_MESSAGES = 100
+# encoded bytes kept per room
+DEFAULT_BYTES = 256 * 1024
+# rooms with history, the least recently active room is dropped first
+DEFAULT_ROOMS = 1024
+
+
+class RoomHistory:
+    '''
+    Bounded per-room ring buffers of Frames
+    '''
+
+    def __init__(self, max_messages=DEFAULT_MESSAGES, max_bytes=DEFAULT_BYTES,
+            max_rooms=DEFAULT_ROOMS):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_rooms = max_rooms
+        # sizes are measured in the default encoding
+        self.codec = JsonCodec()
+        # room -> deque of (frame, size), most recently active room last
+        self.rooms = OrderedDict()
+        # room -> total size of its frames
+        self.sizes = {}
+        self.lock = Lock()
+
+    def append(self, room, frame):
+        '''
+        Records a frame broadcast to room
+        '''
+        if not self.max_messages:
+            return
+        size = len(frame.encode(self.codec)[0])
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            frames = self.rooms.get(room)
+            if frames is None:
+                frames = self.rooms[room] = deque()
+                self.sizes[room] = 0
+                if len(self.rooms) > self.max_rooms:
+                    oldest, _ = self.rooms.popitem(last=False)
+                    del self.sizes[oldest]
+            else:
+                self.rooms.move_to_end(room)
+            frames.append((frame, size))
+            self.sizes[room] += size
+            while len(frames) > self.max_messages or self.sizes[room] > self.max_bytes:
+                _, dropped = frames.popleft()
+                self.sizes[room] -= dropped
+
+    def recent(self, room, count):
+        '''
+        Returns up to count of the most recent frames in room, oldest first
+        '''
+        if count <= 0:
+            return []
+        with self.lock:
+            frames = self.rooms.get(room)
+            if not frames:
+                return []
+            start = max(len(frames) - count, 0)
+            return [frame for (frame, _) in list(frames)[start:]]
@@ -0,0 +1,152 @@
+'''
+Idle connection heartbeats and timeouts.
+
+Each connection records when it last sent anything (last_seen). A connection
+that has been quiet for the heartbeat interval is sent a HEART_BEAT, which
+clients answer, and one that stays quiet for the timeout is evicted.
+
+Checks are kept on a hashed timer wheel keyed by each connection's own
+deadline, so a tick only looks at connections that are due and the work is
+spread across the interval instead of touching every connection at once.
+'''
+
+from threading import Lock
+from time import monotonic
+
+# seconds between wheel ticks
+DEFAULT_TICK = 0.1
+
+
+class TimerWheel:
+    '''
+    Hashed timer wheel. Items are put in the slot for their deadline's tick,
+    expire returns every item whose deadline has passed. Deadlines further out
+    than one rotation stay in their slot until the rotation they're due in.
+    '''
+
+    def __init__(self, tick, slots, now):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        # last tick number processed
+        self.current = int(now / tick)
+
+    def schedule(self, item, deadline):
+        '''
+        Schedules item, deadlines already passed fire on the next tick
+        '''
+        # the first tick starting after the deadline, so it's due when visited
+        n = max(int(deadline / self.tick) + 1, self.current + 1)
+        self.slots[n % len(self.slots)].append((deadline, item))
+
+    def expire(self, now):
+        '''
+        Advances the wheel to now and returns due (deadline, item) pairs
+        '''
+        target = int(now / self.tick)
+        # a long stall only needs one full rotation to visit every slot
+        self.current = max(self.current, target - len(self.slots))
+        due = []
+        while self.current < target:
+            self.current += 1
+            index = self.current % len(self.slots)
+            slot = self.slots[index]
+            if not slot:
+                continue
+            later = []
+            for entry in slot:
+                if entry[0] <= now:
+                    due.append(entry)
+                else:
+                    later.append(entry)
+            self.slots[index] = later
+        return due
+
+
+class LivenessMonitor:
+    '''
+    Heartbeats idle connections and evicts unresponsive ones. Connections need
+    a last_seen attribute (a time.monotonic timestamp) that the owner updates
+    whenever data arrives; touching it never reschedules anything, the
+    connection is simply rechecked when its current deadline comes up.
+
+    on_idle(connection) is called when a heartbeat should be sent and
+    on_timeout(connection) when it should be evicted, both outside the lock.
+    '''
+
+    def __init__(self, interval, timeout, on_idle, on_timeout, tick=DEFAULT_TICK):
+        if timeout <= interval:
+            raise ValueError('timeout must be longer than the heartbeat interval')
+        self.interval = interval
+        self.timeout = timeout
+        self.on_idle = on_idle
+        self.on_timeout = on_timeout
+        self.tick_interval = tick
+        self.wheel = TimerWheel(tick, int(timeout / tick) + 2, monotonic())
+        # connection -> deadline it is scheduled for, entries in the wheel with
+        # any other deadline are stale
+        self.deadlines = {}
+        # connection -> when it was last sent a heartbeat
+        self.pinged = {}
+        self.lock = Lock()
+
+        # counters
+        self.heartbeats = 0
+        self.timeouts = 0
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def add(self, connection):
+        '''
+        Starts monitoring a connection
+        '''
+        with self.lock:
+            self.schedule(connection, connection.last_seen + self.interval)
+
+    def remove(self, connection):
+        '''
+        Stops monitoring a connection
+        '''
+        with self.lock:
+            self.deadlines.pop(connection, None)
+            self.pinged.pop(connection, None)
+
+    def schedule(self, connection, deadline):
+        self.deadlines[connection] = deadline
+        self.wheel.schedule(connection, deadline)
+
+    def tick(self, now=None):
+        '''
+        Checks connections that are due, call every tick_interval seconds
+        '''
+        now = monotonic() if now is None else now
+        idle = []
+        expired = []
+        with self.lock:
+            for deadline, connection in self.wheel.expire(now):
+                if self.deadlines.get(connection) != deadline:
+                    continue
+                quiet = now - connection.last_seen
+                if quiet >= self.timeout:
+                    del self.deadlines[connection]
+                    self.pinged.pop(connection, None)
+                    expired.append(connection)
+                elif quiet >= self.interval:
+                    # one heartbeat per quiet spell, not one per check
+                    pinged_at = self.pinged.get(connection)
+                    if pinged_at is None or connection.last_seen > pinged_at:
+                        self.pinged[connection] = now
+                        idle.append(connection)
+                    self.schedule(connection, min(
+                        now + self.interval, connection.last_seen + self.timeout))
+                else:
+                    # heard from since it was scheduled
+                    self.pinged.pop(connection, None)
+                    self.schedule(connection, connection.last_seen + self.interval)
+            self.heartbeats += len(idle)
+            self.timeouts += len(expired)
+
+        for connection in idle:
+            self.on_idle(connection)
+        for connection in expired:
+            self.on_timeout(connection)
@@ -0,0 +1,203 @@
+'''
+Server metrics in the Prometheus text format.
+
+Handlers and writers update plain counters and histograms with no locking, so
+recording costs a few attribute updates on the hot path. Under the threaded
+engine two threads can race on the same counter and an increment can be lost
+now and then, which is fine for monitoring. Values that are cheap to read from
+the server's own state (connected clients, rooms) are collected when the
+metrics are rendered instead of being tracked.
+
+With --metrics-port the server answers GET /metrics on localhost with
+render()'s output.
+'''
+
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+from compression import CompressionStats
+from outbound import QueueTotals
+from opcodes import OpCode
+
+# handler latency bucket bounds in seconds
+LATENCY_BUCKETS = [
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0,
+]
+# broadcast recipient count bucket bounds
+FANOUT_BUCKETS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+OP_NAMES = {value: name for (name, value) in vars(OpCode).items() if isinstance(value, int)}
+
+
+def op_name(op):
+    return OP_NAMES.get(op, f'{op:#x}')
+
+
+class Histogram:
+    '''
+    Counts of observations falling under each bucket bound, plus their sum
+    '''
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # the last count is for values above every bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels=''):
+        '''
+        Returns the Prometheus sample lines, buckets are cumulative
+        '''
+        prefix = labels + ',' if labels else ''
+        lines = []
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            lines.append(f'{name}_bucket{{{prefix}le="{bound:g}"}} {total}')
+        lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {self.count}')
+        suffix = f'{{{labels}}}' if labels else ''
+        lines.append(f'{name}_sum{suffix} {self.sum:g}')
+        lines.append(f'{name}_count{suffix} {self.count}')
+        return lines
+
+
+class Metrics:
+    '''
+    Everything the server records about itself
+    '''
+
+    def __init__(self):
+        # opcode -> Histogram of handler seconds, its count is the request count
+        self.handlers = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # socket writes, every write carries one or more frames
+        self.writes = 0
+        # limit name -> requests or connections refused, see ratelimit.py
+        self.rate_limited = {}
+        # totals over every compressed connection, see compression.py
+        self.compressed_out = CompressionStats()
+        self.compressed_in = CompressionStats()
+        self.fanout = Histogram(FANOUT_BUCKETS)
+        # outbound queue drops over every client, see outbound.py
+        self.outbound = QueueTotals()
+        # name -> (type, help, function returning the current value)
+        self.collectors = {}
+
+    def observe_request(self, op, seconds):
+        histogram = self.handlers.get(op)
+        if histogram is None:
+            histogram = self.handlers.setdefault(op, Histogram(LATENCY_BUCKETS))
+        histogram.observe(seconds)
+
+    def refuse(self, limit):
+        self.rate_limited[limit] = self.rate_limited.get(limit, 0) + 1
+
+    def collect(self, name, kind, help, value):
+        '''
+        Adds a value read when the metrics are rendered, kind is gauge or
+        counter
+        '''
+        self.collectors[name] = (kind, help, value)
+
+    def render(self):
+        '''
+        Returns every metric in the Prometheus text exposition format
+        '''
+        lines = [
+            '# HELP irc_requests_total Requests handled, by opcode',
+            '# TYPE irc_requests_total counter',
+        ]
+        handlers = sorted(self.handlers.items())
+        for op, histogram in handlers:
+            lines.append(f'irc_requests_total{{op="{op_name(op)}"}} {histogram.count}')
+        lines += [
+            '# HELP irc_handler_seconds Time spent in request handlers, by opcode',
+            '# TYPE irc_handler_seconds histogram',
+        ]
+        for op, histogram in handlers:
+            lines += histogram.render('irc_handler_seconds', f'op="{op_name(op)}"')
+        lines += [
+            '# HELP irc_received_bytes_total Bytes read from clients',
+            '# TYPE irc_received_bytes_total counter',
+            f'irc_received_bytes_total {self.bytes_in}',
+            '# HELP irc_sent_bytes_total Bytes written to clients',
+            '# TYPE irc_sent_bytes_total counter',
+            f'irc_sent_bytes_total {self.bytes_out}',
+            '# HELP irc_writes_total Socket writes to clients',
+            '# TYPE irc_writes_total counter',
+            f'irc_writes_total {self.writes}',
+            '# HELP irc_broadcast_recipients Local recipients of each room broadcast',
+            '# TYPE irc_broadcast_recipients histogram',
+        ]
+        lines += self.fanout.render('irc_broadcast_recipients')
+        lines += [
+            '# HELP irc_rate_limited_total Requests and connections refused, by limit',
+            '# TYPE irc_rate_limited_total counter',
+        ]
+        for limit, count in sorted(self.rate_limited.items()):
+            lines.append(f'irc_rate_limited_total{{limit="{limit}"}} {count}')
+        lines += [
+            '# HELP irc_outbound_dropped_total Frames dropped from full outbound queues',
+            '# TYPE irc_outbound_dropped_total counter',
+            f'irc_outbound_dropped_total {self.outbound.dropped}',
+            '# HELP irc_outbound_overflows_total Clients disconnected for a full outbound queue',
+            '# TYPE irc_outbound_overflows_total counter',
+            f'irc_outbound_overflows_total {self.outbound.overflows}',
+        ]
+        lines += [
+            '# HELP irc_compression_raw_bytes_total Bytes before compression or after decompression',
+            '# TYPE irc_compression_raw_bytes_total counter',
+            f'irc_compression_raw_bytes_total{{direction="out"}} {self.compressed_out.raw}',
+            f'irc_compression_raw_bytes_total{{direction="in"}} {self.compressed_in.raw}',
+            '# HELP irc_compression_wire_bytes_total Compressed bytes on the wire',
+            '# TYPE irc_compression_wire_bytes_total counter',
+            f'irc_compression_wire_bytes_total{{direction="out"}} {self.compressed_out.compressed}',
+            f'irc_compression_wire_bytes_total{{direction="in"}} {self.compressed_in.compressed}',
+            '# HELP irc_compression_cpu_seconds_total CPU time spent compressing and decompressing',
+            '# TYPE irc_compression_cpu_seconds_total counter',
+            f'irc_compression_cpu_seconds_total{{direction="out"}} {self.compressed_out.seconds:g}',
+            f'irc_compression_cpu_seconds_total{{direction="in"}} {self.compressed_in.seconds:g}',
+        ]
+        for name, (kind, help, value) in self.collectors.items():
+            lines += [
+                f'# HELP {name} {help}',
+                f'# TYPE {name} {kind}',
+                f'{name} {value()}',
+            ]
+        return '\n'.join(lines) + '\n'
+
+
+def serve_metrics(metrics, address):
+    '''
+    Serves GET /metrics on address from a background thread
+    '''
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(address, MetricsHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
@@ -0,0 +1,262 @@
+#! /usr/bin/env python3
+
+'''
+Durable append-only message log.
+
+Messages are appended to segment files in a directory, each named after the
+sequence number of its first record (00000000000000000042.log). Once a segment
+grows past the segment size a new one is started. Writes are buffered and
+fsynced in batches, either when enough records are pending or after the fsync
+interval, by a background thread. Appending never waits on an fsync.
+
+Each record is:
+
+    length      4 bytes, size of everything after the crc
+    crc         4 bytes, CRC-32 of everything after the crc
+    seq         8 bytes
+    timestamp   8 byte float, seconds since the epoch
+    room        2 byte length + UTF-8
+    message     JSON
+
+Readers mmap segments and walk the record headers, so ranges can be served
+from large logs without reading whole files into memory.
+
+Usage: msglog.py DIR [--room ROOM] [--start SEQ] [--end SEQ] [--limit N]
+'''
+
+import argparse
+import bisect
+import json
+import mmap
+import os
+import struct
+import zlib
+from threading import Thread, Lock, Event
+from time import time
+
+# (length, crc)
+PREFIX = struct.Struct('!II')
+# (seq, timestamp, room length)
+HEADER = struct.Struct('!QdH')
+# longest room name a record holds, in UTF-8 bytes
+MAX_ROOM_BYTES = 0xFFFF
+
+SEGMENT_SUFFIX = '.log'
+
+DEFAULT_SEGMENT_BYTES = 64 * 1024 * 1024
+# records pending before the background fsync is woken early
+DEFAULT_FSYNC_BATCH = 256
+# seconds between background fsyncs of pending records
+DEFAULT_FSYNC_INTERVAL = 0.5
+
+
+def segment_name(first_seq):
+    return f'{first_seq:020d}{SEGMENT_SUFFIX}'
+
+def list_segments(directory):
+    '''
+    Returns the first sequence numbers of the segments in directory, sorted
+    '''
+    return sorted(
+        int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory)
+        if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit())
+
+def encode_record(seq, timestamp, room, message):
+    '''
+    Returns a record, raises ValueError if room can't be stored in one
+    '''
+    try:
+        room = room.encode()
+    except (AttributeError, UnicodeEncodeError):
+        raise ValueError(f'Room name {room!r:.40} can\'t be logged')
+    if len(room) > MAX_ROOM_BYTES:
+        raise ValueError(f'Room name is over {MAX_ROOM_BYTES} bytes')
+    body = HEADER.pack(seq, timestamp, len(room)) + room + json.dumps(message).encode()
+    return PREFIX.pack(len(body), zlib.crc32(body)) + body
+
+def scan_records(buffer, offset=0):
+    '''
+    Yields (offset, end, seq, timestamp, room) for each intact record in
+    buffer starting at offset, stopping at the first torn or corrupt record
+    '''
+    size = len(buffer)
+    while offset + PREFIX.size + HEADER.size <= size:
+        length, crc = PREFIX.unpack_from(buffer, offset)
+        start = offset + PREFIX.size
+        end = start + length
+        if length < HEADER.size or end > size:
+            return
+        if zlib.crc32(buffer[start:end]) != crc:
+            return
+        seq, timestamp, room_length = HEADER.unpack_from(buffer, start)
+        room_start = start + HEADER.size
+        room = bytes(buffer[room_start:room_start + room_length]).decode()
+        yield offset, end, seq, timestamp, room
+        offset = end
+
+
+class MessageLog:
+    '''
+    Appends messages to the segment log in directory and serves ranges back
+    '''
+
+    def __init__(self, directory, segment_bytes=DEFAULT_SEGMENT_BYTES,
+            fsync_batch=DEFAULT_FSYNC_BATCH, fsync_interval=DEFAULT_FSYNC_INTERVAL):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_batch = fsync_batch
+        self.fsync_interval = fsync_interval
+        self.lock = Lock()
+        self.pending = 0
+        # descriptors of finished segments waiting for their last fsync
+        self.retired = []
+        # set to fsync before the interval is up
+        self.wake = Event()
+        self.closed = Event()
+        os.makedirs(directory, exist_ok=True)
+
+        self.segments = list_segments(directory)
+        self.next_seq = 0
+        self.file = None
+        if self.segments:
+            self.recover()
+        else:
+            self.open_segment(0)
+
+        self.flusher = Thread(target=self.flush_loop, name='msglog', daemon=True)
+        self.flusher.start()
+
+    def segment_path(self, first_seq):
+        return os.path.join(self.directory, segment_name(first_seq))
+
+    def recover(self):
+        '''
+        Finds the last intact record of the newest segment and cuts off
+        anything after it (a write torn by a crash)
+        '''
+        path = self.segment_path(self.segments[-1])
+        valid = 0
+        self.next_seq = self.segments[-1]
+        if os.path.getsize(path):
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                for _, end, seq, _, _ in scan_records(buffer):
+                    valid = end
+                    self.next_seq = seq + 1
+        self.file = open(path, 'ab')
+        if self.file.tell() > valid:
+            self.file.truncate(valid)
+            self.file.seek(valid)
+
+    def open_segment(self, first_seq):
+        if self.file:
+            self.file.flush()
+            self.retired.append(os.dup(self.file.fileno()))
+            self.file.close()
+            self.wake.set()
+        self.file = open(self.segment_path(first_seq), 'ab')
+        if first_seq not in self.segments:
+            self.segments.append(first_seq)
+
+    def append(self, room, message):
+        '''
+        Appends a message, returns its sequence number. It is durable once the
+        next batch is fsynced. Raises ValueError, without using up a sequence
+        number, if the message can't be logged
+        '''
+        with self.lock:
+            seq = self.next_seq
+            record = encode_record(seq, time(), room, message)
+            self.next_seq += 1
+            if self.file.tell() >= self.segment_bytes:
+                self.open_segment(seq)
+            self.file.write(record)
+            self.pending += 1
+            if self.pending >= self.fsync_batch:
+                self.wake.set()
+        return seq
+
+    def sync(self):
+        '''
+        Flushes pending records and fsyncs them. The lock is only held for the
+        flush, appends carry on during the fsync
+        '''
+        with self.lock:
+            fds, self.retired = self.retired, []
+            if self.pending and not self.file.closed:
+                self.file.flush()
+                fds.append(os.dup(self.file.fileno()))
+                self.pending = 0
+        for fd in fds:
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def flush_loop(self):
+        while not self.closed.is_set():
+            self.wake.wait(self.fsync_interval)
+            self.wake.clear()
+            self.sync()
+
+    def close(self):
+        self.closed.set()
+        self.wake.set()
+        self.sync()
+        with self.lock:
+            self.file.close()
+
+    def read(self, room=None, start=0, end=None, limit=None):
+        '''
+        Yields (seq, timestamp, room, message) for records with start <= seq <
+        end, optionally only those in room
+        '''
+        with self.lock:
+            # make buffered records visible to the mmap
+            if not self.file.closed:
+                self.file.flush()
+            segments = list(self.segments)
+        yield from read_segments(self.directory, segments, room, start, end, limit)
+
+
+def read_segments(directory, segments, room=None, start=0, end=None, limit=None):
+    '''
+    Reads records from the segments of a log, see MessageLog.read
+    '''
+    # skip segments that end before start
+    first = max(bisect.bisect_right(segments, start) - 1, 0)
+    count = 0
+    for first_seq in segments[first:]:
+        if end is not None and first_seq >= end:
+            return
+        path = os.path.join(directory, segment_name(first_seq))
+        if not os.path.getsize(path):
+            continue
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            for offset, record_end, seq, timestamp, record_room in scan_records(buffer):
+                if seq < start or (room is not None and record_room != room):
+                    continue
+                if end is not None and seq >= end:
+                    return
+                message_start = offset + PREFIX.size + HEADER.size + len(record_room.encode())
+                yield seq, timestamp, record_room, json.loads(buffer[message_start:record_end])
+                count += 1
+                if limit is not None and count >= limit:
+                    return
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Print records from a message log')
+    parser.add_argument('directory')
+    parser.add_argument('--room', help='only records in this room')
+    parser.add_argument('--start', type=int, default=0, help='first sequence number')
+    parser.add_argument('--end', type=int, help='stop before this sequence number')
+    parser.add_argument('--limit', type=int, help='most records to print')
+    args = parser.parse_args()
+    segments = list_segments(args.directory)
+    for seq, timestamp, room, message in read_segments(
+            args.directory, segments, args.room, args.start, args.end, args.limit):
+        print(json.dumps({'seq': seq, 'time': timestamp, 'room': room, 'message': message}))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,3 @@
-from dataclasses import dataclass
-
-@dataclass
 class OpCode:
 
     ERR = 0x0
@@ -24,3 +21,9 @@ class OpCode:
     ERR_TIMEOUT = 0x11
     ERR_ILLEGAL_WISP = 0x12
     ERR_NOT_IN_ROOM = 0x13
+
+    # binary encoding only: defines an interned string id, see codec.py
+    INTERN = 0x14
+
+    # a request or connection was refused by a rate limit, see ratelimit.py
+    ERR_RATE_LIMITED = 0x15
@@ -0,0 +1,211 @@
+'''
+Bounded per-client outbound frame queues.
+
+Handlers never write to a client's socket directly, they put encoded frames
+on the client's queue and a writer owned by that client drains it. A client
+that stops reading only fills its own queue, what happens then is decided by
+the queue's overflow policy.
+'''
+
+import os
+from collections import deque
+from threading import Condition
+
+# drop the oldest queued frame to make room for the new one
+DROP_OLDEST = 'drop-oldest'
+# give up on the client: queued frames are discarded and it is disconnected
+DISCONNECT = 'disconnect'
+# drop frames made redundant by newer ones with the same coalesce key (eg
+# heartbeats), falling back to dropping the oldest frame
+COALESCE = 'coalesce'
+
+POLICIES = [DROP_OLDEST, DISCONNECT, COALESCE]
+
+DEFAULT_MAXLEN = 1024
+DEFAULT_POLICY = DROP_OLDEST
+
+# buffers passed to a single sendmsg
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+
+class QueueTotals:
+    '''
+    Counters summed over every queue sharing it, they outlive the queues of
+    disconnected clients
+    '''
+
+    def __init__(self):
+        self.dropped = 0
+        # queues closed by the DISCONNECT policy
+        self.overflows = 0
+
+
+class OutboundQueue:
+    '''
+    A bounded FIFO of encoded frames for a single client. put may be called
+    from any thread, get blocks until frames are available (threaded writer)
+    while drain never blocks (asyncio writer woken through on_ready). Drops
+    are also added to totals, if given
+    '''
+
+    def __init__(self, maxlen=DEFAULT_MAXLEN, policy=DEFAULT_POLICY, on_ready=None,
+            totals=None):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown overflow policy {policy!r}')
+        self.maxlen = maxlen
+        self.policy = policy
+        self.on_ready = on_ready
+        self.totals = totals
+        # (data, coalesce_key) pairs
+        self.frames = deque()
+        self.cond = Condition()
+        self.closed = False
+        # set when the DISCONNECT policy trips
+        self.overflowed = False
+
+        # counters
+        self.enqueued = 0
+        self.dropped = 0
+        self.high_water = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def put(self, data, coalesce_key=None):
+        '''
+        Queues a frame. Returns False if the queue is full and the policy is
+        DISCONNECT, the caller is expected to close the client. Frames put on a
+        closed queue are discarded
+        '''
+        with self.cond:
+            if self.closed:
+                return True
+            if len(self.frames) >= self.maxlen and not self.make_room(coalesce_key):
+                return False
+            was_empty = not self.frames
+            self.frames.append((data, coalesce_key))
+            self.enqueued += 1
+            self.high_water = max(self.high_water, len(self.frames))
+            if was_empty:
+                self.cond.notify()
+        if was_empty and self.on_ready:
+            self.on_ready()
+        return True
+
+    def make_room(self, coalesce_key):
+        '''
+        Applies the overflow policy to a full queue, called with the lock held.
+        Returns False if the frame can't be queued
+        '''
+        if self.policy == DISCONNECT:
+            self.overflowed = True
+            self.count_drops(len(self.frames) + 1)
+            if self.totals:
+                self.totals.overflows += 1
+            self.frames.clear()
+            self.closed = True
+            return False
+
+        if self.policy == COALESCE:
+            before = len(self.frames)
+            if coalesce_key is not None:
+                # the new frame supersedes queued ones with the same key
+                kept = [f for f in self.frames if f[1] != coalesce_key]
+            else:
+                # while regular traffic is backed up keyed frames add nothing
+                kept = [f for f in self.frames if f[1] is None]
+            if len(kept) < before:
+                self.frames = deque(kept)
+                self.count_drops(before - len(kept))
+                return True
+
+        self.frames.popleft()
+        self.count_drops(1)
+        return True
+
+    def count_drops(self, count):
+        self.dropped += count
+        if self.totals:
+            self.totals.dropped += count
+
+    def get(self, timeout=None):
+        '''
+        Blocks until frames are queued and returns all of them. Returns None
+        once the queue is closed and empty
+        '''
+        with self.cond:
+            while not self.frames and not self.closed:
+                if not self.cond.wait(timeout):
+                    return []
+            if not self.frames:
+                return None
+            return self.pop_all()
+
+    def drain(self):
+        '''
+        Returns all queued frames without blocking, possibly an empty list.
+        Returns None once the queue is closed and empty
+        '''
+        with self.cond:
+            if not self.frames and self.closed:
+                return None
+            return self.pop_all()
+
+    def pop_all(self):
+        '''
+        Empties the queue, called with the lock held
+        '''
+        frames = [data for data, _ in self.frames]
+        self.frames.clear()
+        return frames
+
+    def close(self, final=None):
+        '''
+        Stops accepting frames. Already queued frames are still handed to the
+        writer, followed by final if given
+        '''
+        with self.cond:
+            self.closed = True
+            if final is not None:
+                self.frames.append((final, None))
+            self.cond.notify()
+        if self.on_ready:
+            self.on_ready()
+
+    def stats(self):
+        '''
+        Returns the queue counters
+        '''
+        return {
+            'depth': len(self.frames),
+            'high_water': self.high_water,
+            'enqueued': self.enqueued,
+            'dropped': self.dropped,
+        }
+
+
+def send_vectored(sock, buffers):
+    '''
+    Writes every buffer to a blocking socket, as few sendmsg calls as the
+    kernel allows. Returns the number of system calls made
+    '''
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(b''.join(buffers))
+        return 1
+    calls = 0
+    buffers = [memoryview(b) for b in buffers]
+    # first buffer not completely written
+    start = 0
+    while start < len(buffers):
+        sent = sock.sendmsg(buffers[start:start + IOV_MAX])
+        calls += 1
+        while start < len(buffers) and sent >= len(buffers[start]):
+            sent -= len(buffers[start])
+            start += 1
+        if sent:
+            # a partial write leaves the tail of a buffer
+            buffers[start] = buffers[start][sent:]
+    return calls
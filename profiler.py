@@ -0,0 +1,163 @@
+'''
+Opt-in profiling of command handlers, switched on and off while the server
+runs.
+
+While enabled, every command dispatched through the server's COMMANDS table
+goes through Profiler.call, which:
+
+- marks the calling thread as being inside a handler, so a sampler thread can
+  record that thread's stack every interval. Stacks are aggregated in the
+  collapsed format read by flamegraph.pl and speedscope, rooted at the
+  opcode's name
+- records calls slower than the threshold, with the request's size in bytes
+  and the number of recipients its broadcasts reached
+
+Sending the server SIGUSR1 toggles profiling. Switching it off writes
+profile-PID-TIME.folded (stacks) and profile-PID-TIME.slow.txt (slow calls) to
+the profile directory. When disabled the dispatch cost is one attribute check.
+'''
+
+import os
+import sys
+from collections import deque
+from threading import Thread, Event, Lock, get_ident
+from time import perf_counter, sleep, strftime, time
+
+from metrics import op_name
+
+# seconds between stack samples
+DEFAULT_INTERVAL = 0.001
+# handler calls slower than this many seconds are recorded
+DEFAULT_SLOW_CALL = 0.005
+# slow calls kept, oldest dropped first
+MAX_SLOW_CALLS = 1000
+
+
+class Call:
+    '''
+    A command being handled
+    '''
+
+    __slots__ = ('op', 'size', 'fanout', 'frame')
+
+    def __init__(self, op, size):
+        self.op = op
+        self.size = size
+        self.fanout = 0
+        # Profiler.call's frame, sampled stacks start below it
+        self.frame = sys._getframe(1)
+
+
+class Profiler:
+    '''
+    Samples handler stacks and records slow handler calls while enabled
+    '''
+
+    def __init__(self, directory='.', interval=DEFAULT_INTERVAL, slow_call=DEFAULT_SLOW_CALL):
+        self.directory = directory
+        self.interval = interval
+        self.slow_call = slow_call
+        self.enabled = False
+        # thread id -> Call it is handling
+        self.calls = {}
+        # collapsed stack -> samples
+        self.stacks = {}
+        self.slow_calls = deque(maxlen=MAX_SLOW_CALLS)
+        self.lock = Lock()
+        self.stopped = Event()
+
+    def call(self, command, payload, client, size):
+        '''
+        Runs command(payload, client) while recording it, size is the
+        request's encoded size
+        '''
+        call = Call(payload['op'], size)
+        thread = get_ident()
+        self.calls[thread] = call
+        start = perf_counter()
+        try:
+            command(payload, client)
+        finally:
+            elapsed = perf_counter() - start
+            del self.calls[thread]
+            if elapsed >= self.slow_call:
+                self.slow_calls.append(
+                    (time(), op_name(call.op), elapsed, call.size, call.fanout, client.username))
+
+    def fanout(self, recipients):
+        '''
+        Adds recipients to the broadcast count of the current thread's call
+        '''
+        call = self.calls.get(get_ident())
+        if call:
+            call.fanout += recipients
+
+    def start(self):
+        with self.lock:
+            if self.enabled:
+                return
+            self.stacks = {}
+            self.slow_calls.clear()
+            self.stopped.clear()
+            self.enabled = True
+            Thread(target=self.sample_loop, name='profiler', daemon=True).start()
+        print('Profiling started')
+
+    def stop(self):
+        '''
+        Stops profiling and writes the report, returns the paths written
+        '''
+        with self.lock:
+            if not self.enabled:
+                return []
+            self.enabled = False
+            self.stopped.set()
+        return self.dump()
+
+    def toggle(self, *_):
+        '''
+        Signal handler, the report is written off the signal handler's thread
+        '''
+        if self.enabled:
+            Thread(target=self.stop, name='profiler-dump', daemon=True).start()
+        else:
+            self.start()
+
+    def sample_loop(self):
+        while not self.stopped.is_set():
+            sleep(self.interval)
+            frames = sys._current_frames()
+            for thread, call in list(self.calls.items()):
+                frame = frames.get(thread)
+                stack = frame and collapse(frame, call)
+                if stack:
+                    self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def dump(self):
+        base = os.path.join(self.directory, f'profile-{os.getpid()}-{strftime("%Y%m%d-%H%M%S")}')
+        with open(base + '.folded', 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f'{stack} {count}\n')
+        with open(base + '.slow.txt', 'w') as f:
+            f.write('# time op ms bytes recipients user\n')
+            for (at, op, seconds, size, fanout, user) in list(self.slow_calls):
+                f.write(f'{at:.3f} {op} {seconds * 1000:.3f} {size} {fanout} {user}\n')
+        print(f'Profile written to {base}.folded and {base}.slow.txt')
+        return [base + '.folded', base + '.slow.txt']
+
+
+def collapse(frame, call):
+    '''
+    Returns the handler part of frame's stack, outermost first, as
+    op;file:function;file:function. None if the thread has already moved on
+    from the call
+    '''
+    names = []
+    while frame is not call.frame:
+        if frame is None:
+            return None
+        code = frame.f_code
+        names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+        frame = frame.f_back
+    names.append(op_name(call.op))
+    return ';'.join(reversed(names))
@@ -0,0 +1,152 @@
+'''
+Rate limiting and admission control.
+
+Requests are checked against token buckets before they are dispatched: one
+per client for every request, and one per room for MESSAGE, since a message is
+fanned out to every member and one chatty client in a big room costs the
+server far more than its own traffic. A request that finds its bucket empty
+is dropped and answered with ERR_RATE_LIMITED.
+
+New connections are checked by Admission before they are registered, against
+a cap on connected clients and a token bucket on the accept rate. Refused
+connections are sent ERR_RATE_LIMITED and closed.
+
+A rate of 0 disables a limit. Buckets aren't locked when taken from, two
+threads racing on the same room's bucket can at worst let an extra message
+through.
+'''
+
+from threading import Lock
+from time import monotonic
+
+# limit names sent in ERR_RATE_LIMITED
+CLIENT = 'client'
+ROOM = 'room'
+CONNECTIONS = 'connections'
+ACCEPT = 'accept'
+
+# requests per second per client, and how many may come in a burst
+DEFAULT_CLIENT_RATE = 20.0
+DEFAULT_CLIENT_BURST = 40
+# messages per second per room
+DEFAULT_ROOM_RATE = 100.0
+DEFAULT_ROOM_BURST = 200
+# rooms with a bucket, past this buckets that have refilled are dropped
+DEFAULT_ROOM_BUCKETS = 4096
+# connected clients, 0 for no cap
+DEFAULT_MAX_CONNECTIONS = 0
+# new connections per second, 0 for no limit
+DEFAULT_ACCEPT_RATE = 0.0
+DEFAULT_ACCEPT_BURST = 100
+
+
+class TokenBucket:
+    '''
+    Holds up to burst tokens, refilled at rate tokens a second. Refilling is
+    done lazily when tokens are taken
+    '''
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+
+    def take(self, count=1):
+        '''
+        Takes count tokens, returns False if there aren't enough
+        '''
+        if not self.rate:
+            return True
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < count:
+            return False
+        self.tokens -= count
+        return True
+
+    def refilled(self, now):
+        '''
+        Returns True if the bucket is full again, no different from a new one
+        '''
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class RoomLimits:
+    '''
+    A token bucket per room, created on first use. Rooms are forgotten with
+    forget once they empty. Since a MESSAGE can name a room nobody joined,
+    at most max_rooms buckets are kept: past that, buckets that have refilled
+    are dropped, and while none has, rooms without a bucket are refused. A
+    bucket still draining is never dropped, which would hand its room a
+    fresh burst
+    '''
+
+    def __init__(self, rate, burst, max_rooms=DEFAULT_ROOM_BUCKETS):
+        self.rate = rate
+        self.burst = burst
+        self.max_rooms = max_rooms
+        self.buckets = {}
+        self.lock = Lock()
+
+    def take(self, room):
+        if not self.rate:
+            return True
+        bucket = self.buckets.get(room)
+        if bucket is None:
+            with self.lock:
+                bucket = self.buckets.get(room)
+                if bucket is None:
+                    if len(self.buckets) >= self.max_rooms:
+                        self.sweep()
+                        if len(self.buckets) >= self.max_rooms:
+                            return False
+                    bucket = self.buckets[room] = TokenBucket(self.rate, self.burst)
+        return bucket.take()
+
+    def sweep(self):
+        '''
+        Drops the buckets that have refilled, called with the lock held
+        '''
+        now = monotonic()
+        for room in [r for (r, b) in self.buckets.items() if b.refilled(now)]:
+            del self.buckets[room]
+
+    def forget(self, room):
+        with self.lock:
+            self.buckets.pop(room, None)
+
+
+class Admission:
+    '''
+    Decides whether a new connection is let in
+    '''
+
+    def __init__(self, max_connections=DEFAULT_MAX_CONNECTIONS,
+            accept_rate=DEFAULT_ACCEPT_RATE, accept_burst=DEFAULT_ACCEPT_BURST):
+        self.max_connections = max_connections
+        self.accepts = TokenBucket(accept_rate, accept_burst)
+        self.lock = Lock()
+        # admitted connections not yet released
+        self.connected = 0
+
+    def admit(self):
+        '''
+        Returns None and counts the connection if it may be let in, otherwise
+        the name of the limit it would break. Admitted connections must be
+        released when they close
+        '''
+        with self.lock:
+            if self.max_connections and self.connected >= self.max_connections:
+                return CONNECTIONS
+            if not self.accepts.take():
+                return ACCEPT
+            self.connected += 1
+            return None
+
+    def release(self):
+        with self.lock:
+            self.connected -= 1
@@ -0,0 +1,263 @@
+'''
+Who is connected, under which name, and in which rooms.
+
+Handler threads log clients in, join and leave rooms and disconnect while
+other threads broadcast, so every structure here is locked, and broadcasts
+iterate snapshots:
+
+ClientRegistry keeps every connected client in a dict, so connecting and
+disconnecting are constant time. Broadcasts iterate a tuple snapshot of it,
+which a change only invalidates. The next broadcast rebuilds it, so a burst
+of connects costs one copy, not one each, and a broadcast always sees a
+consistent set of clients. Usernames are claimed in one of SHARDS dicts
+picked by the name's hash, each behind its own lock, so checking a name is
+free and taking it is a single atomic step, and logins of different names
+rarely contend.
+
+RoomIndex keeps each room's members the same way, a dict plus a lazily
+rebuilt snapshot, so a broadcast never sees a room change size under it,
+along with their names in sorted order for LIST_USERS. Rooms are also
+sharded by name, joins and leaves of different rooms rarely contend.
+'''
+
+from threading import Lock
+
+from users import UserIndex, PAGE_LIMIT
+
+# username shards, each with its own lock
+SHARDS = 16
+
+
+class Shard:
+    '''
+    Usernames whose hash falls in this shard and the clients holding them,
+    or rooms and their Members
+    '''
+
+    __slots__ = ('lock', 'clients')
+
+    def __init__(self):
+        self.lock = Lock()
+        self.clients = {}
+
+
+class Members:
+    '''
+    A set of clients in the order they were added, and a tuple snapshot of
+    it rebuilt on demand. Changed with lock held
+    '''
+
+    __slots__ = ('lock', 'clients', 'snapshot')
+
+    def __init__(self, lock):
+        self.lock = lock
+        # client -> None, a dict for its order
+        self.clients = {}
+        self.snapshot = ()
+
+    def __len__(self):
+        return len(self.clients)
+
+    def __contains__(self, client):
+        return client in self.clients
+
+    def add(self, client):
+        self.clients[client] = None
+        self.snapshot = None
+
+    def discard(self, client):
+        self.clients.pop(client, None)
+        self.snapshot = None
+
+    def current(self):
+        '''
+        Returns the members as a tuple later changes don't touch
+        '''
+        snapshot = self.snapshot
+        if snapshot is None:
+            # built under the lock, or a change made while copying could be
+            # hidden behind a stale snapshot
+            with self.lock:
+                if self.snapshot is None:
+                    self.snapshot = tuple(self.clients)
+                snapshot = self.snapshot
+        return snapshot
+
+
+class RoomMembers(Members):
+    '''
+    A room's members, and the names they're listed under in sorted order
+    '''
+
+    __slots__ = ('names',)
+
+    def __init__(self, lock):
+        super().__init__(lock)
+        self.names = UserIndex()
+
+
+class ClientRegistry:
+    '''
+    Connected clients, and the usernames they have claimed
+    '''
+
+    def __init__(self, shards=SHARDS):
+        self.shards = [Shard() for _ in range(shards)]
+        self.lock = Lock()
+        # every connected client, logged in or not
+        self.clients = Members(self.lock)
+        # claimed usernames in sorted order for LIST_USERS, see users.py
+        self.names = UserIndex()
+
+    def __len__(self):
+        return len(self.clients)
+
+    @property
+    def connected(self):
+        '''
+        Every connected client, as a tuple snapshot
+        '''
+        return self.clients.current()
+
+    def __contains__(self, username):
+        return username in self.shard(username).clients
+
+    def shard(self, username):
+        return self.shards[hash(username) % len(self.shards)]
+
+    def add(self, client):
+        with self.lock:
+            self.clients.add(client)
+
+    def remove(self, client):
+        with self.lock:
+            self.clients.discard(client)
+
+    def claim(self, username, client):
+        '''
+        Gives username to client, returns False if another client has it
+        '''
+        shard = self.shard(username)
+        with shard.lock:
+            if username in shard.clients:
+                return False
+            shard.clients[username] = client
+            self.names.add(username)
+        return True
+
+    def release(self, username, client):
+        '''
+        Frees username if client holds it
+        '''
+        shard = self.shard(username)
+        with shard.lock:
+            if shard.clients.get(username) is not client:
+                return
+            del shard.clients[username]
+            self.names.remove(username)
+
+    def find(self, username):
+        '''
+        Returns the client logged in as username, or None
+        '''
+        return self.shard(username).clients.get(username)
+
+
+class RoomIndex:
+    '''
+    Room name -> member clients. joined(room, client, created) and left(room,
+    client, dropped) are called under the room's shard lock after every
+    change, so whatever they keep in step with the index (the client's own
+    set of rooms, member counts, cluster subscriptions) sees each room's
+    changes in the order they were made. listed(client) returns the name a
+    member is listed under, or None to leave it out of room listings
+    '''
+
+    def __init__(self, joined=None, left=None, listed=None, shards=SHARDS):
+        # room -> RoomMembers, sharded by the room's hash
+        self.shards = [Shard() for _ in range(shards)]
+        self.joined = joined
+        self.left = left
+        self.listed = listed or (lambda client: None)
+
+    def __len__(self):
+        return sum(len(shard.clients) for shard in self.shards)
+
+    def __contains__(self, room):
+        return room in self.shard(room).clients
+
+    def shard(self, room):
+        return self.shards[hash(room) % len(self.shards)]
+
+    def members(self, room):
+        '''
+        Returns room's members as a tuple later joins and leaves don't touch
+        '''
+        members = self.shard(room).clients.get(room)
+        return members.current() if members else ()
+
+    def page(self, room, prefix='', cursor=None, limit=PAGE_LIMIT):
+        '''
+        Returns up to limit of the names room's members are listed under, in
+        order, see UserIndex.page
+        '''
+        members = self.shard(room).clients.get(room)
+        return members.names.page(prefix, cursor, limit) if members else []
+
+    def add(self, room, client):
+        '''
+        Adds client to room, returns False if it was already a member
+        '''
+        shard = self.shard(room)
+        with shard.lock:
+            members = shard.clients.get(room)
+            created = members is None
+            if created:
+                members = shard.clients[room] = RoomMembers(shard.lock)
+            elif client in members:
+                return False
+            members.add(client)
+            if self.joined:
+                self.joined(room, client, created)
+            # read after joined, which lets rename see this room
+            name = self.listed(client)
+            if name is not None and name not in members.names:
+                members.names.add(name)
+            return True
+
+    def remove(self, room, client):
+        '''
+        Removes client from room, returns False if it wasn't a member. Rooms
+        are dropped once their last member leaves
+        '''
+        shard = self.shard(room)
+        with shard.lock:
+            members = shard.clients.get(room)
+            if members is None or client not in members:
+                return False
+            members.discard(client)
+            name = self.listed(client)
+            if name is not None:
+                members.names.remove(name)
+            if not members:
+                del shard.clients[room]
+            if self.left:
+                self.left(room, client, not members)
+            return True
+
+    def rename(self, client, rooms, old, new):
+        '''
+        Lists client under new rather than old in rooms, the rooms it joined.
+        Called once the name it's listed under changed, and before anyone else
+        can take old, so a listing of old can only be client's
+        '''
+        for room in rooms:
+            shard = self.shard(room)
+            with shard.lock:
+                members = shard.clients.get(room)
+                if members is None:
+                    continue
+                if old is not None:
+                    members.names.remove(old)
+                if new is not None and client in members and new not in members.names:
+                    members.names.add(new)
@@ -0,0 +1,88 @@
+'''
+Bounded per-room scrollback for the client.
+
+Each room keeps its most recent lines in memory. Older lines are dropped, or,
+with a spill directory, appended to a file there and read back when scrolled
+to. Lines are addressed by position, counted from the first line the room
+ever had, so positions stay put while old lines are dropped or spilled.
+
+Spill files are unlinked as soon as they are opened, so they go away with
+the client however it exits.
+'''
+
+import os
+import tempfile
+from array import array
+from collections import deque
+from threading import Lock
+
+# lines kept in memory per room
+DEFAULT_LINES = 1000
+
+
+class Scrollback:
+    '''
+    A room's lines, the socket listener thread appends while the UI reads
+    '''
+
+    def __init__(self, limit=DEFAULT_LINES, spill_dir=None):
+        self.limit = limit
+        # the newest lines, lines[0] is at position start
+        self.lines = deque()
+        self.start = 0
+        self.lock = Lock()
+        # file descriptor of the spill file and the offset each spilled line
+        # starts at, spilled lines are positions 0 to start - 1
+        self.spill = None
+        self.offsets = array('Q')
+        self.spilled = 0
+        if spill_dir is not None:
+            fd, path = tempfile.mkstemp(prefix='scrollback-', dir=spill_dir)
+            os.unlink(path)
+            self.spill = fd
+
+    def __len__(self):
+        '''
+        Returns the position after the last line
+        '''
+        return self.start + len(self.lines)
+
+    def first(self):
+        '''
+        Returns the position of the oldest line still available
+        '''
+        return 0 if self.spill is not None else self.start
+
+    def append(self, line):
+        with self.lock:
+            self.lines.append(line)
+            while len(self.lines) > self.limit:
+                old = self.lines.popleft()
+                if self.spill is not None:
+                    data = old.encode()
+                    self.offsets.append(self.spilled)
+                    os.write(self.spill, data)
+                    self.spilled += len(data)
+                self.start += 1
+
+    def get(self, position):
+        '''
+        Returns the line at position, or None if there is none
+        '''
+        with self.lock:
+            if position >= self.start:
+                index = position - self.start
+                return self.lines[index] if index < len(self.lines) else None
+            if self.spill is None or position < 0:
+                return None
+            offset = self.offsets[position]
+            end = self.offsets[position + 1] if position + 1 < len(self.offsets) else self.spilled
+            return os.pread(self.spill, end - offset, offset).decode()
+
+    def close(self):
+        with self.lock:
+            if self.spill is not None:
+                os.close(self.spill)
+                self.spill = None
+                self.offsets = array('Q')
+            self.lines.clear()
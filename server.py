@@ -1,72 +1,577 @@
 #! /usr/bin/env python3
 
 from json.decoder import JSONDecodeError
+import argparse
+import asyncio
 import socket
 import socketserver
 import signal
-import sys
 import os
-from time import sleep
-from datetime import datetime
+from time import sleep, monotonic, perf_counter
 from threading import Thread
 import uuid
-import json
 from opcodes import OpCode
+from outbound import OutboundQueue, send_vectored
+from liveness import LivenessMonitor
+from cluster import BusClient, run_cluster
+from federation import FederationLink, parse_address
+from history import RoomHistory
+from directory import RoomDirectory
+from users import PAGE_LIMIT
+from registry import ClientRegistry, RoomIndex
+import users as user_pages
+import history as room_history
+from msglog import MessageLog
+from capture import Capture
+import msglog
+from metrics import Metrics, serve_metrics
+from profiler import Profiler
+from ratelimit import TokenBucket, RoomLimits, Admission
+import ratelimit
+import profiler as handler_profiler
+import outbound
+from framing import FrameTooLarge, RECV_SIZE
+from codec import Frame, Interner, JsonCodec, BinaryCodec, DecodeError, JSON, BINARY
+from compression import StreamCompressor, StreamDecompressor, COMPRESSIONS
 
-PORT = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+PORT = 8000
 SERVER_ADDRESS = 'localhost', PORT
 
+# outbound queue length and overflow policy for each client, see outbound.py
+QUEUE_SIZE = outbound.DEFAULT_MAXLEN
+QUEUE_POLICY = outbound.DEFAULT_POLICY
 
-client_list = []
+# ops where a newer frame makes queued copies redundant (outbound.COALESCE)
+COALESCE_OPS = {OpCode.HEART_BEAT, OpCode.ERR_RATE_LIMITED}
+
+# seconds a client may be quiet before it is sent a HEART_BEAT, and before it
+# is disconnected with ERR_TIMEOUT
+HEARTBEAT_INTERVAL = 5.0
+IDLE_TIMEOUT = 30.0
+
+# token bucket per client for its requests, see ratelimit.py
+CLIENT_RATE = ratelimit.DEFAULT_CLIENT_RATE
+CLIENT_BURST = ratelimit.DEFAULT_CLIENT_BURST
+
+# seconds a disconnected client's writer gets to flush what's queued
+DISCONNECT_GRACE = 1.0
+
+# seconds a writer waits after being woken for more frames to write along
+# with the first, 0 writes whatever is queued straight away
+WRITE_DELAY = 0.0
+
+# frames the asyncio engine runs from one connection before letting the
+# writers (and everyone else) have the event loop, so one client's pipelined
+# burst doesn't pile up in its recipients' queues
+ASYNC_FRAME_BATCH = 64
+
+# message log segment size and fsync batching, see msglog.py
+LOG_SEGMENT_BYTES = msglog.DEFAULT_SEGMENT_BYTES
+LOG_FSYNC_BATCH = msglog.DEFAULT_FSYNC_BATCH
+LOG_FSYNC_INTERVAL = msglog.DEFAULT_FSYNC_INTERVAL
+
+# server engines selectable with --engine
+ENGINE_THREADED = 'threaded'
+ENGINE_ASYNCIO = 'asyncio'
+
+# connected clients and the usernames they hold, see registry.py
+registry = ClientRegistry()
+
+# names interned for binary connections, shared by every connection
+interner = Interner()
+
+# encodings a client can ask for in LOGIN
+codecs = {
+    JSON: JsonCodec(),
+    BINARY: BinaryCodec(interner),
+}
+
+# recent MESSAGE frames per room, replayed on JOIN_ROOM, see history.py
+history = RoomHistory()
+
+# durable log of MESSAGE and WHISPER traffic when running with --log-dir, see
+# msglog.py
+message_log = None
+
+# inbound requests are recorded here with --capture, see capture.py
+capture = None
+
+# request, traffic and fanout counters, see metrics.py
+metrics = Metrics()
+
+# token bucket per room for MESSAGE, and the connection admission limits
+room_limits = RoomLimits(ratelimit.DEFAULT_ROOM_RATE, ratelimit.DEFAULT_ROOM_BURST)
+admission = Admission()
+
+# handler profiling toggled with SIGUSR1, see profiler.py
+profiler = Profiler()
+PROFILE = False
+
+# connection to the other worker processes when running with --workers, see
+# cluster.py, or to peer servers when running with --link-port or --peer, see
+# federation.py
+bus = None
+
+# member counts and the LIST_ROOMS response, kept up to date by room_joined and
+# room_left, see directory.py
+directory = RoomDirectory()
 
 class Client():
     '''
     Represents a single connection to a client
     '''
 
+    # handler threads are preempted, they never need to yield
+    frame_batch = None
+
     def __init__(self, socket):
         self.socket = socket
         self.uuid = uuid.uuid1() # make UUID
         self.username = ' '
-        self.rooms = ['default']
+        self.rooms = set()
+        # when data was last received, see liveness.py
+        self.last_seen = monotonic()
+        # requests allowed before ERR_RATE_LIMITED
+        self.bucket = TokenBucket(CLIENT_RATE, CLIENT_BURST)
+        # frames waiting for this client's writer
+        self.outbound = OutboundQueue(QUEUE_SIZE, QUEUE_POLICY, totals=metrics.outbound)
+        # the encoder is only used by the writer, the decoder by the reader
+        self.encoding = JSON
+        self.encoder = codecs[JSON].new_encoder()
+        self.decoder = codecs[JSON].new_decoder()
+        # set once the connection negotiates compression, see compression.py
+        self.compression = None
+        self.compressor = None
+        self.decompressor = None
+        # something the asyncio engine waits on before running the client's
+        # later frames: a login waiting on the bus, or a turn for the writers
+        self.pending = None
+        # this connection's id in the capture file
+        self.capture_id = None
+
+    def send(self, frame, coalesce_key=None):
+        '''
+        Queues a Frame for the client's writer, never blocks on the socket
+        '''
+        if not self.outbound.put(frame, coalesce_key):
+            self.overflow()
 
+    def switch_encoding(self, name):
+        '''
+        Decodes everything after the current frame with the named codec and
+        returns a callback that switches the writer once it runs
+        '''
+        codec = codecs[name]
+        self.encoding = name
+        self.decoder = codec.new_decoder(self.decoder.remaining())
+        def switch_encoder():
+            self.encoder = codec.new_encoder()
+        return switch_encoder
 
-def broadcast_all(message):
+    def switch_compression(self, name):
+        '''
+        Decompresses everything after the current frame and returns a callback
+        that compresses the writer's output once it runs
+        '''
+        self.compression = name
+        self.decompressor = StreamDecompressor(totals=metrics.compressed_in)
+        rest = self.decoder.remaining()
+        self.decoder.reset()
+        self.decoder.feed(self.decompressor.decompress(rest))
+        def switch_compressor():
+            self.compressor = StreamCompressor(totals=metrics.compressed_out)
+        return switch_compressor
+
+    def buffers(self, frames):
+        '''
+        Encodes frames for this connection, switching encoders and compression
+        as requested. Returns the buffers to write
+        '''
+        out = []
+        # frames after compression is switched on, compressed in one go
+        compress = []
+        for frame in frames:
+            (compress if self.compressor else out).extend(self.encoder.chunks(frame))
+            if frame.after:
+                frame.after()
+        if compress:
+            out.append(self.compressor.compress(compress))
+        return out
+
+    def overflow(self):
+        '''
+        Called when the outbound queue fills under the disconnect policy
+        '''
+        print(f'Outbound queue full, disconnecting {self.username}')
+        self.disconnect()
+
+    def disconnect(self, op=OpCode.ERR_TIMEOUT):
+        '''
+        Sends op (ERR_TIMEOUT by default) after anything already queued and
+        drops the connection
+        '''
+        self.outbound.close(final=Frame({'op': op}))
+        # ends the read loop in handle, cleanup then shuts down the write side
+        # which also unblocks a writer stuck in sendall
+        try:
+            self.socket.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+
+    def close(self):
+        '''
+        Stops the writer once queued frames are written
+        '''
+        self.outbound.close()
+
+    def start_writer(self):
+        '''
+        Starts the thread draining the outbound queue
+        '''
+        self.writer_thread = Thread(target=self.write_loop, daemon=True)
+        self.writer_thread.start()
+
+    def write_loop(self):
+        '''
+        Writes queued frames to the socket until the queue is closed. Every
+        frame queued by the time the writer wakes (plus WRITE_DELAY) goes out
+        in one vectored write
+        '''
+        while (frames := self.outbound.get()) is not None:
+            if WRITE_DELAY:
+                sleep(WRITE_DELAY)
+                frames += self.outbound.drain() or []
+            try:
+                data = self.buffers(frames)
+                metrics.writes += send_vectored(self.socket, data)
+                metrics.bytes_out += sum(map(len, data))
+            except OSError:
+                self.outbound.close()
+                return
+
+
+class AsyncClient(Client):
     '''
-    calls broadcast on all clients in client_list
+    A client connection served by the asyncio engine. The writer is a task on
+    the event loop woken when frames are queued
     '''
-    for client in client_list:
-        broadcast(client, message)
 
-def broadcast_room(message, room):
+    # frames run before the event loop is yielded, see handle_frames
+    frame_batch = ASYNC_FRAME_BATCH
+
+    def __init__(self, writer):
+        super().__init__(writer.get_extra_info('socket'))
+        self.writer = writer
+        self.ready = asyncio.Event()
+        self.outbound.on_ready = self.ready.set
+
+    def disconnect(self, op=OpCode.ERR_TIMEOUT):
+        self.outbound.close(final=Frame({'op': op}))
+        # the writer closes the connection after the final frame, unless the
+        # client isn't reading at all
+        asyncio.get_running_loop().call_later(DISCONNECT_GRACE, self.writer.transport.abort)
+
+    def start_writer(self):
+        self.writer_task = asyncio.create_task(self.write_loop())
+
+    async def write_loop(self):
+        try:
+            while (frames := self.outbound.drain()) is not None:
+                if not frames:
+                    self.ready.clear()
+                    await self.ready.wait()
+                    # give more frames the latency budget to join this write
+                    if WRITE_DELAY:
+                        await asyncio.sleep(WRITE_DELAY)
+                    continue
+                data = self.buffers(frames)
+                self.writer.writelines(data)
+                metrics.writes += 1
+                metrics.bytes_out += sum(map(len, data))
+                # waits while the transport buffer is over its high water mark
+                await self.writer.drain()
+        except ConnectionError:
+            self.outbound.close()
+            return
+        # the queue only closes when the connection is ending
+        self.writer.close()
+
+
+def room_joined(room, client, created):
+    '''
+    Called by the room index as client joins room. Client.rooms holds the
+    reverse mapping (client -> set of room names)
+    '''
+    client.rooms.add(room)
+    directory.joined(room)
+    if created and bus:
+        bus.subscribe(room)
+
+def room_left(room, client, dropped):
     '''
-    Calls broadcast on all clients in a room
+    Called by the room index as client leaves room
     '''
-    for client in client_list:
-        if room in client.rooms:
-            broadcast(client, message)
+    client.rooms.discard(room)
+    directory.left(room)
+    if dropped:
+        room_limits.forget(room)
+        if bus:
+            bus.unsubscribe(room)
+
+def listed_name(client):
+    '''
+    The name LIST_USERS shows client under, None before it logs in
+    '''
+    return client.username if client.username != ' ' else None
+
+# room index: room name -> member clients, see registry.py
+rooms = RoomIndex(room_joined, room_left, listed_name)
+
+def add_to_room(client, room):
+    '''
+    Adds client to room in the room index. Returns False if already a member
+    '''
+    return rooms.add(room, client)
+
+def remove_from_room(client, room):
+    '''
+    Removes client from room in the room index. Returns False if not a member.
+    Rooms are dropped from the index once their last member leaves
+    '''
+    return rooms.remove(room, client)
+
+def remove_from_all_rooms(client):
+    '''
+    Removes client from every room it is a member of
+    '''
+    for room in list(client.rooms):
+        remove_from_room(client, room)
+
+
+def broadcast_all(message, relay=True):
+    '''
+    calls broadcast on all connected clients, and on other workers' clients
+    unless relay is False
+    '''
+    frame, coalesce_key = encode_message(message)
+    for client in registry.connected:
+        client.send(frame, coalesce_key)
+    if relay and bus:
+        bus.publish_all(message)
+
+def broadcast_room(message, room, relay=True):
+    '''
+    Calls broadcast on all clients in a room, including members connected to
+    other workers unless relay is False
+    '''
+    frame, coalesce_key = encode_message(message)
+    # a snapshot, joins and leaves invalidate it rather than change it
+    members = rooms.members(room)
+    for client in members:
+        client.send(frame, coalesce_key)
+    metrics.fanout.observe(len(members))
+    if profiler.enabled:
+        profiler.fanout(len(members))
+    if relay and bus:
+        bus.publish_room(room, message)
+    return frame
 
 def broadcast(client, message):
     '''
     Sends an encoded JSON message to specified client
     '''
-    message = json.dumps(message).encode()
-    client.socket.sendall(message)
+    client.send(*encode_message(message))
+
+def encode_message(message):
+    '''
+    Wraps a message in a Frame shared by every recipient's outbound queue, it
+    is encoded once per wire encoding in use no matter how many recipients
+    '''
+    coalesce_key = message['op'] if message['op'] in COALESCE_OPS else None
+    return Frame(message), coalesce_key
+
+
+def send_heart_beat(client):
+    '''
+    Sends a heart_beat message to a client that has been quiet, clients answer
+    with a heart_beat of their own
+    '''
+    message = {
+        'op': OpCode.HEART_BEAT,
+    }
+    broadcast(client, message)
 
+def time_out(client):
+    '''
+    Disconnects a client that didn't answer heart_beats
+    '''
+    print(f'Client {client.username} timed out')
+    client.disconnect()
 
 def heart_beat():
     '''
-    Sends a heart_beat message to all connected clients every second
+    Runs the liveness monitor, only idle clients are sent heart_beats
     '''
     while True:
-        sleep(1)
-        print("Bump bump")
+        sleep(liveness.tick_interval)
+        liveness.tick()
+
+
+def register_client(client):
+    '''
+    Adds a newly connected client to the client list and the default room
+    '''
+    registry.add(client)
+    if capture:
+        client.capture_id = capture.connected()
+    add_to_room(client, 'default')
+    client.start_writer()
+    liveness.add(client)
+
+def unregister_client(client):
+    '''
+    cleans up when client disconnects
+    '''
+    # unregister first so the exit broadcast doesn't try to write to the
+    # closed socket
+    liveness.remove(client)
+    remove_from_all_rooms(client)
+    registry.remove(client)
+    admission.release()
+    client.close()
+    if capture:
+        capture.disconnected(client.capture_id)
+    if client.username != ' ':
+        registry.release(client.username, client)
+        if bus:
+            bus.release(client.username)
+    exit_app({}, client)
+
+def receive(client):
+    '''
+    Reads from the client's socket and runs every complete frame, returns
+    False once the client closes the connection. Data is read straight into
+    the decoder's buffer and frames are decoded from there (see framing.py),
+    compressed data is read into a new bytes object as decompressing it
+    makes one anyway
+    '''
+    if client.decompressor:
+        data = client.socket.recv(RECV_SIZE)
+        if data:
+            handle_data(data, client)
+        return bool(data)
+    received = client.decoder.recv_into(client.socket)
+    if received:
+        client.last_seen = monotonic()
+        metrics.bytes_in += received
+        try:
+            handle_frames(client)
+        except (FrameTooLarge, DecodeError) as e:
+            malformed(client, e)
+    return bool(received)
+
+def handle_data(data, client):
+    '''
+    Feeds received bytes to the connection's decoder and runs every complete
+    frame
+    '''
+    client.last_seen = monotonic()
+    metrics.bytes_in += len(data)
+    try:
+        if client.decompressor:
+            data = client.decompressor.decompress(data)
+        client.decoder.feed(data)
+        handle_frames(client)
+    except (FrameTooLarge, DecodeError) as e:
+        malformed(client, e)
+
+def handle_frames(client):
+    '''
+    Runs every complete frame buffered in the connection's decoder, a single
+    read may hold several pipelined frames
+    '''
+    # a command may switch client.decoder, so look it up for every frame
+    handled = 0
+    while not client.pending and (frame := client.decoder.next_frame()) is not None:
+        handle_frame(frame, client)
+        handled += 1
+        if handled == client.frame_batch and not client.pending:
+            # the rest run once the writers had a turn
+            client.pending = asyncio.sleep(0)
+
+def malformed(client, error=None):
+    if client.outbound.closed:
+        # already on its way out
+        return
+    print('MALFORMED FRAME')
+    if isinstance(error, FrameTooLarge) and not client.decoder.resyncs:
+        # a length prefixed stream has no delimiter to find the next frame by
+        client.disconnect(OpCode.ERR_MALFORMED)
+        return
+    message = {
+        'op': OpCode.ERR_MALFORMED
+    }
+    broadcast(client, message)
+
+def handle_frame(frame, client):
+    '''
+    Decodes a single frame and runs its command
+    '''
+    try:
+        data = client.decoder.decode(frame)
+    except (JSONDecodeError, DecodeError):
+        print('ILLEGAL OPERATION:')
+        print(bytes(frame))
+        message = {
+            'op': OpCode.ERR_ILLEGAL_OP
+        }
+        broadcast(client, message)
+        return
+    if capture:
+        capture.request(client.capture_id, data)
+    limit = rate_limit(data, client)
+    if limit:
+        metrics.refuse(limit)
         message = {
-            'op': OpCode.HEART_BEAT,
+            'op': OpCode.ERR_RATE_LIMITED,
+            'limit': limit,
         }
-        broadcast_all(message)
+        broadcast(client, message)
+        return
+    command = COMMANDS[data['op']]
+    start = perf_counter()
+    if profiler.enabled:
+        profiler.call(command, data, client, len(frame))
+    else:
+        command(data, client)
+    metrics.observe_request(data['op'], perf_counter() - start)
+
+def rate_limit(payload, client):
+    '''
+    Returns the name of the limit a request breaks, or None if it may be
+    handled. Heartbeats are never limited, they keep the connection alive
+    '''
+    op = payload['op']
+    if op == OpCode.HEART_BEAT:
+        return None
+    if not client.bucket.take():
+        return ratelimit.CLIENT
+    if op == OpCode.MESSAGE and not room_limits.take(payload.get('room')):
+        return ratelimit.ROOM
+    return None
+
+def check_admission():
+    '''
+    Returns None if a new connection may be registered, otherwise the encoded
+    error to send it before it is closed. Admitted connections are released
+    in unregister_client
+    '''
+    limit = admission.admit()
+    if limit is None:
+        return None
+    metrics.refuse(limit)
+    return codecs[JSON].encode({'op': OpCode.ERR_RATE_LIMITED, 'limit': limit})[0]
 
-    
 
 class IrcRequestHandler(socketserver.BaseRequestHandler):
 
@@ -75,110 +580,227 @@ class IrcRequestHandler(socketserver.BaseRequestHandler):
         print('handle called, pid: ', os.getpid())
         # add client to client list
         self.client = Client(self.request)
-        client_list.append(self.client)
+        register_client(self.client)
         # listen loop
-        while data := self.request.recv(1024):
-            try:
-                data = json.loads(data.strip().decode())
-                COMMANDS[data['op']](data, self.client)
-            except JSONDecodeError:
-                print('ILLEGAL OPERATION:')
-                print(data)
-                message = {
-                    'op': OpCode.ERR_ILLEGAL_OP
-                }
-                broadcast(self.client, message)
-            
+        while receive(self.client):
+            pass
 
     # called whenwhen client disconnects
     def finish(self):
         '''
         cleans up when client disconnects
         '''
-        exit_app({},self.client)
-        client_list.remove(self.client)
-    
+        unregister_client(self.client)
+        # let the writer flush before socketserver closes the socket
+        self.client.writer_thread.join(DISCONNECT_GRACE)
+
+
+class IrcServer(socketserver.ThreadingTCPServer):
+    '''
+    Threaded engine, one thread per client connection
+    '''
+    # socket would fail when previous run was killed if we didn't reuse address
+    allow_reuse_address = True
+    daemon_threads = True
+    # the socketserver default of 5 drops connection bursts, same as asyncio
+    request_queue_size = 1024
+
+    def verify_request(self, request, client_address):
+        '''
+        Admission control, refused connections are told why and closed
+        '''
+        refusal = check_admission()
+        if refusal:
+            try:
+                request.sendall(refusal)
+            except OSError:
+                pass
+            return False
+        return True
+
+
+class ShardedIrcServer(IrcServer):
+    '''
+    Threaded engine for a worker process, every worker binds the same port
+    and the kernel spreads connections across them
+    '''
+
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
+async def handle_async_connection(reader, writer):
+    '''
+    asyncio engine equivalent of IrcRequestHandler, runs for the lifetime of a
+    single client connection
+    '''
+    refusal = check_admission()
+    if refusal:
+        writer.write(refusal)
+        writer.close()
+        return
+    client = AsyncClient(writer)
+    register_client(client)
+    try:
+        while data := await reader.read(RECV_SIZE):
+            handle_data(data, client)
+            while client.pending:
+                pending, client.pending = client.pending, None
+                await pending
+                try:
+                    handle_frames(client)
+                except (FrameTooLarge, DecodeError) as e:
+                    malformed(client, e)
+    except ConnectionError:
+        pass
+    finally:
+        unregister_client(client)
+        writer.close()
+
+async def async_heart_beat():
+    '''
+    asyncio engine equivalent of heart_beat
+    '''
+    while True:
+        await asyncio.sleep(liveness.tick_interval)
+        liveness.tick()
+
 def login(payload, client):
     '''
     Handles clients login by checking for acceptable name and sends back a message
     '''
 
     print(f"Logging in User {payload['username']}")
-    # if payload['username'] in client_list.username:
-    if payload['username'] in [c.username for c in client_list]:
+    if '.' in payload['username']:
         message = {
-            'op': OpCode.ERR_NAME_EXISTS,
+            'op': OpCode.ERR_ILLEGAL_NAME,
             'user': payload['username']
         }
         broadcast(client, message)
         return
-    elif '.' in payload['username']:
+
+    if len(payload['username']) > 32 or len(payload['username']) < 1:
         message = {
-            'op': OpCode.ERR_ILLEGAL_NAME,
+            'op': OpCode.ERR_ILLEGAL_LEN,
             'user': payload['username']
         }
         broadcast(client, message)
         return
 
-    if len(payload['username']) > 32 or len(payload['username']) < 1:
+    # checking and taking the name is one step, two clients racing for the
+    # same name can't both get it
+    if not registry.claim(payload['username'], client):
         message = {
-            'op': OpCode.ERR_ILLEGAL_LEN,
+            'op': OpCode.ERR_NAME_EXISTS,
             'user': payload['username']
         }
         broadcast(client, message)
         return
 
+    # names are also unique across all workers or linked servers. The asyncio
+    # engine waits for the answer on its loop, a handler thread just blocks
+    if bus:
+        if isinstance(client, AsyncClient):
+            client.pending = claim_async(payload, client)
+            return
+        if not bus_claimed(payload, client, bus.claim(payload['username'])):
+            return
+    accept_login(payload, client)
+
+async def claim_async(payload, client):
+    claimed = await bus.claim_async(payload['username'])
+    if bus_claimed(payload, client, claimed):
+        accept_login(payload, client)
+
+def bus_claimed(payload, client, claimed):
+    '''
+    Gives the name back and tells the client if the bus refused it, claimed
+    is None if the bus didn't answer in time
+    '''
+    if claimed:
+        return True
+    registry.release(payload['username'], client)
+    message = {
+        'op': OpCode.ERR_NAME_EXISTS if claimed is False else OpCode.ERR_TIMEOUT,
+        'user': payload['username']
+    }
+    broadcast(client, message)
+    return False
+
+def accept_login(payload, client):
+    '''
+    Switches the client to its claimed name and sends the LOGIN response
+    '''
+    old = listed_name(client)
     client.username = payload['username']
+    # relisted in its rooms while the old name still can't be taken
+    rooms.rename(client, list(client.rooms), old, client.username)
+    if old is not None:
+        registry.release(old, client)
+        if bus:
+            bus.release(old)
     message = {
         'op': OpCode.LOGIN,
         'username':payload['username']
     }
-    broadcast(client, message)
+    # optional encoding and compression switches, the response itself uses
+    # the current ones
+    switches = []
+    if 'encoding' in payload:
+        encoding = payload['encoding'] if payload['encoding'] in codecs else JSON
+        message['encoding'] = encoding
+        if encoding != client.encoding:
+            switches.append(client.switch_encoding(encoding))
+    if 'compression' in payload:
+        # once on, compression stays on for the rest of the connection
+        if payload['compression'] in COMPRESSIONS and not client.compression:
+            switches.append(client.switch_compression(payload['compression']))
+        message['compression'] = client.compression
+    def after():
+        for switch in switches:
+            switch()
+    client.send(Frame(message, after=after if switches else None))
     return
 
 def list_rooms(payload, client):
     '''
-    List all rooms unless containing a . if so it checks if username contained within.
+    Lists public rooms and the private rooms the user is part of, with member
+    counts
     '''
-    rooms = []
-    for c in client_list:
-        for room in c.rooms:
-            rooms += [room]
-
-    rooms = list(set(rooms))
-
-    for room in rooms:
-        if '.' in room:
-            if client.username not in room:
-                rooms.remove(room)
-
-    message = {
-        'op': OpCode.LIST_ROOMS,
-        'rooms': rooms,
-    }
-    broadcast(client, message)
+    client.send(directory.list_rooms(client.username))
     return
 
 def list_users(payload, client):
     '''
-    lists all users. can be used in specified room
+    Lists users in name order, everyone logged in or the members of a room.
+    Names can be filtered by prefix and start after a cursor, the listing is
+    sent as LIST_USERS frames of up to PAGE_SIZE names, see users.py
     '''
-    users = []
-    print(payload)
-    if payload['room'] == '':
-        for c in client_list:
-            users += [c.username]
+    prefix = payload.get('prefix', '')
+    cursor = payload.get('cursor')
+    limit = payload.get('limit', PAGE_LIMIT)
+    if not isinstance(limit, int) or not 0 < limit <= PAGE_LIMIT:
+        limit = PAGE_LIMIT
+    room = payload.get('room', '')
+    # one extra name says whether the limit cut the listing short
+    if room == '':
+        names = registry.names.page(prefix, cursor, limit + 1)
     else:
-        for c in client_list:
-            if payload['room'] in c.rooms:
-                users += [c.username]
+        names = rooms.page(room, prefix, cursor, limit + 1)
+    truncated = len(names) > limit
+    names = names[:limit]
 
-    message = {
-        'op': OpCode.LIST_USERS,
-        'users': users,
-    }
-
-    broadcast(client, message)
+    pages = user_pages.pages(names)
+    for i, page in enumerate(pages):
+        message = {
+            'op': OpCode.LIST_USERS,
+            'users': page,
+            'more': i < len(pages) - 1,
+        }
+        if truncated and not message['more']:
+            message['cursor'] = names[-1]
+        client.send(Frame(message))
     return
 
 def join_room(payload, client):
@@ -186,10 +808,7 @@ def join_room(payload, client):
     Adds room to clients list of rooms
     '''
     print(f'{payload["user"]} joined room {payload["room"]}')
-    newroom = False
-    if payload['room'] not in client.rooms:
-        client.rooms += [payload['room']]
-        newroom = True
+    newroom = add_to_room(client, payload['room'])
 
     message = {
         'op': OpCode.JOIN_ROOM,
@@ -199,6 +818,12 @@ def join_room(payload, client):
     }
 
     broadcast_room(message,payload['room'])
+
+    # optionally catch the client up on what was said before it joined
+    count = payload.get('history', 0)
+    if isinstance(count, int):
+        for frame in history.recent(payload['room'], count):
+            client.send(frame)
     
     return
 
@@ -213,7 +838,7 @@ def leave_room(payload, client):
         }
         broadcast(client,message)
         return
-    client.rooms.remove(payload['room'])
+    remove_from_room(client, payload['room'])
     message = {
         'op': OpCode.LEAVE_ROOM,
         'user': payload['user'],
@@ -232,9 +857,21 @@ def message(payload, client):
         'room': payload['room'],
         'message': payload['message'],
     }
-    broadcast_room(message, payload['room'])
+    frame = broadcast_room(message, payload['room'])
+    history.append(payload['room'], frame)
+    if message_log:
+        log_message(payload['room'], message)
     return
 
+def log_message(room, message):
+    '''
+    Appends a message to the message log, one it can't hold is only reported
+    '''
+    try:
+        message_log.append(room, message)
+    except ValueError as e:
+        print(f'Not logging message: {e}')
+
 def whisper(payload, client):
     '''
     Makes sure user doesn't whisper self.
@@ -259,8 +896,7 @@ def whisper(payload, client):
     if room_name_swapped in client.rooms:
         room_name = room_name_swapped
 
-    if room_name not in client.rooms:
-        client.rooms += [room_name]
+    add_to_room(client, room_name)
 
     message = {
         'op': OpCode.WHISPER,
@@ -269,13 +905,16 @@ def whisper(payload, client):
         'room': room_name,
         'message': payload['message'],
     }
+    if message_log:
+        log_message(room_name, message)
     broadcast(client, message)
-    matching = [c for c in client_list if c.username == payload['target']]
-    if len(matching) > 0:
-        reciever = matching[0]
-        if room_name not in reciever.rooms:
-            reciever.rooms += [room_name]
+    reciever = registry.find(payload['target'])
+    if reciever:
+        add_to_room(reciever, room_name)
         broadcast( reciever,message)
+    elif bus:
+        # target may be connected to another worker
+        bus.publish_whisper(payload['target'], room_name, message)
 
     return
 
@@ -290,6 +929,12 @@ def exit_app(payload, client):
     broadcast_all(message)
     return
 
+def heart_beat_ack(payload, client):
+    '''
+    A client answering a heart_beat, receiving it already updated last_seen
+    '''
+    return
+
 def help_cmd(payload, client):
     '''
     return help opcode
@@ -310,13 +955,256 @@ COMMANDS = {
     OpCode.MESSAGE:message,
     OpCode.USER_EXIT:exit_app,
     OpCode.WHISPER:whisper,
+    OpCode.HEART_BEAT:heart_beat_ack,
     }
 
-if __name__ == '__main__':
-    with socketserver.ThreadingTCPServer(SERVER_ADDRESS, IrcRequestHandler) as server:
+liveness = LivenessMonitor(HEARTBEAT_INTERVAL, IDLE_TIMEOUT, send_heart_beat, time_out)
+
+def collect_metrics():
+    '''
+    Registers the metrics read from server state when rendered
+    '''
+    metrics.collect('irc_connected_clients', 'gauge', 'Connected clients',
+        lambda: len(registry))
+    metrics.collect('irc_rooms', 'gauge', 'Rooms with local members',
+        lambda: len(rooms))
+    metrics.collect('irc_outbound_queued_frames', 'gauge',
+        'Frames waiting in outbound queues over every client',
+        lambda: sum(len(c.outbound) for c in registry.connected))
+    metrics.collect('irc_outbound_max_depth', 'gauge',
+        'Frames waiting in the fullest outbound queue',
+        lambda: max((len(c.outbound) for c in registry.connected), default=0))
+    metrics.collect('irc_outbound_high_water', 'gauge',
+        'Most frames any connected client\'s outbound queue has held',
+        lambda: max((c.outbound.high_water for c in registry.connected), default=0))
+    metrics.collect('irc_heartbeats_total', 'counter', 'Heartbeats sent to idle clients',
+        lambda: liveness.heartbeats)
+    metrics.collect('irc_timeouts_total', 'counter', 'Clients disconnected for not responding',
+        lambda: liveness.timeouts)
+
+collect_metrics()
+
+def raise_fd_limit():
+    '''
+    Raises the open file limit as far as allowed so the asyncio engine can hold
+    many idle connections
+    '''
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
 
-        # socket would fail when previous run was killed if we didn't reuse address
-        server.allow_reuse_address = True
-        thread = Thread(target=heart_beat, name='thread-1')
+def handle_bus_event(event):
+    '''
+    Delivers an event published by another worker to local clients
+    '''
+    kind = event['type']
+    if kind == 'room':
+        frame = broadcast_room(event['message'], event['room'], relay=False)
+        if event['message']['op'] == OpCode.MESSAGE:
+            history.append(event['room'], frame)
+    elif kind == 'all':
+        broadcast_all(event['message'], relay=False)
+    elif kind == 'whisper':
+        reciever = registry.find(event['target'])
+        if reciever:
+            add_to_room(reciever, event['room'])
+            broadcast(reciever, event['message'])
+
+def install_profiler_signal():
+    '''
+    Makes SIGUSR1 toggle handler profiling, where the platform has it. Runs in
+    the serving process, after any fork, so the sampler thread lives there
+    '''
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, profiler.toggle)
+    if PROFILE:
+        profiler.start()
+
+def serve_threaded(address, reuse_port=False):
+    '''
+    Runs the server with one thread per connection
+    '''
+    install_profiler_signal()
+    server_class = ShardedIrcServer if reuse_port else IrcServer
+    with server_class(address, IrcRequestHandler) as server:
+        thread = Thread(target=heart_beat, name='thread-1', daemon=True)
         thread.start()
-        server.serve_forever()
\ No newline at end of file
+        server.serve_forever()
+
+async def serve_async(address, reuse_port=False, stop_signals=()):
+    '''
+    Runs the server on a single asyncio event loop, until one of stop_signals
+    arrives
+    '''
+    raise_fd_limit()
+    install_profiler_signal()
+    loop = asyncio.get_running_loop()
+    if bus:
+        # bus events arrive on the bus reader thread
+        bus.deliver = loop.call_soon_threadsafe
+    stop = asyncio.Event()
+    for signum in stop_signals:
+        loop.add_signal_handler(signum, stop.set)
+    server = await asyncio.start_server(
+        handle_async_connection, *address, reuse_address=True,
+        reuse_port=reuse_port, backlog=1024)
+    heart_beat_task = asyncio.create_task(async_heart_beat())
+    async with server:
+        await stop.wait()
+
+def serve_worker(bus_path, index, engine, address, log_dir=None, metrics_port=None,
+        capture_path=None):
+    '''
+    Runs worker index of a --workers cluster. Each worker logs the messages
+    its own clients send to log_dir/worker-index, serves its own metrics on
+    metrics_port + index, and captures its own connections to
+    capture_path.worker-index
+    '''
+    global bus, message_log, capture
+    bus = BusClient(bus_path, handle_bus_event)
+    if log_dir:
+        message_log = open_message_log(os.path.join(log_dir, f'worker-{index}'))
+    if capture_path:
+        capture = Capture(f'{capture_path}.worker-{index}')
+    if metrics_port:
+        serve_metrics(metrics, (address[0], metrics_port + index))
+    # stop like on SIGINT so the log is flushed, the asyncio engine stops its
+    # loop instead of unwinding it with KeyboardInterrupt
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        if engine == ENGINE_ASYNCIO:
+            asyncio.run(serve_async(address, reuse_port=True,
+                stop_signals=(signal.SIGINT, signal.SIGTERM)))
+        else:
+            serve_threaded(address, reuse_port=True)
+    finally:
+        # a second SIGINT (^C reaches every worker) or SIGTERM (from the
+        # parent) mustn't cut the flush short
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        if message_log:
+            message_log.close()
+        if capture:
+            capture.close()
+
+def open_message_log(directory):
+    return MessageLog(directory, LOG_SEGMENT_BYTES, LOG_FSYNC_BATCH, LOG_FSYNC_INTERVAL)
+
+def parse_args(argv=None):
+    '''
+    Parses command line arguments
+    '''
+    parser = argparse.ArgumentParser(description='IRC server')
+    parser.add_argument('port', nargs='?', type=int, default=PORT,
+        help='port to listen on (default %(default)s)')
+    parser.add_argument('--engine', choices=[ENGINE_THREADED, ENGINE_ASYNCIO],
+        default=ENGINE_THREADED,
+        help='threaded: one thread per connection, asyncio: single event loop (default %(default)s)')
+    parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE,
+        help='frames buffered per client before the overflow policy applies (default %(default)s)')
+    parser.add_argument('--queue-policy', choices=outbound.POLICIES, default=QUEUE_POLICY,
+        help='what to do when a client\'s outbound queue is full (default %(default)s)')
+    parser.add_argument('--write-delay-ms', type=float, default=WRITE_DELAY * 1000,
+        help='milliseconds a writer waits to batch more frames into one write (default %(default)s)')
+    parser.add_argument('--client-rate', type=float, default=CLIENT_RATE,
+        help='requests per second per client, 0 for no limit (default %(default)s)')
+    parser.add_argument('--client-burst', type=int, default=CLIENT_BURST,
+        help='requests a client may send in a burst (default %(default)s)')
+    parser.add_argument('--room-rate', type=float, default=ratelimit.DEFAULT_ROOM_RATE,
+        help='messages per second per room, 0 for no limit (default %(default)s)')
+    parser.add_argument('--room-burst', type=int, default=ratelimit.DEFAULT_ROOM_BURST,
+        help='messages a room may take in a burst (default %(default)s)')
+    parser.add_argument('--max-connections', type=int, default=ratelimit.DEFAULT_MAX_CONNECTIONS,
+        help='connected clients before new connections are refused, 0 for no cap (default %(default)s)')
+    parser.add_argument('--accept-rate', type=float, default=ratelimit.DEFAULT_ACCEPT_RATE,
+        help='new connections per second, 0 for no limit (default %(default)s)')
+    parser.add_argument('--accept-burst', type=int, default=ratelimit.DEFAULT_ACCEPT_BURST,
+        help='new connections accepted in a burst (default %(default)s)')
+    parser.add_argument('--heartbeat-interval', type=float, default=HEARTBEAT_INTERVAL,
+        help='seconds of silence before a client is sent a heartbeat (default %(default)s)')
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+        help='seconds of silence before a client is disconnected (default %(default)s)')
+    parser.add_argument('--history-size', type=int, default=room_history.DEFAULT_MESSAGES,
+        help='messages kept per room for replay on join, 0 disables (default %(default)s)')
+    parser.add_argument('--history-bytes', type=int, default=room_history.DEFAULT_BYTES,
+        help='encoded bytes kept per room for replay on join (default %(default)s)')
+    parser.add_argument('--workers', type=int, default=1,
+        help='worker processes sharing the port, more than 1 runs a cluster (default %(default)s)')
+    parser.add_argument('--log-dir',
+        help='append MESSAGE and WHISPER traffic to a message log in this directory')
+    parser.add_argument('--log-segment-bytes', type=int, default=LOG_SEGMENT_BYTES,
+        help='size a message log segment grows to before a new one is started (default %(default)s)')
+    parser.add_argument('--log-fsync-batch', type=int, default=LOG_FSYNC_BATCH,
+        help='logged messages pending before they are fsynced (default %(default)s)')
+    parser.add_argument('--log-fsync-interval', type=float, default=LOG_FSYNC_INTERVAL,
+        help='most seconds a logged message waits to be fsynced (default %(default)s)')
+    parser.add_argument('--capture', metavar='FILE',
+        help='record every request to FILE for benchmarks/replay.py, workers use FILE.worker-n')
+    parser.add_argument('--profile', action='store_true',
+        help='start with handler profiling on, SIGUSR1 toggles it and writes the report')
+    parser.add_argument('--profile-dir', default='.',
+        help='directory profiling reports are written to (default %(default)s)')
+    parser.add_argument('--slow-call-ms', type=float,
+        default=handler_profiler.DEFAULT_SLOW_CALL * 1000,
+        help='handler calls slower than this are recorded while profiling (default %(default)s)')
+    parser.add_argument('--metrics-port', type=int,
+        help='serve Prometheus metrics at http://localhost:PORT/metrics, workers use PORT + n')
+    parser.add_argument('--link-port', type=int,
+        help='listen for links from peer servers on this port')
+    parser.add_argument('--link-host', default=SERVER_ADDRESS[0],
+        help='address to listen for peer links on (default %(default)s)')
+    parser.add_argument('--peer', action='append', default=[], type=parse_address,
+        metavar='HOST:PORT', help='link to the peer server at HOST:PORT, may be repeated')
+    args = parser.parse_args(argv)
+    if args.workers > 1 and (args.link_port or args.peer):
+        parser.error('--workers can\'t be combined with --link-port or --peer')
+    return args
+
+if __name__ == '__main__':
+    args = parse_args()
+    address = SERVER_ADDRESS[0], args.port
+    QUEUE_SIZE = args.queue_size
+    QUEUE_POLICY = args.queue_policy
+    WRITE_DELAY = args.write_delay_ms / 1000
+    CLIENT_RATE = args.client_rate
+    CLIENT_BURST = args.client_burst
+    room_limits = RoomLimits(args.room_rate, args.room_burst)
+    admission = Admission(args.max_connections, args.accept_rate, args.accept_burst)
+    liveness = LivenessMonitor(
+        args.heartbeat_interval, args.idle_timeout, send_heart_beat, time_out)
+    history = RoomHistory(args.history_size, args.history_bytes)
+    profiler = Profiler(args.profile_dir, slow_call=args.slow_call_ms / 1000)
+    PROFILE = args.profile
+    LOG_SEGMENT_BYTES = args.log_segment_bytes
+    LOG_FSYNC_BATCH = args.log_fsync_batch
+    LOG_FSYNC_INTERVAL = args.log_fsync_interval
+    if args.workers > 1:
+        run_cluster(args.workers, lambda path, index: serve_worker(
+            path, index, args.engine, address, args.log_dir, args.metrics_port,
+            args.capture))
+    else:
+        if args.log_dir:
+            message_log = open_message_log(args.log_dir)
+        if args.metrics_port:
+            serve_metrics(metrics, (address[0], args.metrics_port))
+        if args.capture:
+            capture = Capture(args.capture)
+        if args.link_port or args.peer:
+            link_address = (args.link_host, args.link_port) if args.link_port else None
+            bus = FederationLink(handle_bus_event, link_address, args.peer)
+        try:
+            if args.engine == ENGINE_ASYNCIO:
+                asyncio.run(serve_async(address))
+            else:
+                serve_threaded(address)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if message_log:
+                message_log.close()
+            if capture:
+                capture.close()
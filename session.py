@@ -0,0 +1,160 @@
+'''
+Client side of the LOGIN handshake, and a blocking client connection.
+
+aio_client.py and tui.py share the handshake helpers. Session is what
+`client.py send` uses: a plain socket that batches requests like
+aio_client's ChatClient but doesn't need asyncio, which is the slowest
+import of a short lived script.
+'''
+
+import socket
+
+from opcodes import OpCode
+from framing import RECV_SIZE
+from codec import JsonCodec, BinaryCodec, BINARY
+from compression import StreamCompressor, StreamDecompressor, ZLIB
+
+# LOGIN error responses and what they mean
+LOGIN_ERRORS = {
+    OpCode.ERR_NAME_EXISTS: 'Username already exists',
+    OpCode.ERR_ILLEGAL_NAME: 'Username is illegal',
+    OpCode.ERR_ILLEGAL_LEN: 'Username has illegal length',
+    OpCode.ERR_RATE_LIMITED: 'Server is busy, try again',
+    OpCode.ERR_TIMEOUT: 'Server timed out checking the name, try again',
+}
+
+
+class LoginError(Exception):
+    '''
+    The server refused a LOGIN, response is the error it sent
+    '''
+
+    def __init__(self, response):
+        self.response = response
+        super().__init__(LOGIN_ERRORS.get(response['op'], f'Unexpected response {response}'))
+
+
+def login_request(username, encoding=None, compression=None):
+    '''
+    Returns a LOGIN request, optionally asking for an encoding and compression
+    '''
+    payload = {
+        'op': OpCode.LOGIN,
+        'username': username,
+    }
+    if encoding:
+        payload['encoding'] = encoding
+    if compression:
+        payload['compression'] = compression
+    return payload
+
+def accept_login(response, decoder):
+    '''
+    Switches to what a LOGIN response agreed to. Returns the codec, decoder,
+    compressor and decompressor for everything after the response, frames
+    already buffered in decoder are carried over
+    '''
+    codec = JsonCodec()
+    if response.get('encoding') == BINARY:
+        codec = BinaryCodec()
+        decoder = codec.new_decoder(decoder.remaining())
+    compressor = decompressor = None
+    if response.get('compression') == ZLIB:
+        compressor = StreamCompressor()
+        decompressor = StreamDecompressor()
+        rest = decoder.remaining()
+        decoder.reset()
+        decoder.feed(decompressor.decompress(rest))
+    return codec, decoder, compressor, decompressor
+
+
+class Session:
+    '''
+    A blocking connection to the server. Requests are queued and written
+    together by flush, next_event flushes before it waits
+    '''
+
+    def __init__(self, address, timeout=None):
+        self.socket = socket.create_connection(address, timeout)
+        self.username = None
+        self.codec = JsonCodec()
+        self.decoder = self.codec.new_decoder()
+        self.compressor = None
+        self.decompressor = None
+        # encoded requests waiting for the next flush
+        self.pending = []
+
+    def login(self, username, encoding=None, compression=None):
+        '''
+        Logs in and returns the LOGIN response, raises LoginError if the
+        server refuses the name
+        '''
+        self.request(login_request(username, encoding, compression))
+        while True:
+            response = self.next_event()
+            if response is None:
+                raise ConnectionResetError('Server closed the connection')
+            if response['op'] == OpCode.LOGIN:
+                break
+            if response['op'] in LOGIN_ERRORS:
+                raise LoginError(response)
+        self.codec, self.decoder, self.compressor, self.decompressor = (
+            accept_login(response, self.decoder))
+        self.username = response['username']
+        return response
+
+    def request(self, payload):
+        self.pending.append(self.codec.encode(payload)[0])
+
+    def flush(self):
+        '''
+        Writes every queued request
+        '''
+        if not self.pending:
+            return
+        chunks, self.pending = self.pending, []
+        if self.compressor:
+            self.socket.sendall(self.compressor.compress(chunks))
+        else:
+            self.socket.sendall(b''.join(chunks))
+
+    def next_event(self):
+        '''
+        Returns the next message from the server, or None once it closes the
+        connection
+        '''
+        while True:
+            frame = self.decoder.next_frame()
+            if frame is None:
+                self.flush()
+                if not self.receive():
+                    return None
+                continue
+            event = self.decoder.decode(frame)
+            # answer heartbeats so the server knows we're alive
+            if event['op'] == OpCode.HEART_BEAT:
+                self.request({'op': OpCode.HEART_BEAT})
+                continue
+            return event
+
+    def receive(self):
+        '''
+        Reads from the socket into the decoder, straight into its buffer
+        unless the connection is compressed. Returns False once the server
+        closes the connection
+        '''
+        if not self.decompressor:
+            return self.decoder.recv_into(self.socket) > 0
+        data = self.socket.recv(RECV_SIZE)
+        if data:
+            self.decoder.feed(self.decompressor.decompress(data))
+        return bool(data)
+
+    def close(self):
+        '''
+        Writes queued requests and closes the connection
+        '''
+        try:
+            self.flush()
+        finally:
+            self.socket.close()
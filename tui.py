@@ -0,0 +1,875 @@
+'''
+The chat client's terminal UI, imported by client.py only when it's needed
+since urwid takes a while to import
+'''
+
+from json.decoder import JSONDecodeError
+import os
+import socket
+import select
+from time import sleep, monotonic
+import json
+import urwid
+from collections import OrderedDict
+from threading import Thread, Lock
+
+from opcodes import OpCode
+from framing import RECV_SIZE
+from codec import JsonCodec, DecodeError
+from session import LOGIN_ERRORS, login_request, accept_login
+from scrollback import Scrollback, DEFAULT_LINES
+
+WELCOME_MSG = "Welcome to IRC!"
+TIMEOUT_TIME = 5.0
+socket.setdefaulttimeout(TIMEOUT_TIME)
+
+# most screen redraws per second, incoming lines in between are drawn together
+FRAME_RATE = 30
+# Text widgets kept around per room, only lines on screen need one
+WIDGET_CACHE = 256
+
+# set by run_client from the command line, see client.py
+SERVER_ADDRESS = 'localhost', 8000
+# requested wire encoding and stream compression, None for JSON and none
+ENCODING = None
+COMPRESSION = None
+# scrollback lines kept in memory per room, and where older ones spill to
+SCROLLBACK_LINES = DEFAULT_LINES
+SPILL_DIR = None
+
+# prints on exit. may be modified by program state
+exit_msg = 'Exited'
+
+# prints when /help is invoked
+HELP_MSG = '''
+HELP
+
+COMMANDS
+
+Commands are prefixed with '/', which must be the first character of the input text.
+
+/login [username] - Login with [username]
+/whisper [username] [message] - send [username] [message] in private room
+/rooms - List rooms
+/currentroom - Prints the name of the current room
+/users [room] [prefix] - List all users, or users in [room], '*' for every room,
+    only names starting with [prefix]
+/users + - Continue a listing that was cut short
+/join [room] [n] - Join room, showing up to [n] recent messages
+/leave [room] - Leave current room, or leave [room]
+/exit - Exit program
+/quit - Exit program
+/help - Print this message
+/debug - Toggle debug information
+'''
+
+def connect():
+    '''
+    Connects to the server, exits if it can't be reached
+    '''
+    sockt = socket.socket(socket.AF_INET)
+    try:
+        sockt.connect(SERVER_ADDRESS)
+    except ConnectionRefusedError:
+        print('Error connecting to server')
+        exit()
+    return sockt
+
+def attempt_login(sockt, username):
+    '''
+    Logs in before showing main interface. Raises ConnectionError if the
+    server closed the connection
+    '''
+    try:
+        codec = JsonCodec()
+        sockt.sendall(codec.encode(login_request(username, ENCODING, COMPRESSION))[0])
+        decoder = codec.new_decoder()
+        while resp := next_response(sockt, decoder):
+            opcode = resp['op']
+            if opcode != OpCode.LOGIN:
+
+                # answer heartbeats so the server knows we're alive
+                if opcode == OpCode.HEART_BEAT:
+                    sockt.sendall(codec.encode({ 'op': OpCode.HEART_BEAT })[0])
+                    continue
+                    
+                # username errors
+                if opcode in LOGIN_ERRORS:
+                    print(f'ERROR: {LOGIN_ERRORS[opcode]}')
+                else:
+                    print(f'OPCODE: {opcode:#x}')
+                    print(f'{resp}')
+                    continue
+
+                return None
+
+            # everything after the response uses the encoding and compression
+            # the server agreed to
+            codec, decoder, compressor, decompressor = accept_login(resp, decoder)
+
+            # frames received after the login response stay buffered in decoder
+            user = User(resp['username'], sockt, codec, decoder, compressor, decompressor)
+            return user
+        raise ConnectionResetError('Server closed the connection')
+    except TimeoutError as e:
+        print('Connection timed out.')
+        exit()
+    except Exception as e:
+        raise e
+
+
+def next_response(sockt, decoder):
+    '''
+    Blocks until a full response frame is available and returns it decoded,
+    returns None if the server closed the connection
+    '''
+    while (frame := decoder.next_frame()) is None:
+        data = sockt.recv(RECV_SIZE)
+        if not data:
+            return None
+        decoder.feed(data)
+    return decoder.decode(frame)
+
+
+# runs on another thread
+def listen_on_socket(user, responsefn):
+    '''
+    Listens for server messages on a separate thread
+    '''
+    sockt = user.socket
+    decoder = user.decoder
+    # make sure app has chance to start main loop
+    sleep(0.1)
+    sockt.settimeout(TIMEOUT_TIME)
+    try:
+        while True:
+            # handle anything left over from login before waiting on the socket
+            for frame in decoder:
+                try:
+                    data = decoder.decode(frame)
+                except (JSONDecodeError, DecodeError):
+                    raise ValueError(f'Decoding failed. Data is {bytes(frame)}')
+
+                # no need to tell main thread about heartbeats, just answer
+                # them so the server doesn't time us out
+                if data['op'] == OpCode.HEART_BEAT:
+                    user.send({ 'op': OpCode.HEART_BEAT })
+                    continue
+
+                responsefn(data)
+
+            read_s, _, _ = select.select([sockt], [], [], TIMEOUT_TIME)
+
+            if len(read_s):
+                # uncompressed data is read straight into the decoder's
+                # buffer, see framing.py
+                if user.decompressor:
+                    data = sockt.recv(RECV_SIZE)
+                    received = len(data)
+                    if received:
+                        decoder.feed(user.decompressor.decompress(data))
+                else:
+                    received = decoder.recv_into(sockt)
+
+                # when server disconnects, read_s gets an empty bytestring
+                if not received:
+                    responsefn({ 'op': OpCode.ERR_TIMEOUT })
+                    return
+
+    # signal works just fine in a thread, but yells at us that it can't be in the
+    # main thread and throws a ValueError only when the server disconnects.
+    # TODO better way??
+    except (ValueError, TimeoutError) as e:
+        responsefn({ 'op': OpCode.ERR_TIMEOUT })
+        raise e
+
+
+class User:
+    '''
+    Represents a user
+    '''
+
+    def __init__(self, username, sockt, codec, decoder, compressor=None, decompressor=None):
+        self.username = username
+        self.socket = sockt
+        self.codec = codec
+        self.decoder = decoder
+        self.compressor = compressor
+        self.decompressor = decompressor
+        # the UI and the socket listener thread both send
+        self.send_lock = Lock()
+
+    def send(self, payload):
+        '''
+        Encodes and sends a request to the server
+        '''
+        data, _ = self.codec.encode(payload)
+        with self.send_lock:
+            # compress under the lock, the stream must match the send order
+            if self.compressor:
+                data = self.compressor.compress([data])
+            self.socket.sendall(data)
+
+    def compression_stats(self):
+        '''
+        Describes how well the connection compresses, or None if it doesn't
+        '''
+        if not self.compressor:
+            return None
+        return (f'COMPRESSION: sent {self.compressor.raw} -> {self.compressor.compressed} bytes '
+            f'({self.compressor.ratio():.0%}, {self.compressor.seconds * 1000:.1f} ms CPU), '
+            f'received {self.decompressor.compressed} -> {self.decompressor.raw} bytes '
+            f'({self.decompressor.ratio():.0%}, {self.decompressor.seconds * 1000:.1f} ms CPU)')
+
+class Room:
+    '''
+    Represents a room
+    '''
+
+    def __init__(self, name, lines=()):
+        self.name = name
+        self.scrollback = Scrollback(SCROLLBACK_LINES, SPILL_DIR)
+        for line in lines:
+            self.scrollback.append(line)
+        self.walker = ScrollbackWalker(self.scrollback)
+
+    def close(self):
+        self.scrollback.close()
+
+class ScrollbackWalker(urwid.ListWalker):
+    '''
+    Shows a room's scrollback in the chat ListBox. Text widgets are only made
+    for the lines the ListBox asks for, which are the ones on screen, and a
+    few hundred of them are cached
+    '''
+
+    def __init__(self, scrollback):
+        self.scrollback = scrollback
+        self.focus = len(scrollback) - 1
+        # whether the focus stays on the newest line as lines arrive
+        self.follow = True
+        self.widgets = OrderedDict()
+
+    def widget(self, position):
+        '''
+        Returns the Text widget for position, or None if there is no line
+        '''
+        widget = self.widgets.get(position)
+        if widget is not None:
+            self.widgets.move_to_end(position)
+            return widget
+        if position < self.scrollback.first():
+            return None
+        line = self.scrollback.get(position)
+        if line is None:
+            return None
+        widget = self.widgets[position] = urwid.Text(line)
+        if len(self.widgets) > WIDGET_CACHE:
+            self.widgets.popitem(last=False)
+        return widget
+
+    def at(self, position):
+        widget = self.widget(position)
+        return (widget, position if widget is not None else None)
+
+    def get_focus(self):
+        return self.at(self.focus)
+
+    def set_focus(self, position):
+        self.focus = position
+        self.follow = position >= len(self.scrollback) - 1
+        self._modified()
+
+    def get_next(self, position):
+        return self.at(position + 1)
+
+    def get_prev(self, position):
+        return self.at(position - 1)
+
+    def refresh(self):
+        '''
+        Catches up with lines appended since the last redraw
+        '''
+        if self.follow:
+            self.focus = len(self.scrollback) - 1
+        else:
+            self.focus = max(self.focus, self.scrollback.first())
+        self._modified()
+
+class App(urwid.Pile):
+
+    def __init__(self):
+        '''
+        Attempts to login and builds UI upon success. Main loop must be started
+        separately.
+        '''
+        # Login before launching TUI
+        sockt = None
+        user = None
+        while not user:
+            print('Enter Username: ', end='')
+            username = input()
+            # connect once a name is entered, the server times out connections
+            # that stay quiet while waiting on the prompt
+            if sockt is None:
+                sockt = connect()
+            try:
+                user = attempt_login(sockt, username)
+            except ConnectionError:
+                print('Lost connection to server, reconnecting...')
+                sockt.close()
+                sockt = None
+
+        self.debug = False
+        # last LIST_USERS request, continued by '/users +', and whether a
+        # paged listing is being printed
+        self.users_request = None
+        self.users_listing = False
+        # Commands that either send server requests or print information
+        self.commands = {    
+            '/login': self.cmd_login, 
+            '/rooms': self.cmd_list_rooms, 
+            '/users': self.cmd_list_users, 
+            '/join': self.cmd_join_room, 
+            '/leave': self.cmd_leave_room, 
+            '/message': self.cmd_message,
+            '/whisper': self.cmd_whisper,
+            '/exit': self.cmd_exit_app,
+            '/quit': self.cmd_exit_app,
+            '/help': self.cmd_help_cmd,
+            '/debug': self.toggle_debug,
+            '/currentroom': self.cmd_current_room,
+            }
+
+        # Handles responding to server messages
+        self.responses = {
+            OpCode.MESSAGE: self.rsp_message,
+            OpCode.LOGIN: self.rsp_login,
+            OpCode.LIST_USERS: self.rsp_list_users,
+            OpCode.LIST_ROOMS: self.rsp_list_rooms,
+            OpCode.JOIN_ROOM: self.rsp_join_room,
+            OpCode.WHISPER: self.rsp_whisper,
+            OpCode.USER_EXIT: self.rsp_user_exit,
+            OpCode.LEAVE_ROOM: self.rsp_leave_room,
+
+            OpCode.ERR_TIMEOUT: self.rsp_err_timeout,
+            OpCode.ERR_ILLEGAL_LEN: self.rsp_err_illegal_len,
+            OpCode.ERR_ILLEGAL_WISP: self.rsp_err_illegal_wisp,
+            OpCode.ERR_ILLEGAL_OP: self.rsp_err_illegal_op,
+            OpCode.ERR_NAME_EXISTS: self.rsp_err_name_exists,
+            OpCode.ERR_ILLEGAL_NAME: self.rsp_err_illegal_name,
+            OpCode.ERR_ILLEGAL_MSG: self.rsp_err_illegal_msg,
+            OpCode.ERR_MALFORMED: self.rsp_err_malformed,
+            OpCode.ERR_NOT_IN_ROOM: self.rsp_err_not_in_room,
+            OpCode.ERR_RATE_LIMITED: self.rsp_err_rate_limited,
+
+            OpCode.ERR: self.rsp_err,
+        }
+
+        welcome_messages = [
+            WELCOME_MSG,
+            f"You are logged in as '{user.username}'",
+        ]
+        # join default room automatically
+        default_room = Room('default', welcome_messages)
+        self.rooms = [default_room]
+        self.current_room = default_room
+
+        # setup urwid UI, self is main app container
+        self.text_widget = urwid.ListBox(self.current_room.walker)
+        self.edit_widget = urwid.Edit(' > ')
+        self.edit_box = urwid.LineBox(urwid.Filler(self.edit_widget))
+        super(App, self).__init__([self.text_widget, (3, self.edit_box)], 1)
+        self.loop = urwid.MainLoop(self)
+        # write to this pipe to quit the application
+        self.quit_pipe = self.loop.watch_pipe(self.cmd_exit_app)
+        # printfn writes to this pipe to ask the main loop for a redraw, at
+        # most one is pending and they are at least 1 / FRAME_RATE apart
+        self.redraw_pipe = self.loop.watch_pipe(self.schedule_redraw)
+        self.redraw_lock = Lock()
+        self.redraw_pending = False
+        self.last_redraw = 0.0
+
+        # setup socket listener
+        self.user = user
+        self.socket = user.socket
+        self.socket_thread = Thread(target=listen_on_socket, args=(user, self.handle_server_response))
+        self.socket_thread.start()
+    
+    def toggle_debug(self, _=''):
+        '''
+        Toggles debug mode and prints a notification
+        '''
+        self.debug = not self.debug
+        status = f"DEBUG IS [{'ON' if self.debug else 'OFF'}]"
+        stats = self.user.compression_stats()
+        if self.debug and stats:
+            status += '\n' + stats
+        return (None, status)
+
+    def keypress(self, size, key):
+        '''
+        Handles app keypresses (globally)
+        '''
+        if key == 'enter':
+            edit_text = self.edit_widget.get_edit_text()
+            payload = self.input_check(edit_text)
+            if payload:
+                if self.debug:
+                    self.printfn(f'SENDING: {payload}')
+                self.user.send(payload)
+            self.edit_widget.edit_text = ''
+        elif key in ('page up', 'page down'):
+            # scroll the chat while typing
+            self.text_widget.keypress(size, key)
+        else:
+            super(App, self).keypress(size, key)
+    
+    # prints into chat scroll
+    def printfn(self, string, room=None):
+        '''
+        Prints to the client display
+        '''
+        if not room:
+            room = self.current_room
+        room.scrollback.append(string)
+        if room == self.current_room:
+            self.request_redraw()
+
+    def request_redraw(self):
+        '''
+        Asks the main loop to redraw, can be called from any thread
+        '''
+        with self.redraw_lock:
+            if self.redraw_pending:
+                return
+            self.redraw_pending = True
+        os.write(self.redraw_pipe, b'.')
+
+    def schedule_redraw(self, _):
+        '''
+        Runs on the main loop when a redraw is requested, holds it back until
+        a frame has passed since the last one
+        '''
+        delay = max(0.0, self.last_redraw + 1 / FRAME_RATE - monotonic())
+        self.loop.set_alarm_in(delay, self.redraw)
+        return True
+
+    def redraw(self, loop, _):
+        '''
+        Shows the current room's new lines, the main loop draws the screen
+        once this returns
+        '''
+        with self.redraw_lock:
+            self.redraw_pending = False
+        self.last_redraw = monotonic()
+        walker = self.current_room.walker
+        if self.text_widget.body is not walker:
+            self.text_widget.body = walker
+        walker.refresh()
+        if walker.follow:
+            self.text_widget.set_focus_valign('bottom')
+
+    def input_check(self, input):
+        '''
+        Parses input and potentially executes commands
+        '''
+
+        if input[0:1] == '/':
+            if ' ' in input:
+                command, msg = input.split(' ',1)
+            else:
+                command, msg = input, ''
+            payload = None
+            try:
+                payload, msg = self.commands[command](msg)
+                if msg is not None:
+                    self.printfn(msg)
+            except KeyError:
+                self.printfn(f"Bad Command '{command}'")
+        else:
+            payload, _ = self.cmd_message(input)
+        
+        return payload
+    
+    def get_room_by_name(self, room_name):
+        '''
+        Returns a room from room list by name
+        '''
+        for (i, room) in enumerate(self.rooms):
+            if room.name == room_name:
+                return self.rooms[i]
+    
+    def switch_current_room_by_name(self, room_name):
+        '''
+        Switches the current (visible) room
+        '''
+        for room in self.rooms:
+            if room.name == room_name:
+                self.current_room = room
+                self.request_redraw()
+                return
+        raise ValueError(f"No room named '{room_name}'\nRooms: {[r.name for r in self.rooms]}")
+    
+    def handle_server_response(self, response):
+        '''
+        Responds to a server message, see RESPONSEs
+        '''
+        try:
+            op = response['op']
+        except KeyError:
+            self.printfn('ERROR: Malformed response from server:')
+            self.printfn(response)
+            return
+        
+        respond_fn = None
+        try:
+            respond_fn = self.responses[op]
+        except KeyError:
+            raise ValueError(f'UNKOWN OPCODE {op:#x} SERVER RESPONSE {json.dumps(response)}')
+        
+        if self.debug:
+            self.printfn(f'RECEIVING: {json.dumps(response)}')
+
+        if respond_fn:
+            respond_fn(response)
+        else:
+            raise ValueError(f'Respond fn is None -- OPCODE: {op:#x}, Response: {response}')
+        
+        
+
+    # ==========================================================================
+    # RESPONSE operations
+    # ==========================================================================
+
+    def rsp_message(self, response):
+        '''
+        RESPONSE command executed when message received
+        '''
+        message = f'{response["user"]}: {response["message"]}'
+        if self.current_room.name == response['room']:
+            self.printfn(message)
+        else:
+            if room := self.get_room_by_name(response['room']):
+                self.printfn(message, room)
+    
+    def rsp_login(self, response):
+        '''
+        RESPONSE command executed when notified that user logged in
+        '''
+        self.printfn(f'User {response["username"]} has logged in.')
+    
+    def rsp_list_users(self, response):
+        '''
+        RESPONSE command executed when notified that user listed users, long
+        listings arrive as several pages that are printed as they come
+        '''
+        if not self.users_listing:
+            self.printfn(f'USERS')
+            self.users_listing = True
+        if response['users']:
+            self.printfn(','.join(response['users']))
+        if response.get('more'):
+            return
+        self.users_listing = False
+        if 'cursor' in response:
+            self.users_request['cursor'] = response['cursor']
+            self.printfn("More users, '/users +' to list them")
+        else:
+            self.users_request = None
+    
+    def rsp_list_rooms(self, response):
+        '''
+        RESPONSE command executed when notified that user listed rooms
+        '''
+        self.printfn(f'ROOMS')
+        counts = response.get('counts')
+        if counts:
+            self.printfn(','.join(f'{room} ({count})' for room, count in zip(response['rooms'], counts)))
+        else:
+            self.printfn(','.join(response['rooms']))
+    
+    def rsp_join_room(self, response):
+        '''
+        RESPONSE command executed when notified that user joined room
+        '''
+        if response["user"] == self.user.username:
+            room_name = response['room']
+            if room_name not in [r.name for r in self.rooms]:
+                self.rooms.append(Room(room_name))
+            self.switch_current_room_by_name(room_name)
+            self.printfn(f'Joined room "{response["room"]}"')
+        else:
+            self.printfn(f'{response["user"]} has joined {response["room"]}')
+
+    def rsp_whisper(self, response):
+        '''
+        RESPONSE command executed when notified that user sent or received whisper
+        '''
+        self.printfn("WHISPER SENT")
+        room_name = response["room"]
+        # notification of message if not in room
+        if room_name != self.current_room.name:
+            if response['sender'] == self.user.username:
+                message = f'You whispered {response["target"]}'
+            else:
+                message = f'{response["sender"]} whispered you'
+            self.printfn(message)
+        
+        # send message to room
+        message = f'{response["sender"]}: {response["message"]}'
+        if room_name not in [r.name for r in self.rooms]:
+            self.rooms.append(Room(room_name))
+        room = self.get_room_by_name(room_name)
+        self.printfn(message, room)
+    
+    def rsp_user_exit(self, response):
+        '''
+        RESPONSE command executed when notified that a user exited
+        '''
+        self.printfn(f'''User '{response["user"]}' has logged off''')
+    
+    def rsp_leave_room(self, response):
+        '''
+        RESPONSE command executed when notified that a user exited
+        '''
+        room_name = response["room"]
+        room = self.get_room_by_name(room_name)
+        if response["user"] == self.user.username:
+            self.rooms.remove(room)
+            room.close()
+            if room == self.current_room:
+                self.printfn("LEAVING CURRENT ROOM")
+                self.switch_current_room_by_name('default')
+            self.printfn(f"Left room '{response['room']}'")
+        else:
+            self.printfn(f"User '{response['user']}' has left the room", room)
+    
+    def rsp_err_timeout(self, response):
+        '''
+        RESPONSE command executed when notified that server timed out
+        '''
+        os.write(self.quit_pipe, 'Server timed out'.encode())
+    
+    def rsp_err_illegal_op(self, response):
+        '''
+        RESPONSE command executed when notified that user requested illegal operation
+        '''
+        self.printfn('SERVER ERROR: Illegal Operation')
+
+    def rsp_err_name_exists(self, response):
+        '''
+        RESPONSE command executed when notified that user requested a username that doesn't exist
+        '''
+        self.printfn('SERVER ERROR: Name exists')
+
+    def rsp_err_illegal_name(self, response):
+        '''
+        RESPONSE command executed when notified that user requested a username that is illegal
+        '''
+        self.printfn('SERVER ERROR: Illegal Name')
+
+    def rsp_err_illegal_msg(self, response):
+        '''
+        RESPONSE command executed when notified that user tried to send a message that is illegal
+        '''
+        self.printfn('SERVER ERROR: Illegal Message')
+
+    def rsp_err_malformed(self, response):
+        '''
+        RESPONSE command executed when a response from the server is malformed
+        '''
+        self.printfn('SERVER ERROR: Received malformed request')
+
+    def rsp_err_illegal_wisp(self, response):
+        '''
+        RESPONSE command executed when client requested illegal whisper
+        '''
+        self.printfn('SERVER ERROR: Illegal whisper')
+
+    def rsp_err_not_in_room(self, response):
+        '''
+        RESPONSE command executed when client requested illegal whisper
+        '''
+        self.printfn('SERVER ERROR: Not in room')
+
+    def rsp_err_rate_limited(self, response):
+        '''
+        RESPONSE command executed when a request was dropped for going over a rate limit
+        '''
+        self.printfn(f"SERVER ERROR: Too many requests ({response.get('limit')} limit), slow down")
+
+    def rsp_err_illegal_len(self, response):
+        '''
+        RESPONSE command executed when client requested username with illegal length
+        '''
+        self.printfn('SERVER ERROR: Illegal username length')
+
+    def rsp_err(self, response):
+        '''
+        RESPONSE generic error (currently unused)
+        '''
+        self.printfn(json.loads(response))
+
+
+
+    # ==========================================================================
+    # COMMANDS operations
+    # ==========================================================================
+
+    def cmd_login(self, name=''):
+        '''
+        COMMAND request to login as name
+        '''
+        payload = { 
+            'op': OpCode.LOGIN,
+            'username':name,
+            }
+        return (payload, f'Attempting to log in as {name}...')
+
+    def cmd_list_rooms(self, _=''):
+        '''
+        COMMAND request to list rooms
+        '''
+        payload = { 'op': OpCode.LIST_ROOMS, }
+        return (payload, None)
+
+    def cmd_list_users(self, args=''):
+        '''
+        COMMAND request to list users
+        '''
+        if args == '+':
+            if not self.users_request:
+                return (None, 'ERROR: No user listing to continue')
+            return (dict(self.users_request), None)
+        room, _, prefix = args.partition(' ')
+        payload = { 
+            'op': OpCode.LIST_USERS,
+            'room': '' if room == '*' else room,
+            }
+        if prefix:
+            payload['prefix'] = prefix
+        self.users_request = dict(payload)
+        return (payload, None)
+    
+    def cmd_current_room(self, _=''):
+        '''
+        COMMAND prints curent room 
+        '''
+        return (None, f"Current room is '{self.current_room.name}'")
+
+    def cmd_join_room(self, room=''):
+        '''
+        COMMAND request to join room
+        '''
+        if not room:
+            return (None, 'ERROR: Expected /join [room] [n]')
+        history = 0
+        if ' ' in room:
+            room, history = room.split(' ', 1)
+            try:
+                history = int(history)
+            except ValueError:
+                return (None, 'ERROR: Expected /join [room] [n]')
+        if room in [r.name for r in self.rooms]:
+            self.switch_current_room_by_name(room)
+            self.printfn(f'Switched to room {room}')
+            return (None, None)
+        payload = { 
+            'op': OpCode.JOIN_ROOM,
+            'user': self.user.username,
+            'room': room,
+            }
+        if history:
+            payload['history'] = history
+        return (payload, None)
+        
+    def cmd_leave_room(self, room=''):
+        '''
+        COMMAND request to leave room
+        '''
+        if not room:
+            return (None, 'ERROR: Expected "/leave [room]"')
+        if room == 'default':
+            return (None, "ERROR: Leaving room 'default' is not allowed")
+        if room == self.current_room.name:
+            self.switch_current_room_by_name('default')
+        payload = { 
+            'op': OpCode.LEAVE_ROOM,
+            'room': room,
+            'user': self.user.username,
+            }
+        return (payload, None)
+        
+    def cmd_message(self, message=''):
+        '''
+        COMMAND request to send message
+        '''
+        if message == '':
+            return (None, None)
+        payload = { 
+            'op': OpCode.MESSAGE,
+            'user': self.user.username,
+            'room': self.current_room.name,
+            'message': message,
+            }
+        return (payload, None)
+
+    def cmd_whisper(self, message=''):
+        '''
+        COMMAND request to send whisper
+        '''
+        if message == '':
+            return (None, None)
+        
+        target = None
+        try:
+            target, message = message.split(" ", 1) 
+        except:
+            return (None, 'ERROR: Expected "/whisper [user] [message]"')
+
+        if target == self.user.username:
+            return (None, 'ERROR: You cannot whisper yourself')
+
+        payload = { 
+            'op': OpCode.WHISPER,
+            'sender': self.user.username,
+            'target': target,
+            'message': message,
+            }
+        return (payload, None)
+
+    # TODO doesn't work
+    def cmd_exit_app(self, msg=''):
+        '''
+        Exits app
+        '''
+        global exit_msg
+        if type(msg) == bytes:
+            msg = msg.decode()
+        exit_msg = msg
+        raise urwid.ExitMainLoop()
+
+    def cmd_help_cmd(self, _=''):
+        '''
+        Prints help command
+        '''
+        return (None, HELP_MSG)
+
+
+def run_client(address, encoding=None, compression=None,
+        scrollback=DEFAULT_LINES, spill_dir=None):
+    '''
+    Runs the client application and cleans up upon quitting
+    '''
+    global SERVER_ADDRESS, ENCODING, COMPRESSION, SCROLLBACK_LINES, SPILL_DIR
+    SERVER_ADDRESS = address
+    ENCODING = encoding
+    COMPRESSION = compression
+    SCROLLBACK_LINES = scrollback
+    SPILL_DIR = spill_dir
+    app = App()
+    app.loop.run()
+    print(exit_msg)
+    os._exit(0)
+    
\ No newline at end of file
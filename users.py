@@ -0,0 +1,79 @@
+'''
+Sorted index of logged in usernames, answering LIST_USERS a page at a time.
+
+LIST_USERS requests may carry:
+
+    prefix  only list names starting with this
+    cursor  only list names after this one, from a previous response
+    limit   most names to list, the server's PAGE_LIMIT at most
+
+The answer is streamed as LIST_USERS frames of up to PAGE_SIZE names each.
+Every frame but the last has 'more': true. If the limit cut the listing short
+the last frame has a 'cursor' to send back for the rest.
+'''
+
+from bisect import bisect_left, bisect_right, insort
+from threading import Lock
+
+# names per LIST_USERS frame
+PAGE_SIZE = 200
+# most names listed for one request
+PAGE_LIMIT = 10000
+
+
+class UserIndex:
+    '''
+    Usernames in sorted order
+    '''
+
+    def __init__(self):
+        self.names = []
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        with self.lock:
+            i = bisect_left(self.names, name)
+            return i < len(self.names) and self.names[i] == name
+
+    def add(self, name):
+        with self.lock:
+            insort(self.names, name)
+
+    def remove(self, name):
+        with self.lock:
+            i = bisect_left(self.names, name)
+            if i < len(self.names) and self.names[i] == name:
+                del self.names[i]
+
+    def page(self, prefix='', cursor=None, limit=PAGE_LIMIT):
+        '''
+        Returns up to limit names starting with prefix that sort after cursor
+        '''
+        with self.lock:
+            return page(self.names, prefix, cursor, limit)
+
+
+def page(names, prefix='', cursor=None, limit=PAGE_LIMIT):
+    '''
+    Returns up to limit of the sorted names starting with prefix that sort
+    after cursor
+    '''
+    start = bisect_left(names, prefix)
+    if cursor is not None:
+        start = max(start, bisect_right(names, cursor))
+    out = []
+    for name in names[start:start + limit]:
+        if not name.startswith(prefix):
+            break
+        out.append(name)
+    return out
+
+
+def pages(names, size=PAGE_SIZE):
+    '''
+    Splits names into lists of up to size, always at least one
+    '''
+    return [names[i:i + size] for i in range(0, len(names), size)] or [[]]